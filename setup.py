@@ -85,5 +85,7 @@ setup(name='Products.LDAPUserFolder',
       entry_points="""
       [zope2.initialize]
       Products.LDAPUserFolder = Products.LDAPUserFolder:initialize
+      [console_scripts]
+      ldapuserfolder-cacheserver = Products.LDAPUserFolder.sharedcache:main
       """,
       )
@@ -0,0 +1,839 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" AsyncLDAPDelegate: A delegate with a non-blocking asyncio core
+"""
+
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from hashlib import sha1
+
+import ldap
+
+from .cache import getResource
+from .LDAPDelegate import LDAPDelegate
+from .LDAPDelegate import _cleanDN
+from .LDAPDelegate import _decodeEntry
+from .LDAPDelegate import _getReferralTarget
+from .LDAPDelegate import _insertAttributes
+from .LDAPDelegate import _modifyList
+from .LDAPDelegate import _newRdn
+from .LDAPDelegate import _openConnection
+from .LDAPDelegate import _searchErrorMessage
+from .servers import allowedServers
+from .utils import registerDelegate
+from .utils import to_utf8
+
+
+logger = logging.getLogger('event.LDAPDelegate')
+
+# All running event loop threads, stopped at process exit
+_loop_threads = weakref.WeakSet()
+
+# Blocking equivalents of the asynchronous python-ldap methods, used for
+# connections that do not support the asynchronous API
+SYNC_METHODS = {'search_ext': 'search_s',
+                'add_ext': 'add_s',
+                'modify_ext': 'modify_s',
+                'delete_ext': 'delete_s',
+                'rename': 'modrdn_s'}
+
+
+class Channel:
+    """ A bound connection shared by all operations of one event loop
+
+    Requests are sent with the asynchronous python-ldap API and their
+    results are collected by message ID, so any number of operations
+    can be outstanding on the same connection at the same time.
+    """
+
+    # Bounds for the interval in seconds between checks for a result
+    # if no readiness notification arrives from the socket
+    min_poll = 0.001
+    max_poll = 0.05
+
+    def __init__(self, key, connection, loop, op_timeout=-1):
+        self.key = key
+        self.connection = connection
+        self.loop = loop
+        self.op_timeout = op_timeout
+        self.healthy = True
+        self.pending = 0
+        self.registry = None
+        self.task = None
+        self._waiters = []
+
+        try:
+            self._fd = connection.fileno()
+        except (AttributeError, ValueError, ldap.LDAPError):
+            self._fd = None
+
+    async def call(self, method, *args):
+        """ Send a request and wait for its complete result
+
+        Returns the result tuple of ``result3``. Connections without the
+        asynchronous API, like test stand-ins, are called synchronously
+        and only the result data is set in the returned tuple.
+        """
+        if not hasattr(self.connection, 'result3'):
+            data = getattr(self.connection, SYNC_METHODS[method])(*args)
+            return None, data, None, []
+
+        msgid = getattr(self.connection, method)(*args)
+        self.pending += 1
+
+        try:
+            if self.op_timeout > 0:
+                return await asyncio.wait_for(self.result(msgid),
+                                              self.op_timeout)
+            return await self.result(msgid)
+        except asyncio.TimeoutError:
+            self.abandon(msgid)
+            raise ldap.TIMEOUT(f'No result after {self.op_timeout} seconds')
+        except asyncio.CancelledError:
+            self.abandon(msgid)
+            raise
+        finally:
+            self.pending -= 1
+
+    async def result(self, msgid):
+        """ Wait for the complete result of request ``msgid``
+
+        Search entries are collected as they arrive. Like the standard
+        delegate, the entries received so far are returned if the server
+        reports partial results.
+        """
+        delay = self.min_poll
+        entries = []
+
+        while True:
+            try:
+                res = self.connection.result3(msgid, 0, 0)
+            except ldap.PARTIAL_RESULTS:
+                return ldap.RES_SEARCH_RESULT, entries, msgid, []
+
+            if res[0] in (ldap.RES_SEARCH_ENTRY, ldap.RES_SEARCH_REFERENCE):
+                entries.extend(res[1])
+                delay = self.min_poll
+                continue
+
+            if res[0] is not None:
+                return res[0], entries + list(res[1] or []), res[2], res[3]
+
+            await self._readable(delay)
+            delay = min(delay * 2, self.max_poll)
+
+    def abandon(self, msgid):
+        """ Tell the server to stop working on request ``msgid`` """
+        try:
+            self.connection.abandon(msgid)
+        except (AttributeError, ldap.LDAPError):
+            pass
+
+    def close(self):
+        """ Forget the connection and unbind it in a thread
+
+        Must be called in the event loop of the channel. Unbinding may
+        block, so it never runs in the event loop itself.
+        """
+        self.healthy = False
+        self._wake()
+
+        try:
+            self.loop.run_in_executor(None, self._unbind)
+        except RuntimeError:  # Executor shut down, the loop is ending
+            self._unbind()
+
+    def _unbind(self):
+        try:
+            self.connection.unbind_s()
+        except Exception:
+            pass
+
+    async def _readable(self, timeout):
+        """ Wait until data arrives on the socket or ``timeout`` passes
+
+        All waiters of a channel share a single reader callback. Results
+        may also arrive in data that was already read from the socket,
+        which is why the waiting time is always limited.
+        """
+        if self._fd is None:
+            await asyncio.sleep(timeout)
+            return
+
+        future = self.loop.create_future()
+        if not self._waiters:
+            self.loop.add_reader(self._fd, self._wake)
+        self._waiters.append(future)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+            if not self._waiters:
+                self.loop.remove_reader(self._fd)
+
+    def _wake(self):
+        """ Wake up all operations waiting for data """
+        waiters, self._waiters = self._waiters, []
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+
+class ChannelRegistry:
+    """ The channels of a delegate, per event loop and connection key
+
+    Values are tasks that open the channel, so concurrent operations
+    needing the same connection wait for a single connection attempt.
+
+    Like the connection pool, each event loop keeps at most
+    ``max_size`` channels. Channels unused for ``idle_timeout`` seconds
+    are closed, and the least recently used ones are closed if a new
+    channel exceeds the limit. Channels with outstanding requests are
+    never closed by the registry.
+    """
+
+    def __init__(self, max_size=10, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._loops = weakref.WeakKeyDictionary()
+
+    def get(self, loop, key, now=None):
+        """ Get the task for ``key`` and mark it as recently used """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            channels = self._loops.get(loop)
+            evicted = self._reap(channels or {}, now)
+
+            entry = channels.get(key) if channels else None
+            if entry is not None:
+                entry[1] = now
+                channels.move_to_end(key)
+
+        self._close(loop, evicted)
+
+        return entry and entry[0]
+
+    def set(self, loop, key, task, now=None):
+        """ Store the task for ``key``, closing channels over the limit """
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            # Channels keep their loop alive, forget those of closed loops
+            for closed in [x for x in self._loops if x.is_closed()]:
+                del self._loops[closed]
+
+            channels = self._loops.setdefault(loop, OrderedDict())
+            replaced = channels.pop(key, None)
+            channels[key] = [task, now]
+            evicted = self._reap(channels, now)
+
+            for old_key, (old_task, last_used) in list(channels.items()):
+                if len(channels) <= self.max_size:
+                    break
+                if old_key != key and self._isIdle(old_task):
+                    del channels[old_key]
+                    evicted.append(old_task)
+
+        if replaced is not None and self._isIdle(replaced[0]):
+            evicted.append(replaced[0])
+        self._close(loop, evicted)
+
+    def discard(self, loop, key, task):
+        with self._lock:
+            channels = self._loops.get(loop, {})
+            entry = channels.get(key)
+            if entry is not None and entry[0] is task:
+                del channels[key]
+
+    def clear(self):
+        """ Forget all channels and close them in their event loops """
+        with self._lock:
+            loops = list(self._loops.items())
+            self._loops.clear()
+
+        for loop, channels in loops:
+            self._close(loop, [x[0] for x in channels.values()])
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(x) for x in self._loops.values())
+
+    def _reap(self, channels, now):
+        """ Remove the channels idle for too long and return their tasks
+
+        Entries are kept in the order of their last use, so only the
+        oldest ones need to be looked at.
+        """
+        evicted = []
+
+        for key, (task, last_used) in list(channels.items()):
+            if now - last_used <= self.idle_timeout:
+                break
+            if self._isIdle(task):
+                del channels[key]
+                evicted.append(task)
+
+        return evicted
+
+    def _isIdle(self, task):
+        """ Is the task done and its channel without outstanding requests?
+        """
+        if not task.done():
+            return False
+
+        if task.cancelled() or task.exception() is not None:
+            return True
+
+        return not task.result().pending
+
+    def _close(self, loop, tasks):
+        """ Close the channels opened by ``tasks`` in their event loop """
+        for task in tasks:
+            if task.done() and not task.cancelled() and \
+               task.exception() is None:
+                try:
+                    loop.call_soon_threadsafe(task.result().close)
+                except RuntimeError:  # Event loop is closed
+                    pass
+
+
+class AsyncOperations:
+    """ The coroutines behind the operations of an AsyncLDAPDelegate
+
+    An instance is created for each operation in the calling thread. It
+    only holds the bind credentials, copies of the delegate settings and
+    process-wide objects, because the coroutines run in an event loop
+    thread where the persistent delegate must not be used.
+    """
+
+    def __init__(self, credentials, candidates, read_only, rdn_attr,
+                 health, counters, channels, referrals):
+        self.credentials = credentials
+        self.identity = (credentials[0],
+                         sha1(to_utf8(credentials[1] or '')).hexdigest())
+        self.candidates = candidates
+        self.read_only = read_only
+        self.rdn_attr = rdn_attr
+        self.health = health
+        self.counters = counters
+        self.channels = channels
+        self.referrals = referrals
+
+    def servers(self):
+        """ Yield (connection string, server) tuples in order of preference
+        """
+        return allowedServers(self.candidates, self.health)
+
+    def getTimeout(self, requests=1):
+        """ Get the seconds to wait for ``requests`` consecutive requests
+
+        Each request may try to connect to every server and is sent up
+        to twice, after a lost connection or to a referral target.
+        Returns None if any server has no connection or operation
+        timeout.
+        """
+        if not self.candidates:
+            return None
+
+        connect = 0
+        operation = 0
+        for conn_string, server in self.candidates:
+            if server['conn_timeout'] <= 0 or server['op_timeout'] <= 0:
+                return None
+            connect += server['conn_timeout']
+            operation = max(operation, server['op_timeout'])
+
+        return requests * 2 * (connect + operation)
+
+    async def search(self, base, scope, filter='(objectClass=*)', attrs=[]):
+        """ Coroutine version of ``LDAPDelegate.search`` """
+        result = {'exception': '', 'size': 0, 'results': []}
+        base = _cleanDN(base)
+
+        try:
+            res = await self.perform('search_ext', base, scope, filter,
+                                     attrs)
+
+            for rec_dn, rec_dict in res[1]:
+                rec_dict = _decodeEntry(rec_dn, rec_dict)
+
+                if rec_dict is not None:
+                    result['results'].append(rec_dict)
+                    result['size'] += 1
+
+        except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+            raise
+
+        except Exception as e:
+            result['exception'] = _searchErrorMessage(e, base, filter)
+
+        return result
+
+    async def searchMany(self, queries):
+        """ Coroutine version of ``LDAPDelegate.search_many`` """
+        searches = [self.search(x['base'], x['scope'],
+                                x.get('filter', '(objectClass=*)'),
+                                x.get('attrs', []))
+                    for x in queries]
+
+        return list(await asyncio.gather(*searches))
+
+    async def insert(self, base, rdn, attrs=None):
+        """ Coroutine version of ``LDAPDelegate.insert`` """
+        if self.read_only:
+            msg = 'Running in read-only mode, insertion is disabled'
+            logger.info(msg)
+            return msg
+
+        msg = ''
+        dn = _cleanDN(f'{rdn},{base}')
+        attribute_list = _insertAttributes(attrs)
+
+        try:
+            await self.perform('add_ext', dn, attribute_list)
+        except asyncio.CancelledError:
+            raise
+        except ldap.INVALID_CREDENTIALS as e:
+            e_name = e.__class__.__name__
+            msg = f'{e_name} No permission to insert "{dn}"'
+        except ldap.ALREADY_EXISTS as e:
+            e_name = e.__class__.__name__
+            msg = f'{e_name} Record with dn "{dn}" already exists'
+        except Exception as e:
+            e_name = e.__class__.__name__
+            msg = f'{e_name} LDAPDelegate.insert: {e}'
+
+        if msg != '':
+            logger.info(msg, exc_info=1)
+
+        return msg
+
+    async def delete(self, dn):
+        """ Coroutine version of ``LDAPDelegate.delete`` """
+        if self.read_only:
+            msg = 'Running in read-only mode, deletion is disabled'
+            logger.info(msg)
+            return msg
+
+        msg = ''
+        dn = _cleanDN(dn)
+
+        try:
+            await self.perform('delete_ext', dn)
+        except asyncio.CancelledError:
+            raise
+        except ldap.INVALID_CREDENTIALS:
+            msg = f'No permission to delete "{dn}"'
+        except Exception as e:
+            msg = f'LDAPDelegate.delete: {e}'
+
+        if msg != '':
+            logger.info(msg, exc_info=1)
+
+        return msg
+
+    async def modify(self, dn, mod_type=None, attrs=None):
+        """ Coroutine version of ``LDAPDelegate.modify`` """
+        if self.read_only:
+            msg = 'Running in read-only mode, modification is disabled'
+            logger.info(msg)
+            return msg
+
+        clean_dn = _cleanDN(dn)
+        res = await self.search(clean_dn, ldap.SCOPE_BASE)
+        attrs = attrs and attrs or {}
+
+        if res['exception']:
+            return res['exception']
+
+        if res['size'] == 0:
+            return f'LDAPDelegate.modify: Cannot find dn "{dn}"'
+
+        cur_rec = res['results'][0]
+        mod_list = _modifyList(cur_rec, mod_type, attrs)
+        msg = ''
+
+        try:
+            target_dn = clean_dn
+            new_rdn = _newRdn(cur_rec, attrs, self.rdn_attr)
+            if new_rdn:
+                await self.perform('rename', target_dn, new_rdn)
+                old_dn_exploded = ldap.explode_dn(target_dn)
+                old_dn_exploded[0] = new_rdn
+                target_dn = ','.join(old_dn_exploded)
+
+            if mod_list:
+                await self.perform('modify_ext', target_dn, mod_list)
+            else:
+                debug_msg = 'Nothing to modify: %s' % target_dn
+                logger.debug('LDAPDelegate.modify: %s' % debug_msg)
+
+        except asyncio.CancelledError:
+            raise
+
+        except ldap.INVALID_CREDENTIALS as e:
+            e_name = e.__class__.__name__
+            msg = f'{e_name} No permission to modify "{dn}"'
+
+        except Exception as e:
+            e_name = e.__class__.__name__
+            msg = f'{e_name} LDAPDelegate.modify: {str(e)}'
+
+        if msg != '':
+            logger.info(msg, exc_info=1)
+
+        return msg
+
+    async def perform(self, method, *args):
+        """ Send a request on a shared channel and wait for its result
+
+        Like ``_perform`` the request is retried once on a new connection
+        if the connection turns out to be gone. A referral is followed
+        on a channel to the referral target, kept in a separate registry
+        limited like the pool for referral connections.
+        """
+        for attempt in range(2):
+            channel = await self.getChannel(fresh=attempt > 0)
+
+            try:
+                return await self.callChannel(channel, method, *args)
+            except (ldap.SERVER_DOWN, ldap.UNAVAILABLE):
+                if attempt > 0:
+                    raise
+                logger.debug('perform: Connection lost, retrying',
+                             exc_info=1)
+            except ldap.REFERRAL as e:
+                conn_str = _getReferralTarget(e)
+                self.counters.increment('referral_hops')
+                server = {'conn_timeout': 5, 'op_timeout': -1}
+                channel = await self.openChannel(
+                    self.referrals, (conn_str, 'referral', self.identity),
+                    server)
+                return await self.callChannel(channel, method, *args)
+
+    async def callChannel(self, channel, method, *args):
+        """ Send a request on ``channel`` and record the server health """
+        start = time.monotonic()
+
+        try:
+            result = await channel.call(method, *args)
+        except (ldap.SERVER_DOWN, ldap.UNAVAILABLE, ldap.TIMEOUT,
+                ldap.CONNECT_ERROR):
+            self.dropChannel(channel)
+            self.health.recordFailure(channel.key[0])
+            raise
+
+        self.health.recordSuccess(channel.key[0], time.monotonic() - start)
+
+        return result
+
+    async def getChannel(self, fresh=False):
+        """ Get a channel to the first usable server
+
+        Servers are tried in the order chosen by the server selection
+        strategy, like in ``_checkout``.
+        """
+        exc = None
+
+        for conn_string, server in self.servers():
+            try:
+                return await self.openChannel(
+                    self.channels, (conn_string, self.identity), server,
+                    fresh=fresh)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE) as e:
+                self.health.recordFailure(conn_string)
+                exc = e
+            except (ldap.INVALID_CREDENTIALS,
+                    ldap.UNWILLING_TO_PERFORM) as e:
+                exc = e
+
+        if exc is not None:
+            raise exc
+
+        raise ldap.SERVER_DOWN('Cannot connect to LDAP server')
+
+    async def openChannel(self, channels, key, server, fresh=False):
+        """ Get the channel for ``key`` from ``channels``
+
+        The channel belongs to the running event loop. A new connection
+        is opened in a thread if there is no usable channel yet or if
+        ``fresh`` is True.
+        """
+        loop = asyncio.get_running_loop()
+        task = channels.get(loop, key)
+
+        if task is not None and not fresh:
+            try:
+                channel = await asyncio.shield(task)
+                if channel.healthy:
+                    return channel
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Another operation failed opening it, try again below
+                pass
+
+        user_dn, user_pwd = self.credentials
+        connect = functools.partial(_openConnection, key[0], user_dn,
+                                    user_pwd,
+                                    conn_timeout=server['conn_timeout'],
+                                    op_timeout=server['op_timeout'])
+
+        async def opener():
+            connection = await loop.run_in_executor(None, connect)
+            channel = Channel(key, connection, loop, server['op_timeout'])
+            channel.registry = channels
+            channel.task = task
+            return channel
+
+        task = loop.create_task(opener())
+        channels.set(loop, key, task)
+
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            channels.discard(loop, key, task)
+            raise
+
+    def dropChannel(self, channel):
+        """ Close a failed channel so it is not used again """
+        channel.registry.discard(channel.loop, channel.key, channel.task)
+        channel.close()
+
+
+class EventLoopThread:
+    """ An event loop running in a daemon thread
+
+    The synchronous methods of the ``AsyncLDAPDelegate`` run their
+    coroutines in this loop and wait for the result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+
+    def run(self, coroutine, timeout=None):
+        """ Run ``coroutine`` in the event loop and return its result
+
+        If there is no result after ``timeout`` seconds the coroutine is
+        cancelled and ``ldap.TIMEOUT`` is raised.
+        """
+        loop = self.start()
+
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError('Cannot wait for the event loop from '
+                               'within the event loop')
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ldap.TIMEOUT(f'No result after {timeout} seconds')
+
+    def start(self):
+        """ Start the loop thread if needed and return the loop """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever,
+                    name='LDAPDelegate event loop', daemon=True)
+                self._thread.start()
+                _loop_threads.add(self)
+
+            return self._loop
+
+    def stop(self, timeout=5):
+        """ Stop the event loop and wait for the thread to finish """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+
+        if thread is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+            if not thread.is_alive():
+                loop.close()
+
+        _loop_threads.discard(self)
+
+    def isRunning(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+
+def stopAllEventLoops():
+    """ Stop all running event loop threads """
+    for loop_thread in list(_loop_threads):
+        loop_thread.stop()
+
+
+atexit.register(stopAllEventLoops)
+
+
+class AsyncLDAPDelegate(LDAPDelegate):
+    """ AsyncLDAPDelegate
+
+    A LDAP delegate for applications built on asyncio. The coroutines
+    ``search_async``, ``search_many_async``, ``insert_async``,
+    ``modify_async`` and ``delete_async`` return the same results as
+    the methods of the same name without the suffix on the standard
+    delegate. They never block the event loop while waiting for the
+    server, so a single thread can run many directory operations
+    concurrently.
+
+    Within an event loop operations share one connection per server
+    and bind identity, requests are multiplexed over it by message ID.
+    Only opening and binding a new connection runs in a thread. The
+    number of these connections per event loop is limited by the
+    connection pool settings, see ``ChannelRegistry``.
+
+    The synchronous ``search``, ``search_many``, ``insert``, ``modify``
+    and ``delete`` methods used by the user folder run the coroutines
+    in an event loop thread kept for each delegate and process and wait
+    at most as long as the server timeouts allow. The coroutines only
+    get an ``AsyncOperations`` object with copies of the settings they
+    need, never the persistent delegate. All other methods, like
+    ``iter_search`` and ``verify_credentials``, are inherited from the
+    standard delegate.
+    """
+
+    # Coroutines
+
+    async def search_async(self, base, scope, filter='(objectClass=*)',
+                           attrs=[], bind_dn='', bind_pwd=''):
+        """ Coroutine version of ``search`` """
+        operations = self._getOperations(bind_dn, bind_pwd)
+        return await operations.search(base, scope, filter, attrs)
+
+    async def search_many_async(self, queries, bind_dn='', bind_pwd=''):
+        """ Coroutine version of ``search_many`` """
+        operations = self._getOperations(bind_dn, bind_pwd)
+        return await operations.searchMany(queries)
+
+    async def insert_async(self, base, rdn, attrs=None):
+        """ Coroutine version of ``insert`` """
+        return await self._getOperations().insert(base, rdn, attrs)
+
+    async def delete_async(self, dn):
+        """ Coroutine version of ``delete`` """
+        return await self._getOperations().delete(dn)
+
+    async def modify_async(self, dn, mod_type=None, attrs=None):
+        """ Coroutine version of ``modify`` """
+        return await self._getOperations().modify(dn, mod_type, attrs)
+
+    # Synchronous facade, the event loop thread only gets the operations
+    # object created here and never the delegate itself
+
+    def search(self, base, scope, filter='(objectClass=*)', attrs=[],
+               bind_dn='', bind_pwd=''):
+        """ The main search engine """
+        operations = self._getOperations(bind_dn, bind_pwd)
+        return self._runSync(operations.search(base, scope, filter, attrs),
+                             operations.getTimeout())
+
+    def search_many(self, queries, bind_dn='', bind_pwd=''):
+        """ Run several independent searches at once """
+        operations = self._getOperations(bind_dn, bind_pwd)
+        return self._runSync(operations.searchMany(queries),
+                             operations.getTimeout())
+
+    def insert(self, base, rdn, attrs=None):
+        """ Insert a new record """
+        operations = self._getOperations()
+        return self._runSync(operations.insert(base, rdn, attrs),
+                             operations.getTimeout())
+
+    def delete(self, dn):
+        """ Delete a record """
+        operations = self._getOperations()
+        return self._runSync(operations.delete(dn), operations.getTimeout())
+
+    def modify(self, dn, mod_type=None, attrs=None):
+        """ Modify a record """
+        operations = self._getOperations()
+        # Reading the record, renaming and modifying it
+        return self._runSync(operations.modify(dn, mod_type, attrs),
+                             operations.getTimeout(requests=3))
+
+    def _getOperations(self, bind_dn='', bind_pwd=''):
+        """ Copy everything an operation needs from the delegate
+
+        The bind credentials are found here because they may depend on
+        the security context of the calling thread.
+        """
+        return AsyncOperations(self._getBindCredentials(bind_dn, bind_pwd),
+                               self._serverCandidates(), self.read_only,
+                               self.rdn_attr, self._getHealth(),
+                               self._getCounters(), self._getChannels(),
+                               self._getChannels('referral'))
+
+    def _getEventLoop(self):
+        """ Get the process-wide event loop thread for this delegate """
+        return getResource(f'{self._hash}-eventloop', EventLoopThread, ())
+
+    def _runSync(self, coroutine, timeout=None):
+        """ Run a coroutine in the event loop thread and wait for it """
+        return self._getEventLoop().run(coroutine, timeout)
+
+    def _getChannels(self, kind='server'):
+        """ Get a process-wide channel registry for this delegate
+
+        Channels to the configured servers are limited like the
+        connection pools, channels to referral targets like the pool for
+        referral connections.
+        """
+        channels = getResource(f'{self._hash}-{kind}channels',
+                               ChannelRegistry, ())
+        if kind == 'referral':
+            channels.max_size = self.referral_pool_size
+            channels.idle_timeout = self.referral_idle_timeout
+        else:
+            channels.max_size = self.pool_size
+            channels.idle_timeout = self.pool_idle_timeout
+
+        return channels
+
+    def _clearPools(self):
+        """ Close all pooled connections and channels """
+        LDAPDelegate._clearPools(self)
+        self._getChannels().clear()
+        self._getChannels('referral').clear()
+
+
+# Register this delegate class with the delegate registry
+registerDelegate('Asynchronous LDAP delegate', AsyncLDAPDelegate,
+                 'A LDAP delegate with asyncio coroutines for all operations')
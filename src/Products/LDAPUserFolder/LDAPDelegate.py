@@ -13,11 +13,15 @@
 """ LDAPDelegate: A delegate that performs LDAP operations
 """
 
+import itertools
 import logging
 import random
+import time
+from hashlib import sha1
 
 import ldap
 import ldap.filter
+from ldap.controls import SimplePagedResultsControl
 from ldap.dn import escape_dn_chars
 from ldapurl import LDAPUrl
 from ldapurl import isLDAPUrl
@@ -26,9 +30,18 @@ from AccessControl.SecurityManagement import getSecurityManager
 from Persistence import Persistent
 
 from .cache import getResource
-from .cache import removeResource
 from .LDAPUser import LDAPUser
+from .pool import ConnectionPool
+from .pool import Counters
+from .pool import PoolExhaustedError
+from .pool import race
+from .servers import HealthMonitor
+from .servers import HealthRegistry
+from .servers import allowedServers
+from .servers import getSelectionStrategy
+from .servers import registeredSelectionStrategies
 from .utils import BINARY_ATTRIBUTES
+from .utils import INVALID_CREDENTIALS_MESSAGE
 from .utils import registerDelegate
 from .utils import to_utf8
 
@@ -39,6 +52,221 @@ except AttributeError:
     c_factory = ldap.ldapobject.SimpleLDAPObject
 logger = logging.getLogger('event.LDAPDelegate')
 
+# All connection pools of a delegate, see LDAPDelegate._getPool
+POOL_KINDS = ('manager', 'user', 'auth', 'referral')
+
+
+def _openConnection(connection_string, user_dn, user_pwd, conn_timeout=5,
+                    op_timeout=-1):
+    """ Open a new raw connection and bind if credentials are given """
+    connection = c_factory(connection_string)
+
+    # Set the protocol version - version 3 is preferred
+    try:
+        connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
+    except ldap.LDAPError:  # Invalid protocol version, fall back safely
+        connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION2)
+
+    # Deny auto-chasing of referrals to be safe, we handle them instead
+    try:
+        connection.set_option(ldap.OPT_REFERRALS, 0)
+    except ldap.LDAPError:  # Cannot set referrals, so do nothing
+        pass
+
+    # Set the connection timeout
+    if conn_timeout > 0:
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, conn_timeout)
+
+    # Set the operations timeout
+    if op_timeout > 0:
+        connection.timeout = op_timeout
+
+    # Now bind with the credentials given. Let exceptions propagate out.
+    # Don't bind if no credentials are provided.
+    if user_dn and user_pwd:
+        connection.simple_bind_s(user_dn, user_pwd)
+
+    return connection
+
+
+def probeServer(connection_string, conn_timeout=5, op_timeout=-1,
+                bind_dn='', bind_pwd=''):
+    """ Check if a server is reachable by binding and reading the root DSE
+
+    Raises an exception if the server cannot be reached. Refused
+    credentials or access to the root DSE still mean the server works.
+    """
+    connection = _openConnection(connection_string, '', '',
+                                 conn_timeout=conn_timeout,
+                                 op_timeout=op_timeout)
+    try:
+        if bind_dn and bind_pwd:
+            try:
+                connection.simple_bind_s(bind_dn, bind_pwd)
+            except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+                logger.warning(f'probeServer: Bind as {bind_dn} refused '
+                               f'by {connection_string}')
+
+        try:
+            connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)')
+        except (ldap.NO_SUCH_OBJECT, ldap.INSUFFICIENT_ACCESS):
+            pass
+    finally:
+        try:
+            connection.unbind_s()
+        except Exception:
+            pass
+
+
+def _cleanRdn(rdn):
+    """ Escape all characters that need escaping for a DN, see RFC 2253 """
+    if rdn.find('\\') != -1:
+        # already escaped, disregard
+        return rdn
+
+    try:
+        key, val = rdn.split('=')
+        val = val.lstrip()
+        return f'{key}={escape_dn_chars(val)}'
+    except ValueError:
+        return rdn
+
+
+def _cleanDN(dn):
+    """ Escape all characters that need escaping for a DN, see RFC 2253 """
+    return ','.join(_cleanRdn(x) for x in ldap.explode_dn(dn))
+
+
+def _getReferralTarget(exception):
+    """ Get the connection string for the target of a referral """
+    payload = exception.args[0]
+    info = payload.get('info')
+    ldap_url = info[info.find('ldap'):]
+
+    if not isLDAPUrl(ldap_url):
+        raise ldap.CONNECT_ERROR(f'Bad referral "{exception}"')
+
+    return LDAPUrl(ldap_url).initializeUrl()
+
+
+def _searchErrorMessage(exc, base, filter):
+    """ Log a search error and return a message describing it """
+    if isinstance(exc, ldap.INVALID_CREDENTIALS):
+        msg = INVALID_CREDENTIALS_MESSAGE
+        logger.debug(msg, exc_info=exc)
+
+    elif isinstance(exc, ldap.NO_SUCH_OBJECT):
+        msg = f'Cannot find {filter} under {base}'
+        logger.debug(msg, exc_info=exc)
+
+    elif isinstance(exc, (ldap.SIZELIMIT_EXCEEDED,
+                          ldap.ADMINLIMIT_EXCEEDED)):
+        msg = 'Too many results for this query'
+        logger.warning(msg, exc_info=exc)
+
+    else:
+        msg = str(exc)
+        logger.error(msg, exc_info=exc)
+
+    return msg
+
+
+def _decodeEntry(rec_dn, rec_dict):
+    """ Decode a raw search result entry into a record mapping
+
+    Returns None for entries that are no records.
+    """
+    # When used against Active Directory, "rec_dict" may not be
+    # be a dictionary in some cases (instead, it can be a list)
+    # An example of a useless "res" entry that can be ignored
+    # from AD is
+    # (None, ['ldap://ForestDnsZones.PORTAL.LOCAL/\
+    # DC=ForestDnsZones,DC=PORTAL,DC=LOCAL'])
+    # This appears to be some sort of internal referral, but
+    # we can't handle it, so we need to skip over it.
+    try:
+        items = rec_dict.items()
+    except AttributeError:
+        # 'items' not found on rec_dict
+        return None
+
+    for key, value in items:
+        is_binary = key.lower() in BINARY_ATTRIBUTES
+
+        if not isinstance(value, str):
+            try:
+                for i in range(len(value)):
+                    if not is_binary and \
+                       isinstance(value[i], bytes):
+                        value[i] = value[i].decode('UTF-8')
+            except Exception:
+                pass
+
+    rec_dict['dn'] = rec_dn
+
+    return rec_dict
+
+
+def _insertAttributes(attrs):
+    """ Convert an attribute mapping into a list for adding a record """
+    attribute_list = []
+    attrs = attrs and attrs or {}
+
+    for attr_key, attr_val in attrs.items():
+        if attr_key.endswith(';binary'):
+            is_binary = True
+            attr_key = attr_key[:-7]
+        else:
+            is_binary = False
+
+        if not is_binary and isinstance(attr_val, (str, bytes)):
+            if isinstance(attr_val, str):
+                sep = ';'
+            else:
+                sep = b';'
+            attr_val = [x.strip() for x in attr_val.split(sep)]
+
+        if attr_val != ['']:
+            if not is_binary:
+                attr_val = list(map(to_utf8, attr_val))
+            attribute_list.append((attr_key, attr_val))
+
+    return attribute_list
+
+
+def _modifyList(cur_rec, mod_type, attrs):
+    """ Compute the modification list for changing a record """
+    mod_list = []
+
+    for key, values in attrs.items():
+
+        if key.endswith(';binary'):
+            key = key[:-7]
+        else:
+            values = list(map(to_utf8, values))
+
+        if mod_type is None:
+            if cur_rec.get(key, ['']) != values and values != ['']:
+                mod_list.append((ldap.MOD_REPLACE, key, values))
+            elif key in cur_rec and values == ['']:
+                mod_list.append((ldap.MOD_DELETE, key, None))
+        else:
+            mod_list.append((mod_type, key, values))
+
+    return mod_list
+
+
+def _newRdn(cur_rec, attrs, rdn_attr):
+    """ Get the new cleaned RDN if a modification renames a record
+
+    Returns an empty string if the RDN stays the same.
+    """
+    new_rdn = attrs.get(rdn_attr, [''])[0]
+    if new_rdn and new_rdn != cur_rec.get(rdn_attr)[0]:
+        return _cleanRdn(f'{rdn_attr}={new_rdn}')
+
+    return ''
+
 
 class LDAPDelegate(Persistent):
     """ LDAPDelegate
@@ -54,8 +282,52 @@ class LDAPDelegate(Persistent):
                   was raised.
 
     results     - Sequence of results
+
+    Connections are kept in a process-wide pool shared by all threads,
+    keyed by server and bind identity. A thread checks out a connection
+    for the duration of a single operation and hands it back afterwards.
+
+    The order in which servers are tried is determined by the server
+    selection strategy, see ``servers.registerSelectionStrategy``.
     """
 
+    # Connection pool settings, see ConnectionPool
+    pool_size = 10
+    pool_idle_timeout = 300
+
+    # Pooled connections idle for longer than this many seconds are
+    # checked with a search before they are reused
+    health_check_interval = 60
+
+    # Size of the separate pool used only for verifying passwords
+    auth_pool_size = 4
+
+    # Size and idle timeout of the pool for connections to referral
+    # targets, keyed by target and bind identity
+    referral_pool_size = 4
+    referral_idle_timeout = 60
+
+    # Name of the server selection strategy and relative server weights
+    # for the ``weighted`` strategy, keyed by connection string
+    server_selection = 'failover'
+    _server_weights = {}
+
+    # Circuit breaker: Skip a server for ``breaker_cooldown`` seconds
+    # after ``breaker_threshold`` consecutive failures, 0 disables it
+    breaker_threshold = 3
+    breaker_cooldown = 30
+
+    # Seconds between server probes by the background health monitor,
+    # 0 disables the monitor
+    health_monitor_interval = 0
+
+    # Number of records per page retrieved by iter_search
+    page_size = 500
+
+    # Seconds to wait for a new connection before racing an attempt to
+    # the next server against it, 0 tries servers one after the other
+    connect_stagger = 0
+
     def __setstate__(self, v):
         """
             __setstate__ is called whenever the instance is loaded
@@ -122,10 +394,10 @@ class LDAPDelegate(Persistent):
 
         self._servers = servers
 
-        # Delete the cached connection in case the new server was added
+        # Drop pooled connections in case the new server was added
         # in response to the existing server failing in a way that leads
         # to nasty timeouts
-        removeResource(f'{self._hash}-connection')
+        self._clearPools()
 
     def getServers(self):
         """ Return info about all my servers """
@@ -149,9 +421,125 @@ class LDAPDelegate(Persistent):
 
         self._servers = new_servers
 
-        # Delete the cached connection so that we don't accidentally
+        # Drop pooled connections so that we don't accidentally
         # continue using a server we should not be using anymore
-        removeResource(f'{self._hash}-connection')
+        self._clearPools()
+
+    def getServerSelection(self):
+        """ Return the name of the server selection strategy """
+        return self.server_selection
+
+    def getServerWeights(self):
+        """ Return a mapping of connection string to server weight """
+        weights = {}
+        for server in self.getServers():
+            conn_string = self._createConnectionString(server)
+            weights[conn_string] = self._server_weights.get(conn_string, 1)
+
+        return weights
+
+    def setServerSelection(self, strategy, weights=None):
+        """ Set the server selection strategy and optional server weights
+
+        ``weights`` is a mapping of connection string to a non-negative
+        integer weight for the ``weighted`` strategy.
+        """
+        if strategy not in registeredSelectionStrategies():
+            raise ValueError(f'Unknown server selection strategy {strategy}')
+
+        self.server_selection = strategy
+
+        if weights is not None:
+            self._server_weights = {key: max(int(value), 0)
+                                    for key, value in weights.items()}
+
+    def setConnectStagger(self, seconds):
+        """ Set the delay before racing the next server, 0 disables it """
+        self.connect_stagger = max(float(seconds), 0.0)
+
+    def setCircuitBreaker(self, threshold, cooldown):
+        """ Configure the circuit breaker, a threshold of 0 disables it """
+        self.breaker_threshold = max(int(threshold), 0)
+        self.breaker_cooldown = max(int(cooldown), 1)
+
+    def setHealthMonitor(self, interval):
+        """ Set the health monitor interval, 0 stops the monitor """
+        self.health_monitor_interval = max(int(interval), 0)
+        self._updateMonitor()
+
+    def isHealthMonitorRunning(self):
+        """ Is the background health monitor running in this process? """
+        return self._getMonitor().isRunning()
+
+    def getServerHealth(self):
+        """ Return health information for each configured server """
+        health = self._getHealth()
+
+        return [health.getInfo(self._createConnectionString(x))
+                for x in self.getServers()]
+
+    def _getHealth(self):
+        """ Get the process-wide health registry for this delegate """
+        health = getResource(f'{self._hash}-health', HealthRegistry, ())
+        health.threshold = self.breaker_threshold
+        health.cooldown = self.breaker_cooldown
+
+        return health
+
+    def _getMonitor(self):
+        """ Get the process-wide health monitor for this delegate """
+        return getResource(f'{self._hash}-monitor', HealthMonitor,
+                           (self._getHealth(),))
+
+    def _updateMonitor(self):
+        """ Start, reconfigure or stop the health monitor as needed
+
+        The monitor thread is started lazily the first time the delegate
+        is used in a process. It only gets copies of the server settings
+        and credentials, never the persistent delegate itself.
+        """
+        monitor = self._getMonitor()
+        interval = self.health_monitor_interval
+
+        if not interval:
+            if monitor.isRunning():
+                monitor.stop()
+            return
+
+        targets = []
+        for server in self.getServers():
+            options = (('conn_timeout', server['conn_timeout']),
+                       ('op_timeout', server['op_timeout']),
+                       ('bind_dn', self.bind_dn),
+                       ('bind_pwd', self.bind_pwd))
+            targets.append((self._createConnectionString(server), options))
+
+        if not monitor.isConfigured(probeServer, targets, interval):
+            monitor.configure(probeServer, targets, interval)
+        monitor.start()
+
+    def _orderedServers(self):
+        """ Yield (connection string, server) tuples in order of preference
+
+        Servers refused by their circuit breaker come last, see
+        ``servers.allowedServers``.
+        """
+        yield from allowedServers(self._serverCandidates(), self._getHealth())
+
+    def _serverCandidates(self):
+        """ List (connection string, server) tuples in order of preference
+
+        The circuit breakers are not asked yet. The server mappings are
+        copies, so the list may be used outside of the current thread.
+        """
+        strategy = getSelectionStrategy(self.server_selection)
+        health = self._getHealth()
+        if self.health_monitor_interval:
+            self._updateMonitor()
+        candidates = [(self._createConnectionString(x), dict(x))
+                      for x in self.getServers()]
+
+        return list(strategy(candidates, health, self._server_weights))
 
     def edit(self, login_attr, users_base, rdn_attr, objectclasses,
              bind_dn, bind_pwd, binduid_usage, read_only):
@@ -169,10 +557,24 @@ class LDAPDelegate(Persistent):
         self.u_classes = objectclasses
 
     def connect(self, bind_dn='', bind_pwd=''):
-        """ initialize an ldap server connection """
-        conn = None
-        conn_string = ''
+        """ initialize an ldap server connection
+
+        The connection is taken from the connection pool and handed back
+        right away, so it may be used by other threads as well. The
+        delegate's own operations check out connections for exclusive
+        use instead, see ``_perform``.
+        """
+        pooled = self._checkout(bind_dn=bind_dn, bind_pwd=bind_pwd)
 
+        if pooled is None:
+            return None
+
+        self._checkin(pooled)
+
+        return pooled.connection
+
+    def _getBindCredentials(self, bind_dn='', bind_pwd=''):
+        """ Find the DN and password to bind with """
         if bind_dn != '':
             user_dn = bind_dn
             user_pwd = bind_pwd or '~'
@@ -190,26 +592,100 @@ class LDAPDelegate(Persistent):
             else:
                 user_dn = user_pwd = ''
 
-        conn = getResource(f'{self._hash}-connection')
-        try:
-            conn.simple_bind_s(user_dn, user_pwd)
-            conn.search_s(self.u_base, self.BASE, '(objectClass=*)')
-            return conn
-        except (AttributeError, ldap.SERVER_DOWN, ldap.NO_SUCH_OBJECT,
-                ldap.TIMEOUT, ldap.INVALID_CREDENTIALS, ldap.UNAVAILABLE,
-                ldap.UNWILLING_TO_PERFORM):
-            pass
+        return user_dn, user_pwd
+
+    def _getPool(self, kind='manager'):
+        """ Get a process-wide connection pool for this delegate
+
+        Connections bound as the configured manager DN and connections
+        bound as any other identity are kept in separate pools of type
+        ``manager`` and ``user``, so they cannot evict each other. The
+        ``auth`` pool is used by ``verify_credentials`` only, the
+        ``referral`` pool holds connections to referral targets.
+        """
+        pool = getResource(f'{self._hash}-{kind}pool', ConnectionPool, ())
+        if kind == 'auth':
+            pool.max_size = self.auth_pool_size
+        elif kind == 'referral':
+            pool.max_size = self.referral_pool_size
+        else:
+            pool.max_size = self.pool_size
+
+        if kind == 'referral':
+            pool.idle_timeout = self.referral_idle_timeout
+        else:
+            pool.idle_timeout = self.pool_idle_timeout
 
+        return pool
+
+    def _clearPools(self):
+        """ Close all pooled connections """
+        for kind in POOL_KINDS:
+            self._getPool(kind).clear()
+
+    def _getCounters(self):
+        """ Get the process-wide event counters for this delegate """
+        return getResource(f'{self._hash}-counters', Counters, ())
+
+    def getConnectionStatistics(self):
+        """ Return connection pool usage figures and event counts
+
+        Returns a mapping with the statistics for each connection pool
+        under the key ``pools`` and event counters such as the number of
+        followed referrals, ``referral_hops``, under ``counters``.
+        """
+        return {'pools': {x: self._getPool(x).getStatistics()
+                          for x in POOL_KINDS},
+                'counters': self._getCounters().asDict()}
+
+    def _checkin(self, pooled):
+        """ Hand a connection back to the pool it was checked out from """
+        self._getPool(pooled.key[1]).checkin(pooled)
+
+    def _checkout(self, bind_dn='', bind_pwd='', fresh=False):
+        """ Check out a bound connection from the connection pool
+
+        Servers are tried in the order chosen by the server selection
+        strategy, servers refused by their circuit breaker last. Returns
+        None if no server could be tried and raises the last connection
+        error if all of them fail. The connection must be handed back with
+        ``_checkin`` after use. If ``fresh`` is True a new connection is
+        opened even if idle pooled connections exist.
+
+        Pooled connections remember the identity they are bound as, a
+        bind is only sent if that identity differs from the one needed.
+        """
+        user_dn, user_pwd = self._getBindCredentials(bind_dn, bind_pwd)
+        identity = (user_dn, sha1(to_utf8(user_pwd or '')).hexdigest())
+        if user_dn and user_dn == self.bind_dn:
+            kind = 'manager'
+        else:
+            kind = 'user'
+        pool = self._getPool(kind)
+        conn_string = ''
         exc = None
+        servers = self._orderedServers()
 
-        for server in self._servers:
-            conn_string = self._createConnectionString(server)
+        for conn_string, server in servers:
+            key = (conn_string, kind)
 
             try:
-                newconn = self._connect(conn_string, user_dn, user_pwd,
-                                        conn_timeout=server['conn_timeout'],
-                                        op_timeout=server['op_timeout'])
-                return newconn
+                if self.connect_stagger <= 0:
+                    return self._openPooled(pool, key, server, user_dn,
+                                            user_pwd, identity, fresh=fresh)
+
+                if not fresh:
+                    pooled = self._reuseIdle(pool, key, user_dn, user_pwd,
+                                             identity)
+                    if pooled is not None:
+                        return pooled
+
+                # Race this server against the remaining ones
+                pooled = self._raceConnect(pool, kind,
+                                           [(conn_string, server)], servers,
+                                           user_dn, user_pwd, identity)
+                if pooled is not None:
+                    return pooled
             except (ldap.SERVER_DOWN, ldap.TIMEOUT,  # NOQA: F841
                     ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM,
                     ldap.UNAVAILABLE) as e:
@@ -235,73 +711,292 @@ class LDAPDelegate(Persistent):
 
         return None
 
-    def handle_referral(self, exception):
-        """ Handle a referral specified in a exception """
-        payload = exception.args[0]
-        info = payload.get('info')
-        ldap_url = info[info.find('ldap'):]
+    def _prepareReused(self, pool, pooled, user_dn, user_pwd, identity):
+        """ Make a reused pooled connection ready for ``identity``
 
-        if isLDAPUrl(ldap_url):
-            conn_str = LDAPUrl(ldap_url).initializeUrl()
+        Returns None and discards the connection if it turns out to be
+        stale. A refused bind is raised after handing the connection back.
+        """
+        # Connections that were used recently are trusted, only
+        # those that sat idle for a while are probed first.
+        needs_probe = pooled.idleTime() > self.health_check_interval
 
-            if self.binduid_usage == 1:
-                user_dn = self.bind_dn
-                user_pwd = self.bind_pwd
-            else:
-                user = getSecurityManager().getUser()
+        try:
+            if pooled.bound_as != identity:
+                pooled.bound_as = None
+                pooled.connection.simple_bind_s(user_dn, user_pwd)
+                pooled.bound_as = identity
+            if needs_probe:
+                pooled.connection.search_s(self.u_base, self.BASE,
+                                           '(objectClass=*)')
+            return pooled
+        except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM):
+            # The bind was refused but the connection is usable
+            pool.checkin(pooled)
+            raise
+        except (AttributeError, ldap.SERVER_DOWN, ldap.NO_SUCH_OBJECT,
+                ldap.TIMEOUT, ldap.UNAVAILABLE):
+            # Stale pooled connection, throw it away
+            pooled.markFailed()
+            pool.checkin(pooled)
+
+        return None
+
+    def _reuseIdle(self, pool, key, user_dn, user_pwd, identity):
+        """ Get an idle pooled connection for ``key`` or None """
+        while True:
+            pooled = pool.checkoutIdle(key, prefer=identity)
+            if pooled is None:
+                return None
+
+            pooled = self._prepareReused(pool, pooled, user_dn, user_pwd,
+                                         identity)
+            if pooled is not None:
+                return pooled
+
+    def _openPooled(self, pool, key, server, user_dn, user_pwd, identity,
+                    fresh=False):
+        """ Check out a connection for ``key`` bound as ``identity``
+
+        Idle connections are reused unless ``fresh`` is True, otherwise
+        a new connection is opened.
+        """
+        conn_string = key[0]
+        conn_timeout = server['conn_timeout']
+        op_timeout = server['op_timeout']
+
+        def factory():
+            return self._connect(conn_string, user_dn, user_pwd,
+                                 conn_timeout=conn_timeout,
+                                 op_timeout=op_timeout)
+
+        while True:
+            try:
+                pooled = pool.checkout(key, factory, fresh=fresh,
+                                       prefer=identity)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE):
+                self._getHealth().recordFailure(conn_string)
+                raise
+
+            if pooled.uses == 1:
+                # Freshly created and bound by the factory
+                pooled.bound_as = identity
+                return pooled
+
+            pooled = self._prepareReused(pool, pooled, user_dn, user_pwd,
+                                         identity)
+            if pooled is not None:
+                return pooled
+
+    def _raceConnect(self, pool, kind, first, others, user_dn, user_pwd,
+                     identity):
+        """ Open connections to several servers in parallel
+
+        A connection attempt to the servers in ``first`` is started
+        right away, every ``connect_stagger`` seconds without a result
+        another attempt is started for the next server from the iterable
+        ``others``. The first connection to succeed is returned. Later
+        successful attempts are handed to the pool as idle connections.
+
+        The attempts run in separate threads, they only use the
+        module-level connection factory and no persistent objects.
+        """
+        health = self._getHealth()
+
+        def attempts():
+            for conn_string, server in itertools.chain(first, others):
+                conn_timeout = server['conn_timeout']
+                op_timeout = server['op_timeout']
+
+                def factory(conn_string=conn_string,
+                            conn_timeout=conn_timeout,
+                            op_timeout=op_timeout):
+                    return _openConnection(conn_string, user_dn, user_pwd,
+                                           conn_timeout=conn_timeout,
+                                           op_timeout=op_timeout)
+
+                def attempt(key=(conn_string, kind), factory=factory):
+                    try:
+                        pooled = pool.checkout(key, factory, fresh=True)
+                    except (ldap.SERVER_DOWN, ldap.TIMEOUT,
+                            ldap.UNAVAILABLE):
+                        health.recordFailure(key[0])
+                        raise
+                    pooled.bound_as = identity
+                    return pooled
+
+                yield attempt
+
+        return race(attempts(), self.connect_stagger, loser=pool.checkin)
+
+    def _perform(self, operation, bind_dn='', bind_pwd=''):
+        """ Run ``operation`` with a pooled connection and return its result
+
+        ``operation`` is called with the raw connection as its only
+        argument. Connections that fail with a network-level error are
+        thrown away instead of being handed back to the pool. If the
+        connection turns out to be gone the operation is retried once
+        on a newly opened connection.
+        """
+        def checkout(fresh):
+            return self._checkout(bind_dn=bind_dn, bind_pwd=bind_pwd,
+                                  fresh=fresh)
+
+        return self._performWith(checkout, operation)
+
+    def _performWith(self, checkout, operation):
+        """ Run ``operation`` on a connection obtained from ``checkout``
+
+        ``checkout`` is called with a flag telling whether a new
+        connection is needed, see ``_perform``.
+        """
+        for attempt in range(2):
+            pooled = checkout(attempt > 0)
+
+            if pooled is None:
+                raise ldap.SERVER_DOWN('Cannot connect to LDAP server')
+
+            health = self._getHealth()
+            start = time.monotonic()
+
+            try:
+                result = operation(pooled.connection)
+                health.recordSuccess(pooled.key[0],
+                                     time.monotonic() - start)
+                return result
+            except (ldap.SERVER_DOWN, ldap.UNAVAILABLE):
+                pooled.markFailed()
+                health.recordFailure(pooled.key[0])
+                if attempt > 0:
+                    raise
+                logger.debug('_perform: Connection lost, retrying',
+                             exc_info=1)
+            except (ldap.TIMEOUT, ldap.CONNECT_ERROR):
+                # Not retried, the server may have carried out the operation
+                pooled.markFailed()
+                health.recordFailure(pooled.key[0])
+                raise
+            finally:
+                self._checkin(pooled)
+
+    def verify_credentials(self, dn, password):
+        """ Find out if the given DN and password are valid
+
+        The credentials are checked by binding with them on a connection
+        from a small pool that is reserved for this purpose and never
+        used for reading from the directory. Returns True or False, or
+        None if no server could be asked.
+        """
+        if not dn or not password:
+            return False
+
+        pool = self._getPool('auth')
+        health = self._getHealth()
+        exc = None
+
+        for conn_string, server in self._orderedServers():
+
+            def factory(conn_string=conn_string, server=server):
+                return self._connect(conn_string, '', '',
+                                     conn_timeout=server['conn_timeout'],
+                                     op_timeout=server['op_timeout'])
+
+            for fresh in (False, True):
                 try:
-                    user_dn = user.getUserDN()
-                    user_pwd = user._getPassword()
-                except AttributeError:  # User object is not a LDAPUser
-                    user_dn = user_pwd = ''
+                    pooled = pool.checkout((conn_string, 'auth'), factory,
+                                           fresh=fresh)
+                except PoolExhaustedError as e:
+                    logger.warning(f'verify_credentials: {e}')
+                    return None
+                except (ldap.SERVER_DOWN, ldap.TIMEOUT,  # NOQA: F841
+                        ldap.UNAVAILABLE) as e:
+                    health.recordFailure(conn_string)
+                    exc = e
+                    break
 
-            return self._connect(conn_str, user_dn, user_pwd)
+                try:
+                    pooled.connection.simple_bind_s(dn, password)
+                    health.recordSuccess(conn_string)
+                    return True
+                except (ldap.INVALID_CREDENTIALS, ldap.UNWILLING_TO_PERFORM,
+                        ldap.NO_SUCH_OBJECT):
+                    health.recordSuccess(conn_string)
+                    return False
+                except (ldap.SERVER_DOWN, ldap.TIMEOUT,
+                        ldap.UNAVAILABLE) as e:
+                    pooled.markFailed()
+                    exc = e
+                    if pooled.uses == 1:
+                        # Not a stale pooled connection, the server failed
+                        health.recordFailure(conn_string)
+                        break
+                finally:
+                    pool.checkin(pooled)
+
+        logger.error(f'verify_credentials: Cannot verify "{dn}" ({exc})')
 
-        else:
-            raise ldap.CONNECT_ERROR(f'Bad referral "{exception}"')
+        return None
 
-    def _connect(self, connection_string, user_dn, user_pwd,
-                 conn_timeout=5, op_timeout=-1):
-        """ Factored out to allow usage by other pieces """
-        connection_strings = [self._createConnectionString(s)
-                              for s in self._servers]
-
-        # Connect to the server to get a raw connection object
-        # Only cache it if the connection string matches our
-        # configured connection strings. This excludes connections
-        # resulting from a ldap.REFERRAL exception
-        if connection_string in connection_strings:
-            connection = getResource(f'{self._hash}-connection',
-                                     c_factory, (connection_string,))
-        else:
-            connection = c_factory(connection_string)
+    def handle_referral(self, exception):
+        """ Handle a referral specified in a exception
 
-        # Set the protocol version - version 3 is preferred
-        try:
-            connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION3)
-        except ldap.LDAPError:  # Invalid protocol version, fall back safely
-            connection.set_option(ldap.OPT_PROTOCOL_VERSION, ldap.VERSION2)
+        Returns a connection to the referral target. Like the result of
+        ``connect`` the connection is kept in a connection pool and may
+        be shared with other threads.
+        """
+        conn_str = _getReferralTarget(exception)
+        self._getCounters().increment('referral_hops')
+        pooled = self._checkoutReferral(conn_str)
+        self._checkin(pooled)
 
-        # Deny auto-chasing of referrals to be safe, we handle them instead
-        try:
-            connection.set_option(ldap.OPT_REFERRALS, 0)
-        except ldap.LDAPError:  # Cannot set referrals, so do nothing
-            pass
+        return pooled.connection
 
-        # Set the connection timeout
-        if conn_timeout > 0:
-            connection.set_option(ldap.OPT_NETWORK_TIMEOUT, conn_timeout)
+    def _performReferral(self, exception, operation):
+        """ Run ``operation`` against the target of a referral
 
-        # Set the operations timeout
-        if op_timeout > 0:
-            connection.timeout = op_timeout
+        The connection is taken from the referral connection pool, which
+        is keyed by referral target and bind identity.
+        """
+        conn_str = _getReferralTarget(exception)
+        self._getCounters().increment('referral_hops')
 
-        # Now bind with the credentials given. Let exceptions propagate out.
-        # Don't bind if no credentials are provided.
-        if user_dn and user_pwd:
-            connection.simple_bind_s(user_dn, user_pwd)
+        def checkout(fresh):
+            return self._checkoutReferral(conn_str, fresh=fresh)
 
-        return connection
+        return self._performWith(checkout, operation)
+
+    def _checkoutReferral(self, conn_str, fresh=False):
+        """ Check out a pooled connection to a referral target """
+        if self.binduid_usage == 1:
+            user_dn = self.bind_dn
+            user_pwd = self.bind_pwd
+        else:
+            user = getSecurityManager().getUser()
+            try:
+                user_dn = user.getUserDN()
+                user_pwd = user._getPassword()
+            except AttributeError:  # User object is not a LDAPUser
+                user_dn = user_pwd = ''
+
+        identity = (user_dn, sha1(to_utf8(user_pwd or '')).hexdigest())
+
+        def factory():
+            return self._connect(conn_str, user_dn, user_pwd)
+
+        pooled = self._getPool('referral').checkout(
+            (conn_str, 'referral', identity), factory, fresh=fresh)
+        pooled.bound_as = identity
+
+        return pooled
+
+    def _connect(self, connection_string, user_dn, user_pwd,
+                 conn_timeout=5, op_timeout=-1):
+        """ Factored out to allow usage by other pieces """
+        # Connect to the server to get a new raw connection object.
+        # Reusing connections is left to the connection pool.
+        return _openConnection(connection_string, user_dn, user_pwd,
+                               conn_timeout=conn_timeout,
+                               op_timeout=op_timeout)
 
     def search(self, base, scope, filter='(objectClass=*)', attrs=[],
                bind_dn='', bind_pwd=''):
@@ -309,80 +1004,281 @@ class LDAPDelegate(Persistent):
         result = {'exception': '', 'size': 0, 'results': []}
         base = self._clean_dn(base)
 
-        try:
-            connection = self.connect(bind_dn=bind_dn, bind_pwd=bind_pwd)
-            if connection is None:
-                result['exception'] = 'Cannot connect to LDAP server'
-                return result
+        def _search(connection):
+            return self._searchAll(connection, base, scope, filter, attrs)
 
+        try:
             try:
-                res = connection.search_s(base, scope, filter, attrs)
-            except ldap.PARTIAL_RESULTS:
-                res_type, res = connection.result(all=0)
+                res = self._perform(_search, bind_dn=bind_dn,
+                                    bind_pwd=bind_pwd)
             except ldap.REFERRAL as e:
-                connection = self.handle_referral(e)
-
-                try:
-                    res = connection.search_s(base, scope, filter, attrs)
-                except ldap.PARTIAL_RESULTS:
-                    res_type, res = connection.result(all=0)
+                res = self._performReferral(e, _search)
 
             for rec_dn, rec_dict in res:
-                # When used against Active Directory, "rec_dict" may not be
-                # be a dictionary in some cases (instead, it can be a list)
-                # An example of a useless "res" entry that can be ignored
-                # from AD is
-                # (None, ['ldap://ForestDnsZones.PORTAL.LOCAL/\
-                # DC=ForestDnsZones,DC=PORTAL,DC=LOCAL'])
-                # This appears to be some sort of internal referral, but
-                # we can't handle it, so we need to skip over it.
-                try:
-                    items = rec_dict.items()
-                except AttributeError:
-                    # 'items' not found on rec_dict
-                    continue
+                rec_dict = _decodeEntry(rec_dn, rec_dict)
+
+                if rec_dict is not None:
+                    result['results'].append(rec_dict)
+                    result['size'] += 1
+
+        except (KeyboardInterrupt, SystemExit):
+            raise
+
+        except Exception as e:
+            result['exception'] = _searchErrorMessage(e, base, filter)
+
+        return result
 
-                for key, value in items:
-                    is_binary = key.lower() in BINARY_ATTRIBUTES
+    def search_many(self, queries, bind_dn='', bind_pwd=''):
+        """ Run several independent searches at once
 
-                    if not isinstance(value, str):
+        ``queries`` is a sequence of mappings with the keys ``base``,
+        ``scope`` and optionally ``filter`` and ``attrs``, which have the
+        same meaning as the ``search`` arguments of the same name. All
+        searches are sent over one connection before the first result is
+        read, so the total time approaches that of a single search.
+
+        Returns a list with one mapping per query, in the same order and
+        in the same format as the return value of ``search``.
+        """
+        prepared = [(self._clean_dn(x['base']), x['scope'],
+                     x.get('filter', '(objectClass=*)'), x.get('attrs', []))
+                    for x in queries]
+        results = [{'exception': '', 'size': 0, 'results': []}
+                   for x in prepared]
+
+        if not prepared:
+            return results
+
+        def _searchMany(connection):
+            # Message IDs of the searches whose results were not read yet
+            pending = {}
+            outcomes = [None] * len(prepared)
+
+            try:
+                if hasattr(connection, 'search_ext'):
+                    for i, query in enumerate(prepared):
                         try:
-                            for i in range(len(value)):
-                                if not is_binary and \
-                                   isinstance(value[i], bytes):
-                                    value[i] = value[i].decode('UTF-8')
-                        except Exception:
-                            pass
+                            pending[i] = connection.search_ext(*query)
+                        except (ldap.SERVER_DOWN, ldap.UNAVAILABLE,
+                                ldap.TIMEOUT, ldap.CONNECT_ERROR):
+                            raise
+                        except ldap.LDAPError as e:
+                            # Like a bad filter, only fails this search
+                            outcomes[i] = e
+
+                for i, query in enumerate(prepared):
+                    if outcomes[i] is not None:
+                        continue
+
+                    try:
+                        if i in pending:
+                            outcomes[i] = self._collectResults(connection,
+                                                               pending[i])
+                        else:
+                            # Connections without asynchronous search
+                            # support
+                            outcomes[i] = self._searchAll(connection, *query)
+                    except (ldap.SERVER_DOWN, ldap.UNAVAILABLE, ldap.TIMEOUT,
+                            ldap.CONNECT_ERROR):
+                        raise
+                    except ldap.LDAPError as e:
+                        outcomes[i] = e
+                    pending.pop(i, None)
+
+            except BaseException:
+                # The next user of the connection must not get the
+                # results of searches sent here
+                self._abandon(connection, pending.values())
+                raise
+
+            return outcomes
 
-                rec_dict['dn'] = rec_dn
+        try:
+            outcomes = self._perform(_searchMany, bind_dn=bind_dn,
+                                     bind_pwd=bind_pwd)
+        except Exception as e:
+            outcomes = [e] * len(prepared)
 
-                result['results'].append(rec_dict)
-                result['size'] += 1
+        for query, outcome, result in zip(prepared, outcomes, results):
+            try:
+                if isinstance(outcome, ldap.REFERRAL):
+                    outcome = self._performReferral(
+                        outcome,
+                        lambda conn, query=query: self._searchAll(conn,
+                                                                  *query))
 
-        except ldap.INVALID_CREDENTIALS:
-            msg = 'Invalid authentication credentials'
-            logger.debug(msg, exc_info=1)
-            result['exception'] = msg
+                if isinstance(outcome, Exception):
+                    raise outcome
 
-        except ldap.NO_SUCH_OBJECT:
-            msg = f'Cannot find {filter} under {base}'
-            logger.debug(msg, exc_info=1)
-            result['exception'] = msg
+                for rec_dn, rec_dict in outcome:
+                    rec_dict = _decodeEntry(rec_dn, rec_dict)
 
-        except (ldap.SIZELIMIT_EXCEEDED, ldap.ADMINLIMIT_EXCEEDED):
-            msg = 'Too many results for this query'
-            logger.warning(msg, exc_info=1)
-            result['exception'] = msg
+                    if rec_dict is not None:
+                        result['results'].append(rec_dict)
+                        result['size'] += 1
 
-        except (KeyboardInterrupt, SystemExit):
+            except Exception as e:
+                result['exception'] = _searchErrorMessage(e, query[0],
+                                                          query[2])
+
+        return results
+
+    def iter_search(self, base, scope, filter='(objectClass=*)', attrs=[],
+                    bind_dn='', bind_pwd='', page_size=None,
+                    allow_partial=True):
+        """ Search and yield the matching records one by one
+
+        Records are mappings like the items in the ``results`` list
+        returned by ``search``. They are retrieved in pages of
+        ``page_size`` records using the simple paged results control
+        (RFC 2696), ``page_size`` defaults to the ``page_size`` attribute.
+        A page size of 0 retrieves all records in one go. Callers may
+        stop iterating at any time, the paged search is then abandoned.
+
+        Servers refusing the paged results control are asked for all
+        records in one go.
+
+        Unlike ``search`` errors are not caught but raised to the caller.
+        Searches without paging return the records received so far when
+        the server reports partial results, unless ``allow_partial`` is
+        false. ldap.PARTIAL_RESULTS is raised in that case.
+        """
+        if page_size is None:
+            page_size = self.page_size
+        base = self._clean_dn(base)
+
+        pooled = self._checkout(bind_dn=bind_dn, bind_pwd=bind_pwd)
+        if pooled is None:
+            raise ldap.SERVER_DOWN('Cannot connect to LDAP server')
+
+        connection = pooled.connection
+        control = None
+        cookie = None
+
+        try:
+            # Connections without extended search support, like those
+            # of some test stand-ins, get all results at once
+            if page_size and hasattr(connection, 'search_ext'):
+                control = SimplePagedResultsControl(True, size=page_size,
+                                                    cookie='')
+
+            try:
+                try:
+                    if control is None:
+                        pages = [self._searchAll(connection, base, scope,
+                                                 filter, attrs,
+                                                 allow_partial)]
+                    else:
+                        pages = self._searchPages(connection, base, scope,
+                                                  filter, attrs, control)
+                        # Fetch the first page before yielding anything,
+                        # so that a referral can still be followed
+                        pages = itertools.chain([next(pages)], pages)
+                except (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                        ldap.UNWILLING_TO_PERFORM):
+                    if control is None:
+                        raise
+                    # The server does not support paged results
+                    logger.debug('iter_search: Paging refused, retrieving '
+                                 'all records at once', exc_info=1)
+                    control = None
+                    pages = [self._searchAll(connection, base, scope, filter,
+                                             attrs, allow_partial)]
+            except StopIteration:
+                pages = []
+            except ldap.REFERRAL as e:
+                def _search(conn):
+                    return self._searchAll(conn, base, scope, filter, attrs,
+                                           allow_partial)
+                pages = [self._performReferral(e, _search)]
+
+            for page in pages:
+                cookie = control and control.cookie
+                for rec_dn, rec_dict in page:
+                    rec_dict = _decodeEntry(rec_dn, rec_dict)
+                    if rec_dict is not None:
+                        yield rec_dict
+            cookie = None
+
+        except (ldap.SERVER_DOWN, ldap.UNAVAILABLE, ldap.TIMEOUT,
+                ldap.CONNECT_ERROR):
+            pooled.markFailed()
+            self._getHealth().recordFailure(pooled.key[0])
             raise
 
-        except Exception as e:
-            msg = str(e)
-            logger.error(msg, exc_info=1)
-            result['exception'] = msg
+        finally:
+            if cookie and pooled.healthy:
+                # Stopped early, tell the server to release the results
+                try:
+                    control.size = 0
+                    connection.search_ext_s(base, scope, filter, attrs,
+                                            serverctrls=[control])
+                except ldap.LDAPError:
+                    pooled.markFailed()
+            self._checkin(pooled)
+
+    def _searchAll(self, connection, base, scope, filter, attrs,
+                   allow_partial=True):
+        """ Run a search and return all raw results at once """
+        try:
+            return connection.search_s(base, scope, filter, attrs)
+        except ldap.PARTIAL_RESULTS:
+            if not allow_partial:
+                raise
+            res_type, res = connection.result(all=0)
+            return res
+
+    def _collectResults(self, connection, msgid):
+        """ Read all raw results of the asynchronous search ``msgid``
+
+        Like ``_searchAll`` the results received so far are returned if
+        the server reports partial results.
+        """
+        results = []
 
-        return result
+        while True:
+            try:
+                rtype, rdata, rmsgid, rctrls = connection.result3(msgid,
+                                                                  all=0)
+            except ldap.PARTIAL_RESULTS:
+                return results
+
+            results.extend(rdata or [])
+
+            if rtype not in (ldap.RES_SEARCH_ENTRY,
+                             ldap.RES_SEARCH_REFERENCE):
+                return results
+
+    def _abandon(self, connection, msgids):
+        """ Tell the server to drop outstanding requests, ignoring errors """
+        for msgid in msgids:
+            try:
+                connection.abandon_ext(msgid)
+            except ldap.LDAPError:
+                # The connection is broken and will not be reused
+                logger.debug('_abandon: Cannot abandon request', exc_info=1)
+
+    def _searchPages(self, connection, base, scope, filter, attrs, control):
+        """ Yield pages of raw results of a paged search
+
+        After each page ``control.cookie`` holds the cookie for the next
+        page, it is empty after the last page.
+        """
+        while True:
+            msgid = connection.search_ext(base, scope, filter, attrs,
+                                          serverctrls=[control])
+            rtype, rdata, rmsgid, serverctrls = connection.result3(msgid)
+
+            control.cookie = ''
+            for ctrl in serverctrls:
+                if ctrl.controlType == SimplePagedResultsControl.controlType:
+                    control.cookie = ctrl.cookie
+
+            yield rdata
+
+            if not control.cookie:
+                break
 
     def insert(self, base, rdn, attrs=None):
         """ Insert a new record """
@@ -394,31 +1290,10 @@ class LDAPDelegate(Persistent):
         msg = ''
 
         dn = self._clean_dn(f'{rdn},{base}')
-        attribute_list = []
-        attrs = attrs and attrs or {}
-
-        for attr_key, attr_val in attrs.items():
-            if attr_key.endswith(';binary'):
-                is_binary = True
-                attr_key = attr_key[:-7]
-            else:
-                is_binary = False
-
-            if not is_binary and isinstance(attr_val, (str, bytes)):
-                if isinstance(attr_val, str):
-                    sep = ';'
-                else:
-                    sep = b';'
-                attr_val = [x.strip() for x in attr_val.split(sep)]
-
-            if attr_val != ['']:
-                if not is_binary:
-                    attr_val = list(map(to_utf8, attr_val))
-                attribute_list.append((attr_key, attr_val))
+        attribute_list = _insertAttributes(attrs)
 
         try:
-            connection = self.connect()
-            connection.add_s(dn, attribute_list)
+            self._perform(lambda conn: conn.add_s(dn, attribute_list))
         except ldap.INVALID_CREDENTIALS as e:
             e_name = e.__class__.__name__
             msg = f'{e_name} No permission to insert "{dn}"'
@@ -427,8 +1302,8 @@ class LDAPDelegate(Persistent):
             msg = f'{e_name} Record with dn "{dn}" already exists'
         except ldap.REFERRAL as e:
             try:
-                connection = self.handle_referral(e)
-                connection.add_s(dn, attribute_list)
+                self._performReferral(
+                    e, lambda conn: conn.add_s(dn, attribute_list))
             except ldap.INVALID_CREDENTIALS:
                 e_name = e.__class__.__name__
                 msg = f'{e_name} No permission to insert "{dn}"'
@@ -455,14 +1330,12 @@ class LDAPDelegate(Persistent):
         dn = self._clean_dn(dn)
 
         try:
-            connection = self.connect()
-            connection.delete_s(dn)
+            self._perform(lambda conn: conn.delete_s(dn))
         except ldap.INVALID_CREDENTIALS:
             msg = f'No permission to delete "{dn}"'
         except ldap.REFERRAL as e:
             try:
-                connection = self.handle_referral(e)
-                connection.delete_s(dn)
+                self._performReferral(e, lambda conn: conn.delete_s(dn))
             except ldap.INVALID_CREDENTIALS:
                 msg = f'No permission to delete "{dn}"' % dn
             except Exception as e:
@@ -493,50 +1366,35 @@ class LDAPDelegate(Persistent):
             return f'LDAPDelegate.modify: Cannot find dn "{dn}"'
 
         cur_rec = res['results'][0]
-        mod_list = []
+        mod_list = _modifyList(cur_rec, mod_type, attrs)
         msg = ''
 
-        for key, values in attrs.items():
-
-            if key.endswith(';binary'):
-                key = key[:-7]
-            else:
-                values = list(map(to_utf8, values))
-
-            if mod_type is None:
-                if cur_rec.get(key, ['']) != values and values != ['']:
-                    mod_list.append((self.REPLACE, key, values))
-                elif key in cur_rec and values == ['']:
-                    mod_list.append((self.DELETE, key, None))
-            else:
-                mod_list.append((mod_type, key, values))
-
-        try:
-            connection = self.connect()
-
-            new_rdn = attrs.get(self.rdn_attr, [''])[0]
-            if new_rdn and new_rdn != cur_rec.get(self.rdn_attr)[0]:
-                raw_rdn = f'{self.rdn_attr}={new_rdn}'
-                new_rdn = self._clean_rdn(raw_rdn)
-                connection.modrdn_s(clean_dn, new_rdn)
-                old_dn_exploded = self.explode_dn(clean_dn)
+        def _modify(connection):
+            target_dn = clean_dn
+            new_rdn = _newRdn(cur_rec, attrs, self.rdn_attr)
+            if new_rdn:
+                connection.modrdn_s(target_dn, new_rdn)
+                old_dn_exploded = self.explode_dn(target_dn)
                 old_dn_exploded[0] = new_rdn
-                clean_dn = ','.join(old_dn_exploded)
+                target_dn = ','.join(old_dn_exploded)
 
             if mod_list:
-                connection.modify_s(clean_dn, mod_list)
+                connection.modify_s(target_dn, mod_list)
             else:
-                debug_msg = 'Nothing to modify: %s' % clean_dn
+                debug_msg = 'Nothing to modify: %s' % target_dn
                 logger.debug('LDAPDelegate.modify: %s' % debug_msg)
 
+        try:
+            self._perform(_modify)
+
         except ldap.INVALID_CREDENTIALS as e:
             e_name = e.__class__.__name__
             msg = f'{e_name} No permission to modify "{dn}"'
 
         except ldap.REFERRAL as e:
             try:
-                connection = self.handle_referral(e)
-                connection.modify_s(dn, mod_list)
+                self._performReferral(
+                    e, lambda conn: conn.modify_s(dn, mod_list))
             except ldap.INVALID_CREDENTIALS as e:
                 e_name = e.__class__.__name__
                 msg = f'{e_name} No permission to modify "{dn}"'
@@ -565,22 +1423,11 @@ class LDAPDelegate(Persistent):
 
     def _clean_rdn(self, rdn):
         """ Escape all characters that need escaping for a DN, see RFC 2253 """
-        if rdn.find('\\') != -1:
-            # already escaped, disregard
-            return rdn
-
-        try:
-            key, val = rdn.split('=')
-            val = val.lstrip()
-            return f'{key}={escape_dn_chars(val)}'
-        except ValueError:
-            return rdn
+        return _cleanRdn(rdn)
 
     def _clean_dn(self, dn):
         """ Escape all characters that need escaping for a DN, see RFC 2253 """
-        elems = [self._clean_rdn(x) for x in self.explode_dn(dn)]
-
-        return ','.join(elems)
+        return _cleanDN(dn)
 
     def explode_dn(self, dn, notypes=0):
         """ Indirection to avoid need for importing ldap elsewhere """
@@ -28,10 +28,10 @@ class NonexistingUser:
     """Fake user we can use in our negative cache."""
 
     def __init__(self):
-        self.birth = DateTime()
+        self.birth = time.time()
 
     def getCreationTime(self):
-        return self.birth
+        return DateTime(self.birth)
 
     def _getPassword(self):
         return None
@@ -93,6 +93,11 @@ class LDAPUser(BasicUser):
         """ Retrieve the password """
         return self.__
 
+    @security.private
+    def _setPassword(self, password):
+        """ Replace the password """
+        self.__ = password
+
     @security.public
     def getUserName(self):
         """ Get the name associated with this user """
@@ -13,6 +13,8 @@
 """ The LDAPUserFolder class
 """
 
+import functools
+import json
 import logging
 import os
 import random
@@ -20,6 +22,7 @@ import time
 import urllib
 from hashlib import sha1
 
+import transaction
 from AccessControl import ClassSecurityInfo
 from AccessControl.class_init import InitializeClass
 from AccessControl.Permissions import manage_users
@@ -30,21 +33,29 @@ from Acquisition import aq_base
 from App.Common import package_home
 from App.special_dtml import DTMLFile
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 from OFS.SimpleItem import SimpleItem
 from OFS.userfolder import BasicUserFolder
 from zope.interface import implementer
 from ZPublisher.HTTPRequest import default_encoding
 
-from dataflake.cache.simple import SimpleCache
-
-from .cache import UserCache
+from .cache import RefreshQueue
+from .cache import SingleFlight
+from .cache import getCacheBackend
 from .cache import getResource
+from .cache import registeredCacheBackends
+from .groupindex import GroupIndex
+from .groupindex import getGroupType
 from .interfaces import ILDAPUserFolder
+from .invalidation import InvalidationLog
 from .LDAPUser import LDAPUser
 from .LDAPUser import NonexistingUser
 from .permissions import change_ldapuserfolder
+from .servers import registeredSelectionStrategies
 from .utils import GROUP_MEMBER_ATTRIBUTES
 from .utils import GROUP_MEMBER_MAP
+from .utils import INVALID_CREDENTIALS_MESSAGE
+from .utils import MATCHING_RULE_IN_CHAIN
 from .utils import VALID_GROUP_ATTRIBUTES
 from .utils import _createDelegate
 from .utils import _createLDAPPassword
@@ -53,6 +64,7 @@ from .utils import guid2string
 
 
 logger = logging.getLogger('event.LDAPUserFolder')
+CACHE_TYPES = ('authenticated', 'anonymous', 'negative', 'groups', 'misc')
 _marker = []
 _dtmldir = os.path.join(package_home(globals()), 'dtml')
 
@@ -76,6 +88,12 @@ class LDAPUserFolder(BasicUserFolder):
     zmi_icon = 'fas fa-users-cog'
     zmi_show_add_dialog = False
 
+    # Group settings for instances created before they existed
+    _group_resolution = 'search'
+    _group_attribute = 'memberOf'
+    _group_nesting = 0
+    _group_nesting_in_chain = False
+
     #################################################################
     #
     # Setting up all ZMI management screens and default login pages
@@ -121,6 +139,7 @@ class LDAPUserFolder(BasicUserFolder):
         """ Create a new LDAPUserFolder instance """
         self._hash = f'{self.meta_type}{str(random.random())}'
         self._delegate = _createDelegate(delegate_type)
+        self._invalidations = InvalidationLog()
         self._ldapschema = {'cn': {'ldap_name': 'cn',
                                    'friendly_name': 'Canonical Name',
                                    'multivalued': False,
@@ -134,10 +153,12 @@ class LDAPUserFolder(BasicUserFolder):
 
         # Local DN to role tree for storing roles
         self._groups_store = OOBTree()
-        # List of additionally known roles
-        self._additional_groups = []
+        # Reverse index of _groups_store, role to a set of user DNs
+        self._groups_members = OOBTree()
+        # Set of additionally known roles
+        self._additional_groups = OOTreeSet()
         # Place to store mappings from LDAP group to Zope role
-        self._groups_mappings = {}
+        self._groups_mappings = OOBTree()
 
         # Caching-related
         self._anonymous_timeout = 600
@@ -162,18 +183,87 @@ class LDAPUserFolder(BasicUserFolder):
         self._pwd_encryption = 'SHA'
         self.read_only = False
         self._extra_user_filter = ''
+        self._group_resolution = 'search'
+        self._group_attribute = 'memberOf'
+        self._group_nesting = 0
+        self._group_nesting_in_chain = False
 
     def _clearCaches(self):
-        """ Clear all logs and caches for user-related information """
+        """ Clear all logs and caches for user-related information
+
+        The caches of other ZEO clients are cleared as well when they
+        notice the change, see ``_applyInvalidations``.
+        """
+        self._clearLocalCaches()
+        self._invalidationLog().invalidateAll()
+
+    def _clearLocalCaches(self):
+        """ Clear the caches of the current process """
         self._cache('anonymous').invalidate()
         self._cache('authenticated').invalidate()
         self._cache('negative').invalidate()
+        self._cache('groups').invalidate()
         self._misc_cache().invalidate()
 
-    def _lookupuserbyattr(self, name, value, pwd=None):
+    def _invalidationLog(self):
+        """ Get the persistent cache invalidation log
+
+        Instances created before the log existed get it the first time
+        something is invalidated.
+        """
+        log = getattr(aq_base(self), '_invalidations', None)
+
+        if log is None:
+            log = self._invalidations = InvalidationLog()
+
+        return log
+
+    def _applyInvalidations(self):
+        """ Drop cache entries invalidated by any ZEO client
+
+        The generation and serial of the invalidation log applied by this
+        process are compared with the stored ones. If they differ, the
+        users expired meanwhile are removed from the caches, or all
+        caches are cleared if needed. Caches shared by several processes
+        are only updated by the first process to notice the change.
+        """
+        log = getattr(aq_base(self), '_invalidations', None)
+        if log is None:
+            return
+
+        state = log.getState()
+        applied = getResource(f'{self._hash}-invalidations', dict, ())
+        previous = applied.get('state', (0, 0))
+        if previous == state:
+            return
+
+        # Record first, clearing the caches below runs through here again
+        applied['state'] = state
+
+        # Caches shared by several processes are only cleared once
+        config = self.getCacheBackend()
+        backend = getCacheBackend(config['name'], config['location'])
+        previous = backend.claimInvalidations(f'{self._hash}-invalidations',
+                                              state, previous)
+        if previous is None:
+            return
+
+        changes = log.getChanges(previous)
+
+        if changes is None:
+            logger.debug('_applyInvalidations: Clearing all caches')
+            self._clearLocalCaches()
+        else:
+            for user in changes:
+                self._expireLocalUser(user)
+
+    def _lookupuserbyattr(self, name, value, pwd=None, errors=None):
         """
             returns a record's DN and the groups a uid belongs to
             as well as a dictionary containing user attributes
+
+            If a list is passed as ``errors`` messages about errors that
+            prevented finding the user are appended to it.
         """
         users_base = self.users_base
 
@@ -216,6 +306,10 @@ class LDAPUserFolder(BasicUserFolder):
         logger.debug('_lookupuserbyattr: Using filter "%s"' % search_str)
 
         known_attrs = list(self.getSchemaConfig().keys())
+        group_attr = self._getGroupAttribute()
+
+        if group_attr is not None and group_attr not in known_attrs:
+            known_attrs.append(group_attr)
 
         res = self._delegate.search(base=users_base, scope=self.users_scope,
                                     filter=search_str, attrs=known_attrs,
@@ -225,33 +319,34 @@ class LDAPUserFolder(BasicUserFolder):
             msg = '_lookupuserbyattr: No user "%s=%s" (%s)' % (
                 name, value, res['exception'] or 'n/a')
             logger.debug(msg)
+            if res['exception'] and errors is not None:
+                errors.append(res['exception'])
             return None, None, None, None
 
         user_attrs = res['results'][0]
         dn = user_attrs.get('dn')
 
-        if pwd is not None:
+        if pwd is not None and self._binduid_usage == 1:
+            # Step 2: Verify the password passed in for the DN we looked
+            #         up in Step 1. Since LDAP passwords are one-way
+            #         encoded I must ask the LDAP server to verify the
+            #         password, I cannot do it myself. The attributes
+            #         read in Step 1 as Manager are kept.
+            user_pwd = self._bindpwd
+
+            verified = self._delegate.verify_credentials(dn, pwd)
+            if not verified:
+                msg = '_lookupuserbyattr: Binding as "%s" fails' % dn
+                logger.debug(msg)
+                if verified is None and errors is not None:
+                    errors.append('Cannot verify credentials')
+                return None, None, None, None
+
+        elif pwd is not None:
             # Step 2: Re-bind using the password passed in and the DN we
             #         looked up in Step 1. This will catch bad passwords.
-            if self._binduid_usage != 1:
-                user_dn = dn
-                user_pwd = pwd
-            else:
-                user_dn = self._binduid
-                user_pwd = self._bindpwd
-
-                # Even though I am going to use the Manager DN and password
-                # for the "final" lookup I *must* ensure that the password
-                # is not a bad password. Since LDAP passwords
-                # are one-way encoded I must ask the LDAP server to verify
-                # the password, I cannot do it myself.
-                try:
-                    self._delegate.connect(bind_dn=dn, bind_pwd=pwd)
-                except Exception:
-                    # Something went wrong, most likely bad credentials
-                    msg = '_lookupuserbyattr: Binding as "%s" fails' % dn
-                    logger.debug(msg)
-                    return None, None, None, None
+            user_dn = dn
+            user_pwd = pwd
 
             logger.debug('_lookupuserbyattr: Re-binding as "%s"' % user_dn)
 
@@ -265,6 +360,9 @@ class LDAPUserFolder(BasicUserFolder):
             if auth_res['size'] == 0 or auth_res['exception']:
                 logger.debug(f'_lookupuserbyattr: "{dn}" lookup fails bound'
                              f' as "{user_dn}"')
+                if auth_res['exception'] and errors is not None and \
+                   auth_res['exception'] != INVALID_CREDENTIALS_MESSAGE:
+                    errors.append(auth_res['exception'])
                 return None, None, None, None
 
             user_attrs = auth_res['results'][0]
@@ -274,7 +372,25 @@ class LDAPUserFolder(BasicUserFolder):
 
         logger.debug('_lookupuserbyattr: user_attrs %s' % str(user_attrs))
 
-        groups = list(self.getGroups(dn=dn, attr='cn', pwd=user_pwd))
+        if group_attr is not None:
+            # The user record lists the groups, no need to search them
+            group_records = self._groupsFromEntry(user_attrs, group_attr)
+            self._cache('groups').set(dn, (dn, group_records))
+
+            if group_attr not in self.getSchemaConfig():
+                user_attrs = {k: v for k, v in user_attrs.items()
+                              if k.lower() != group_attr.lower()}
+        elif self._getNestingDepth() > 0:
+            group_records = [x for x in self.getGroups(dn=dn, pwd=user_pwd)
+                             if x[0]]
+        else:
+            group_records = None
+
+        if group_records is None:
+            groups = list(self.getGroups(dn=dn, attr='cn', pwd=user_pwd))
+        else:
+            group_records = self._getNestedGroups(dn, group_records)
+            groups = [x[0] for x in group_records]
         roles = self._mapRoles(groups)
         roles.extend(self._roles)
 
@@ -300,6 +416,22 @@ class LDAPUserFolder(BasicUserFolder):
 
         setattr(self, prop_name, prop_value)
 
+    @security.protected(change_ldapuserfolder)
+    def manage_upgrade(self, REQUEST=None):
+        """ Convert data stored by older versions to the current format
+
+        Data left in an old format is otherwise converted the first time
+        it is changed.
+        """
+        self._storedLocalGroupMembers()
+        self._additionalGroups()
+        self._groupMappings()
+        logger.info('manage_upgrade: Converted stored data')
+
+        if REQUEST:
+            msg = 'Stored data converted'
+            return self.manage_main(manage_tabs_message=msg)
+
     @security.protected(change_ldapuserfolder)
     def manage_changeProperty(self, prop_name, prop_value,
                               client_form='manage_main', REQUEST=None):
@@ -321,7 +453,9 @@ class LDAPUserFolder(BasicUserFolder):
                     binduid, bindpwd, binduid_usage=1, rdn_attr='cn',
                     obj_classes='top,person', local_groups=0,
                     implicit_mapping=0, encryption='SHA', read_only=0,
-                    extra_user_filter='', REQUEST=None):
+                    extra_user_filter='', group_resolution='search',
+                    group_attribute='memberOf', group_nesting=0,
+                    group_nesting_in_chain=0, REQUEST=None):
         """ Edit the LDAPUserFolder Object """
         if not binduid:
             binduid_usage = 0
@@ -387,6 +521,13 @@ class LDAPUserFolder(BasicUserFolder):
 
         self._extra_user_filter = extra_user_filter.strip()
 
+        if group_resolution not in ('search', 'attribute'):
+            group_resolution = 'search'
+        self._group_resolution = group_resolution
+        self._group_attribute = group_attribute.strip() or 'memberOf'
+        self._group_nesting = max(int(group_nesting or 0), 0)
+        self._group_nesting_in_chain = not not group_nesting_in_chain
+
         self._clearCaches()
         msg = 'Properties changed'
 
@@ -425,6 +566,120 @@ class LDAPUserFolder(BasicUserFolder):
         if REQUEST:
             return self.manage_servers(manage_tabs_message=msg)
 
+    @security.protected(manage_users)
+    def getServerSelection(self):
+        """ Return the name of the server selection strategy in use """
+        return self._delegate.getServerSelection()
+
+    @security.protected(manage_users)
+    def getServerSelectionStrategies(self):
+        """ Return the available server selection strategies for the ZMI """
+        strategies = registeredSelectionStrategies()
+
+        return [{'name': x['name'], 'description': x['description']}
+                for x in strategies.values()]
+
+    @security.protected(manage_users)
+    def getConnectStagger(self):
+        """ Return the parallel connection delay in milliseconds """
+        return int(self._delegate.connect_stagger * 1000)
+
+    @security.protected(manage_users)
+    def getServerStatus(self):
+        """ Return server definitions with weight and health information
+        """
+        weights = self._delegate.getServerWeights()
+        status = []
+
+        for server, health in zip(self._delegate.getServers(),
+                                  self._delegate.getServerHealth()):
+            info = dict(server)
+            info.update(health)
+            info['weight'] = weights.get(health['uri'], 1)
+            if health['latency'] is None:
+                info['latency_ms'] = 'n/a'
+            else:
+                info['latency_ms'] = '%.1f' % (health['latency'] * 1000)
+            if health['last_probe'] is None:
+                info['last_probe_str'] = 'never'
+            else:
+                info['last_probe_str'] = time.strftime(
+                    '%Y-%m-%d %H:%M:%S', time.localtime(health['last_probe']))
+            status.append(info)
+
+        return status
+
+    @security.protected(manage_users)
+    def manage_setServerSelection(self, strategy, weights=None,
+                                  connect_stagger=None, REQUEST=None):
+        """ Change the server selection strategy and the server weights
+
+        ``weights`` is a sequence of integer weights in the order of
+        the configured servers. ``connect_stagger`` is the delay in
+        milliseconds before a connection attempt to the next server is
+        started in parallel, 0 disables parallel connection attempts.
+        """
+        weight_map = None
+        if weights is not None:
+            uris = self._delegate.getServerWeights().keys()
+            weight_map = dict(zip(uris, [int(x) for x in weights]))
+
+        try:
+            self._delegate.setServerSelection(strategy, weight_map)
+            msg = 'Server selection changed'
+        except ValueError as e:
+            msg = str(e)
+
+        if connect_stagger is not None:
+            self._delegate.setConnectStagger(int(connect_stagger) / 1000.0)
+
+        if REQUEST:
+            return self.manage_servers(manage_tabs_message=msg)
+
+    @security.protected(manage_users)
+    def getCircuitBreaker(self):
+        """ Return the circuit breaker settings for the ZMI """
+        return {'threshold': self._delegate.breaker_threshold,
+                'cooldown': self._delegate.breaker_cooldown}
+
+    @security.protected(manage_users)
+    def manage_setCircuitBreaker(self, threshold, cooldown, REQUEST=None):
+        """ Change the circuit breaker failure threshold and cool-down """
+        self._delegate.setCircuitBreaker(threshold, cooldown)
+        msg = 'Circuit breaker settings changed'
+
+        if REQUEST:
+            return self.manage_servers(manage_tabs_message=msg)
+
+    @security.protected(manage_users)
+    def getConnectionStatistics(self):
+        """ Return connection pool statistics for the ZMI """
+        stats = self._delegate.getConnectionStatistics()
+        pools = []
+
+        for kind, pool_stats in sorted(stats['pools'].items()):
+            info = dict(pool_stats)
+            info['kind'] = kind
+            pools.append(info)
+
+        return {'pools': pools,
+                'referral_hops': stats['counters'].get('referral_hops', 0)}
+
+    @security.protected(manage_users)
+    def getHealthMonitor(self):
+        """ Return the health monitor settings and state for the ZMI """
+        return {'interval': self._delegate.health_monitor_interval,
+                'running': self._delegate.isHealthMonitorRunning()}
+
+    @security.protected(manage_users)
+    def manage_setHealthMonitor(self, interval, REQUEST=None):
+        """ Change the health monitor interval, 0 disables the monitor """
+        self._delegate.setHealthMonitor(interval)
+        msg = 'Health monitor settings changed'
+
+        if REQUEST:
+            return self.manage_servers(manage_tabs_message=msg)
+
     @security.protected(manage_users)
     def getMappedUserAttrs(self):
         """ Return the mapped user attributes """
@@ -469,42 +724,50 @@ class LDAPUserFolder(BasicUserFolder):
         """
         result_dict = {}
         [result_dict.__setitem__(x, []) for x in attrnames]
+        size = 0
+        exception = ''
 
-        res = self._delegate.search(base=base_dn, scope=scope,
-                                    attrs=attrnames, filter=filter_str)
-
-        if res['size'] == 0 or res['exception']:
+        # Records are retrieved page by page and only the requested
+        # values are kept, so this works for very large directories
+        try:
+            for record in self._delegate.iter_search(base=base_dn,
+                                                     scope=scope,
+                                                     filter=filter_str,
+                                                     attrs=attrnames):
+                size += 1
+                for attrname in attrnames:
+                    if attrname == 'dn':
+                        result = record.get(attrname)
+                    else:
+                        result = record.get(attrname, [])
+                        if len(result) == 0:
+                            result = ''
+                        elif len(result) > 0:
+                            result = result[0]
+                    result_dict[attrname].append(result)
+        except Exception as e:
+            exception = str(e) or e.__class__.__name__
+            size = 0
+            [result_dict.__setitem__(x, []) for x in attrnames]
+
+        if size == 0:
             msg = ('getAttributesOfAllObjects: Cannot find any users (%s)'
-                   % res['exception'])
+                   % exception)
             logger.error(msg)
 
-            return result_dict
-
-        result_dicts = res['results']
-
-        for attrname in attrnames:
-            result_dict[attrname] = s = []
-            for i in range(res['size']):
-
-                if attrname == 'dn':
-                    s.append(result_dicts[i].get(attrname))
-
-                else:
-                    result = result_dicts[i].get(attrname, [])
-                    if len(result) == 0:
-                        result = ''
-                    elif len(result) > 0:
-                        result = result[0]
-                    s.append(result)
-
         return result_dict
 
     @security.protected(manage_users)
     def getUserIds(self):
         """ Return a tuple containing all user IDs """
-        expires = self._misc_cache().get('useridlistexpires')
-        if expires and expires > time.time():
-            return self._misc_cache().get('useridlist')
+        return self._singleFlight().do(('misc', 'useridlist'),
+                                       self._getUserIds)
+
+    def _getUserIds(self):
+        """ Get the user IDs from the misc cache or from LDAP """
+        cached = self._misc_cache().get('useridlist')
+        if cached is not None:
+            return cached
 
         user_filter = self._getUserFilterString()
 
@@ -513,18 +776,21 @@ class LDAPUserFolder(BasicUserFolder):
             user_filter, (self._uid_attr,)).get(self._uid_attr))
 
         self._misc_cache().set('useridlist', useridlist[:])
-        # Expire after 600 secs
-        self._misc_cache().set('useridlistexpires', time.time() + 600)
 
         return tuple(useridlist)
 
     @security.protected(manage_users)
     def getUserNames(self):
         """ Return a tuple containing all logins """
+        return self._singleFlight().do(('misc', 'loginlist'),
+                                       self._getUserNames)
+
+    def _getUserNames(self):
+        """ Get the logins from the misc cache or from LDAP """
         loginlist = []
-        expires = self._misc_cache().get('loginlistexpires')
-        if expires and expires > time.time():
-            return self._misc_cache().get('loginlist')
+        cached = self._misc_cache().get('loginlist')
+        if cached is not None:
+            return cached
 
         user_filter = self._getUserFilterString()
 
@@ -544,17 +810,20 @@ class LDAPUserFolder(BasicUserFolder):
         loginlist = sorted(loginlistinfo[self._login_attr])
 
         self._misc_cache().set('loginlist', loginlist[:])
-        # Expire after 600 secs
-        self._misc_cache().set('loginlistexpires', time.time() + 600)
 
         return tuple(loginlist)
 
     @security.protected(manage_users)
     def getUserIdsAndNames(self):
         """ Return a tuple of (user ID, login) tuples """
-        expires = self._misc_cache().get('useridnamelistexpires')
-        if expires and expires > time.time():
-            return self._misc_cache().get('useridnamelist')
+        return self._singleFlight().do(('misc', 'useridnamelist'),
+                                       self._getUserIdsAndNames)
+
+    def _getUserIdsAndNames(self):
+        """ Get user IDs and logins from the misc cache or from LDAP """
+        cached = self._misc_cache().get('useridnamelist')
+        if cached is not None:
+            return cached
 
         user_filter = self._getUserFilterString()
 
@@ -566,8 +835,6 @@ class LDAPUserFolder(BasicUserFolder):
                                    d.get(self._login_attr)))
 
         self._misc_cache().set('useridnamelist', login_id_list)
-        # Expire after 600 secs
-        self._misc_cache().set('useridnamelistexpires', time.time() + 600)
 
         return tuple(login_id_list)
 
@@ -624,18 +891,52 @@ class LDAPUserFolder(BasicUserFolder):
                 logger.debug(msg)
                 return cached_user
 
+            stale_user = self._cache(cache_type).getStale(value, pwd)
+
+            if stale_user and self._refreshLater(name, value, pwd):
+                msg = f'getUserByAttr: "{value}" stale in {cache_type} cache'
+                logger.debug(msg)
+                return stale_user
+
+        # Concurrent lookups of the same user share one LDAP lookup
+        flight_key = ('user', name, value.lower(),
+                      sha1((pwd or '').encode()).hexdigest())
+
+        return self._singleFlight().do(flight_key, self._fetchUser, name,
+                                       value, pwd, cache)
+
+    def _fetchUser(self, name, value, pwd=None, cache=0):
+        """ Look up a user in LDAP and update the user caches """
+        user_obj = self._makeUser(name, value, pwd)
+
+        if user_obj is None:
+            negative_cache_key = '{}:{}:{}'.format(
+                name, value, sha1((pwd or '').encode()).hexdigest())
+            self._cache('negative').set(negative_cache_key, NonexistingUser())
+            return None
+
+        if cache:
+            cache_type = pwd and 'authenticated' or 'anonymous'
+            self._cache(cache_type).set(value, user_obj)
+
+        return user_obj
+
+    def _makeUser(self, name, value, pwd=None, errors=None):
+        """ Look up a user in LDAP and create a user object
+
+        Returns None if there is no usable user record. See
+        ``_lookupuserbyattr`` for ``errors``.
+        """
         user_roles, user_dn, user_attrs, ldap_groups = self._lookupuserbyattr(
-            name=name, value=value, pwd=pwd)
+            name=name, value=value, pwd=pwd, errors=errors)
 
         if user_dn is None:
             logger.debug(f'getUserByAttr: "{name}={value}" not found')
-            self._cache('negative').set(negative_cache_key, NonexistingUser())
             return None
 
         if user_attrs is None:
             msg = f'getUserByAttr: "{name}={value}" has no properties, bailing'
             logger.debug(msg)
-            self._cache('negative').set(negative_cache_key, NonexistingUser())
             return None
 
         if user_roles is None or user_roles == self._roles:
@@ -656,7 +957,6 @@ class LDAPUserFolder(BasicUserFolder):
             msg = 'getUserByAttr: "%s" has no "%s" (Login) value!' % (
                 user_dn, self._login_attr)
             logger.debug(msg)
-            self._cache('negative').set(negative_cache_key, NonexistingUser())
             return None
 
         if self._uid_attr != 'dn' and len(uid) > 0:
@@ -665,19 +965,58 @@ class LDAPUserFolder(BasicUserFolder):
             msg = 'getUserByAttr: "%s" has no "%s" (UID Attribute) value!' % (
                 user_dn, self._uid_attr)
             logger.debug(msg)
-            self._cache('negative').set(negative_cache_key, NonexistingUser())
             return None
 
-        user_obj = LDAPUser(uid, login_name, pwd or 'undef', user_roles or [],
-                            [], user_dn, user_attrs, self.getMappedUserAttrs(),
-                            self.getMultivaluedUserAttrs(),
-                            self.getBinaryUserAttrs(),
-                            ldap_groups=ldap_groups)
+        return LDAPUser(uid, login_name, pwd or 'undef', user_roles or [],
+                        [], user_dn, user_attrs, self.getMappedUserAttrs(),
+                        self.getMultivaluedUserAttrs(),
+                        self.getBinaryUserAttrs(),
+                        ldap_groups=ldap_groups)
 
-        if cache:
-            self._cache(cache_type).set(value, user_obj)
+    def _refreshLater(self, name, value, pwd=None):
+        """ Refresh a stale cached user in the background
 
-        return user_obj
+        Returns False if the refresh cannot be queued right now. The
+        background thread runs without the security context of the
+        request, so users are only refreshed there if the Manager DN is
+        always used for binding. Otherwise the refreshed entry could be
+        read with different credentials than the entry it replaces.
+        """
+        if self._delegate.binduid_usage != 1:
+            return False
+
+        key = (name, value.lower(), sha1((pwd or '').encode()).hexdigest())
+
+        return self._getRefreshQueue().submit(
+            key, self._refreshJob(name, value, pwd))
+
+    def _refreshJob(self, name, value, pwd=None):
+        """ Create the background job refreshing a cached user """
+        return functools.partial(_refreshCachedUser, self.getPhysicalPath(),
+                                 name, value, pwd)
+
+    def _refreshCachedUser(self, name, value, pwd=None):
+        """ Look up a user with a stale cache entry again
+
+        The new user object replaces the cache entry. If the user cannot
+        be found anymore the entry is removed. After LDAP errors the stale
+        entry is kept and served until its grace period is over.
+        """
+        cache = self._cache(pwd and 'authenticated' or 'anonymous')
+        errors = []
+        user_obj = self._makeUser(name, value, pwd, errors=errors)
+
+        if user_obj is not None:
+            cache.set(value, user_obj)
+        elif errors:
+            logger.warning(f'_refreshCachedUser: Cannot refresh "{value}", '
+                           f'keeping stale entry ({errors[0]})')
+        else:
+            cache.invalidate(value)
+
+    def _getRefreshQueue(self):
+        """ Get the process-wide queue for background cache refreshes """
+        return getResource(f'{self._hash}-refreshqueue', RefreshQueue, ())
 
     @security.protected(manage_users)
     def getUser(self, name, pwd=None):
@@ -704,19 +1043,27 @@ class LDAPUserFolder(BasicUserFolder):
 
         res = self._delegate.search(base=user_dn, scope=self._delegate.BASE,
                                     attrs=[uid_attr])
+        user_id = self._userIdFromResult(res)
 
-        if res['exception'] or res['size'] == 0:
+        if user_id is None:
             return None
 
-        if uid_attr != 'dn':
-            user_id = res['results'][0].get(uid_attr)[0]
-        else:
-            user_id = res['results'][0].get(uid_attr)
-
         user = self.getUserByAttr(uid_attr, user_id, cache=1)
 
         return user
 
+    def _userIdFromResult(self, res):
+        """ Get the user ID from a search result for a user record """
+        uid_attr = self._uid_attr
+
+        if res['exception'] or res['size'] == 0:
+            return None
+
+        if uid_attr != 'dn':
+            return res['results'][0].get(uid_attr)[0]
+
+        return res['results'][0].get(uid_attr)
+
     def authenticate(self, name, password, request):
         superuser = self._emergency_user
 
@@ -780,7 +1127,18 @@ class LDAPUserFolder(BasicUserFolder):
         result = ()
         cn = urllib.parse.unquote(encoded_cn)
 
-        if not self._local_groups:
+        index = self._groupIndex()
+
+        if index is not None:
+            record = index.getGroupByCN(cn)
+
+            if record is not None:
+                result = sorted((k, v) for k, v in record.items()
+                                if k.lower() != 'objectclass')
+            else:
+                logger.debug('getGroupDetails: No group "%s"' % cn)
+
+        elif not self._local_groups:
             fltr = self._delegate.filter_format('(cn=%s)', (cn,))
             res = self._delegate.search(base=self.groups_base,
                                         scope=self.groups_scope,
@@ -807,12 +1165,7 @@ class LDAPUserFolder(BasicUserFolder):
                     break
 
             if g_dn:
-                users = []
-
-                for user_dn, role_dns in self._groups_store.items():
-                    if g_dn in role_dns:
-                        users.append(user_dn)
-
+                users = list(self._localGroupMembers().get(g_dn, ()))
                 result = [('', users)]
 
         return result
@@ -835,9 +1188,19 @@ class LDAPUserFolder(BasicUserFolder):
                     for dn in vals:
                         all_dns[dn] = 1
 
-        for dn in all_dns.keys():
+        # Resolve all member DNs to user IDs with a single batch of searches
+        uid_attr = self._uid_attr
+        dns = list(all_dns.keys())
+        queries = [{'base': dn, 'scope': self._delegate.BASE,
+                    'attrs': [uid_attr]} for dn in dns]
+
+        for dn, res in zip(dns, self._delegate.search_many(queries)):
             try:
-                user = self.getUserByDN(dn)
+                user_id = self._userIdFromResult(res)
+                if user_id is None:
+                    user = None
+                else:
+                    user = self.getUserByAttr(uid_attr, user_id, cache=1)
             except Exception:
                 user = None
 
@@ -846,6 +1209,67 @@ class LDAPUserFolder(BasicUserFolder):
 
         return tuple(users)
 
+    def _localGroupMembers(self):
+        """ Get the index of user DNs by role for locally stored groups
+
+        Folders created before the index existed get a temporary index
+        built from the group store, so that reading never writes to the
+        ZODB. The index is stored by ``manage_upgrade`` or the next time
+        the local groups are changed.
+        """
+        members = getattr(aq_base(self), '_groups_members', None)
+
+        if members is None:
+            members = self._buildLocalGroupMembers()
+
+        return members
+
+    def _storedLocalGroupMembers(self):
+        """ Get the stored index of user DNs by role, storing it if needed
+        """
+        members = getattr(aq_base(self), '_groups_members', None)
+
+        if members is None:
+            members = self._groups_members = self._buildLocalGroupMembers()
+
+        return members
+
+    def _buildLocalGroupMembers(self):
+        """ Build the index of user DNs by role from the group store """
+        members = OOBTree()
+
+        for user_dn, role_dns in self._groups_store.items():
+            for role in role_dns:
+                if role not in members:
+                    members[role] = OOTreeSet()
+                members[role].insert(user_dn)
+
+        return members
+
+    def _setLocalGroups(self, user_dn, role_dns):
+        """ Store the roles of a user in the local group store """
+        members = self._storedLocalGroupMembers()
+        old_roles = self._groups_store.get(user_dn) or []
+
+        # Empty sets are kept. Deleting them could lose members added
+        # by concurrent transactions when conflicts are resolved.
+        for role in old_roles:
+            if role not in role_dns and user_dn in members.get(role, ()):
+                members[role].remove(user_dn)
+
+        for role in role_dns:
+            if role not in members:
+                members[role] = OOTreeSet()
+            members[role].insert(user_dn)
+
+        self._groups_store[user_dn] = role_dns
+
+    def _deleteLocalGroups(self, user_dn):
+        """ Remove a user from the local group store """
+        if user_dn in self._groups_store:
+            self._setLocalGroups(user_dn, [])
+            del self._groups_store[user_dn]
+
     @security.protected(manage_users)
     def getLocalUsers(self):
         """ Return all those users who are in locally stored groups """
@@ -1078,19 +1502,16 @@ class LDAPUserFolder(BasicUserFolder):
             group_list.sort()
 
         else:
-            gscope = self._delegate.getScopes()[self.groups_scope]
-
-            if dn != '*':
-                f_template = '(&(objectClass=%s)(%s=%s))'
-                group_filter = '(|'
-
-                for g_name, m_name in GROUP_MEMBER_MAP.items():
-                    fltr = self._delegate.filter_format(f_template,
-                                                        (g_name, m_name, dn))
-                    group_filter += fltr
-
-                group_filter += ')'
+            index = self._groupIndex()
 
+            if index is not None:
+                if dn != '*':
+                    groups = index.getGroupsForMember(dn)
+                else:
+                    groups = index.getGroups()
+                exc = ''
+            elif dn != '*':
+                groups, exc = self._getGroupMemberships(dn)
             else:
                 group_filter = '(|'
 
@@ -1100,35 +1521,358 @@ class LDAPUserFolder(BasicUserFolder):
                     group_filter += fltr
 
                 group_filter += ')'
+                groups, exc = self._searchGroups(group_filter, '*')
 
-            res = self._delegate.search(base=self.groups_base, scope=gscope,
-                                        filter=group_filter, attrs=['cn'],
-                                        bind_dn='', bind_pwd='')
-
-            exc = res['exception']
             if exc:
                 if attr is None:
                     group_list = (('', exc),)
                 else:
                     group_list = (exc,)
-            elif res['size'] > 0:
-                res_dicts = res['results']
-                for i in range(res['size']):
-                    dn = res_dicts[i].get('dn')
-                    try:
-                        cn = res_dicts[i]['cn'][0]
-                    except KeyError:    # NDS oddity
-                        cn = self._delegate.explode_dn(dn, 1)[0]
-
+            else:
+                for cn, group_dn in groups:
                     if attr is None:
-                        group_list.append((cn, dn))
+                        group_list.append((cn, group_dn))
                     elif attr == 'cn':
                         group_list.append(cn)
                     elif attr == 'dn':
-                        group_list.append(dn)
+                        group_list.append(group_dn)
 
         return group_list
 
+    def _getGroupMemberships(self, dn):
+        """ Get the groups a DN is a member of from the groups cache or LDAP
+
+        Returns a tuple of (cn, DN) tuples for the groups and an error
+        message. Failed searches are not cached.
+        """
+        cache = self._cache('groups')
+        cached = cache.get(dn)
+        if cached is not None:
+            return cached[1], ''
+
+        group_attr = self._getGroupAttribute()
+
+        if group_attr is not None:
+            groups, exc = self._readGroupAttribute(dn, group_attr)
+        else:
+            f_template = '(&(objectClass=%s)(%s=%s))'
+            group_filter = '(|'
+
+            for g_name, m_name in GROUP_MEMBER_MAP.items():
+                fltr = self._delegate.filter_format(f_template,
+                                                    (g_name, m_name, dn))
+                group_filter += fltr
+
+            group_filter += ')'
+            groups, exc = self._searchGroups(group_filter, dn)
+
+        if not exc:
+            # The member DN is stored as well, an empty tuple of groups
+            # would look like a cache miss
+            cache.set(dn, (dn, groups))
+
+        return groups, exc
+
+    def _searchGroups(self, group_filter, member_dn, flight='groups'):
+        """ Search for groups in groups_base
+
+        Returns a tuple of (cn, DN) tuples and an error message.
+        Concurrent searches of the same ``flight`` for the same member
+        DN share one search.
+        """
+        gscope = self._delegate.getScopes()[self.groups_scope]
+        res = self._singleFlight().do((flight, member_dn.lower()),
+                                      self._delegate.search,
+                                      base=self.groups_base, scope=gscope,
+                                      filter=group_filter, attrs=['cn'],
+                                      bind_dn='', bind_pwd='')
+
+        if res['exception']:
+            return (), res['exception']
+
+        groups = []
+        for group in res['results']:
+            group_dn = group.get('dn')
+            try:
+                cn = group['cn'][0]
+            except KeyError:    # NDS oddity
+                cn = self._delegate.explode_dn(group_dn, 1)[0]
+            groups.append((cn, group_dn))
+
+        return tuple(groups), ''
+
+    def _getNestedGroups(self, dn, groups):
+        """ Add the groups containing a user's groups to ``groups``
+
+        ``groups`` is a sequence of (cn, DN) tuples for the groups
+        ``dn`` is a direct member of. The groups containing them are
+        looked up in the group graph up to the configured depth or, for
+        Active Directory, found with one search using the
+        LDAP_MATCHING_RULE_IN_CHAIN matching rule.
+        """
+        depth = self._getNestingDepth()
+
+        if not depth:
+            return tuple(groups)
+
+        if self._group_nesting_in_chain:
+            fltr = self._delegate.filter_format(
+                f'(member:{MATCHING_RULE_IN_CHAIN}:=%s)', (dn,))
+            chain, exc = self._searchGroups(fltr, dn, flight='groupchain')
+
+            if exc:
+                logger.warning(f'_getNestedGroups: Cannot search nested '
+                               f'groups of "{dn}" ({exc})')
+                return tuple(groups)
+
+            known = {x[1].lower() for x in groups}
+            return tuple(groups) + tuple(x for x in chain
+                                         if x[1].lower() not in known)
+
+        graph = self._groupGraph()
+
+        if graph is None:
+            return tuple(groups)
+
+        return graph.expand(groups, depth)
+
+    def _getGroupAttribute(self):
+        """ Get the user attribute listing the DNs of the user's groups
+
+        Returns None if group memberships are found by searching the
+        groups for the member DN instead. With local groups or with the
+        group membership index the attribute is not used.
+        """
+        if self._local_groups or getattr(self, '_group_index', False) or \
+           self._group_resolution != 'attribute':
+            return None
+
+        return self._group_attribute or 'memberOf'
+
+    def _readGroupAttribute(self, dn, group_attr):
+        """ Read the groups of a DN from its group attribute
+
+        Returns a tuple of (cn, DN) tuples and an error message. The
+        search has its own flight name, concurrent group searches for
+        the same DN get results of a different shape.
+        """
+        res = self._singleFlight().do(('group_attr', dn.lower(), group_attr),
+                                      self._delegate.search,
+                                      base=dn, scope=self._delegate.BASE,
+                                      filter='(objectClass=*)',
+                                      attrs=[group_attr],
+                                      bind_dn='', bind_pwd='')
+
+        if res['exception']:
+            return (), res['exception']
+
+        if res['size'] == 0:
+            return (), ''
+
+        return self._groupsFromEntry(res['results'][0], group_attr), ''
+
+    def _groupsFromEntry(self, user_attrs, group_attr):
+        """ Get (cn, DN) tuples for the groups listed in a user record
+
+        Only groups within the groups base and scope are returned, just
+        like searching for them would.
+        """
+        group_dns = []
+        for key, value in user_attrs.items():
+            if key.lower() == group_attr.lower():
+                group_dns = isinstance(value, str) and [value] or value
+
+        base = [x.lower() for x in self._delegate.explode_dn(self.groups_base)]
+        depth = len(base)
+        groups = []
+
+        for group_dn in group_dns:
+            try:
+                exploded = self._delegate.explode_dn(group_dn)
+            except Exception:
+                logger.debug(f'_groupsFromEntry: Invalid group DN {group_dn}')
+                continue
+
+            if [x.lower() for x in exploded[-depth:]] != base or \
+               (self.groups_scope == 0 and len(exploded) != depth) or \
+               (self.groups_scope == 1 and len(exploded) != depth + 1):
+                continue
+
+            groups.append((self._delegate.explode_dn(group_dn, 1)[0],
+                           group_dn))
+
+        return tuple(groups)
+
+    def _expireGroupMemberships(self, *dns):
+        """ Remove DNs from the groups cache of all ZEO clients """
+        for dn in dns:
+            self._expireUser(dn)
+
+    def _groupIndex(self):
+        """ Get the group membership index or None if it is not used
+
+        The index is loaded on first use. Once it is older than the
+        refresh interval it is loaded again in the background while the
+        current contents are still used. If it cannot be loaded group
+        memberships are searched for one by one.
+        """
+        if self._local_groups or not getattr(self, '_group_index', False):
+            index = self._loadedGroupIndex()
+            if index is not None and not self._usesGroupGraph():
+                index.clear()
+            return None
+
+        return self._getGroupIndex()
+
+    def _groupGraph(self):
+        """ Get the group index for resolving nested groups
+
+        Returns None if nested groups are not resolved through the
+        graph of groups that are members of other groups.
+        """
+        if not self._usesGroupGraph():
+            return None
+
+        return self._getGroupIndex()
+
+    def _usesGroupGraph(self):
+        return self._getNestingDepth() > 0 and \
+            not self._group_nesting_in_chain
+
+    def _getNestingDepth(self):
+        """ Get the number of group levels to follow above a user's
+        groups, 0 if nested groups are not resolved
+        """
+        if self._local_groups:
+            return 0
+
+        try:
+            return max(int(self._group_nesting or 0), 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _getGroupIndex(self):
+        """ Get the group index, load it if necessary
+
+        Returns None if the index cannot be loaded.
+        """
+        index = getResource(f'{self._hash}-groupindex', GroupIndex, ())
+        source = (self.groups_base, self.groups_scope)
+
+        if index.source != source:
+            # Concurrent requests share one search of the groups base
+            self._singleFlight().do(('groupindex',), self._loadGroupIndex)
+
+            if index.source != source:
+                return None
+
+        elif index.getAge() > self.getGroupIndex()['interval']:
+            self._getRefreshQueue().submit(('groupindex',),
+                                           self._groupIndexJob())
+
+        return index
+
+    def _loadedGroupIndex(self):
+        """ Get the group membership index if it is loaded, else None """
+        index = getResource(f'{self._hash}-groupindex')
+
+        if index is None or not index.isLoaded():
+            return None
+
+        return index
+
+    def _loadGroupIndex(self):
+        """ Load all groups and their members into the group index
+
+        Returns True if the index was loaded. Groups are retrieved page by
+        page, the index is only loaded if all pages could be read. After
+        errors the index is left unchanged.
+        """
+        index = getResource(f'{self._hash}-groupindex', GroupIndex, ())
+        group_filter = '(|'
+
+        for g_name in GROUP_MEMBER_MAP.keys():
+            group_filter += self._delegate.filter_format('(objectClass=%s)',
+                                                         (g_name,))
+
+        group_filter += ')'
+        gscope = self._delegate.getScopes()[self.groups_scope]
+        attrs = list(VALID_GROUP_ATTRIBUTES) + ['objectClass']
+
+        try:
+            records = list(self._delegate.iter_search(base=self.groups_base,
+                                                      scope=gscope,
+                                                      filter=group_filter,
+                                                      attrs=attrs,
+                                                      allow_partial=False))
+        except Exception as e:
+            logger.warning('_loadGroupIndex: Cannot load group index (%s)'
+                           % (str(e) or e.__class__.__name__))
+            return False
+
+        index.load(records, source=(self.groups_base, self.groups_scope))
+        logger.debug('_loadGroupIndex: Loaded %i groups' % len(records))
+
+        return True
+
+    def _indexGroup(self, group_dn):
+        """ Read a new or changed group into a loaded group index """
+        index = self._loadedGroupIndex()
+
+        if index is not None:
+            attrs = list(VALID_GROUP_ATTRIBUTES) + ['objectClass']
+            res = self._delegate.search(base=group_dn,
+                                        scope=self._delegate.BASE,
+                                        filter='(objectClass=*)',
+                                        attrs=attrs)
+
+            if res['size'] > 0:
+                index.addGroup(res['results'][0])
+            else:
+                index.removeGroup(group_dn)
+
+    def _groupIndexJob(self):
+        """ Create the background job loading the group index again """
+        return functools.partial(_refreshGroupIndex, self.getPhysicalPath())
+
+    @security.protected(manage_users)
+    def getGroupIndex(self):
+        """ Get the group membership index settings and contents
+
+        Returns a mapping with the keys ``enabled``, ``interval`` (the
+        refresh interval in seconds) and, if the index is loaded in the
+        current process, the number of ``groups`` and ``members`` and
+        the ``age`` of the index in seconds.
+        """
+        info = {'enabled': getattr(self, '_group_index', False),
+                'interval': getattr(self, '_group_index_interval', 300),
+                'groups': 0, 'members': 0, 'age': None}
+        index = self._loadedGroupIndex()
+
+        if index is not None:
+            info.update(index.getStatistics())
+
+        return info
+
+    @security.protected(manage_users)
+    def setGroupIndex(self, enabled=False, interval=300, REQUEST=None):
+        """ Enable or disable the group membership index
+
+        The index resolves group memberships from memory. It is loaded
+        from a paged search of the groups base and loaded again after
+        ``interval`` seconds.
+        """
+        self._group_index = bool(enabled)
+        self._group_index_interval = max(int(interval or 0), 1)
+
+        index = self._loadedGroupIndex()
+        if index is not None:
+            index.clear()
+
+        if REQUEST is not None:
+            msg = 'Group membership index settings changed'
+            return self.manage_cache(manage_tabs_message=msg)
+
     @security.protected(manage_users)
     def getGroupType(self, group_dn):
         """ get the type of group """
@@ -1139,17 +1883,42 @@ class LDAPUserFolder(BasicUserFolder):
                 group_type = 'Zope Built-in Role'
 
         else:
+            group_type = self._getGroupTypes([group_dn])[group_dn]
+
+        return group_type
+
+    def _getGroupTypes(self, group_dns):
+        """ Look up the types of several LDAP groups in one batch
+
+        Returns a mapping of group DN to group type. Groups found in the
+        group membership index are not looked up.
+        """
+        group_types = {}
+        index = self._groupIndex()
+
+        if index is not None:
+            for group_dn in group_dns:
+                record = index.getGroup(group_dn)
+
+                if record is not None:
+                    group_types[group_dn] = getGroupType(record)
+
+            group_dns = [x for x in group_dns if x not in group_types]
+
+        queries = [{'base': x, 'scope': self._delegate.BASE,
+                    'attrs': ['objectClass']} for x in group_dns]
+        l_groups = [x.lower() for x in GROUP_MEMBER_MAP.keys()]
+
+        for group_dn, res in zip(group_dns,
+                                 self._delegate.search_many(queries)):
             group_type = 'n/a'
-            res = self._delegate.search(base=group_dn,
-                                        scope=self._delegate.BASE,
-                                        attrs=['objectClass'])
-            if res['exception']:
+
+            if res['exception'] or res['size'] == 0:
                 msg = 'getGroupType: No group "%s" (%s)' % (
                     group_dn, res['exception'])
                 logger.info(msg)
 
             else:
-                l_groups = [x.lower() for x in GROUP_MEMBER_MAP.keys()]
                 g_attrs = res['results'][0]
                 group_obclasses = g_attrs.get('objectClass', [])
                 group_obclasses.extend(g_attrs.get('objectclass', []))
@@ -1158,7 +1927,9 @@ class LDAPUserFolder(BasicUserFolder):
                 if len(g_types) > 0:
                     group_type = g_types[0]
 
-        return group_type
+            group_types[group_dn] = group_type
+
+        return group_types
 
     @security.protected(manage_users)
     def getGroupMappings(self):
@@ -1170,9 +1941,7 @@ class LDAPUserFolder(BasicUserFolder):
     @security.protected(manage_users)
     def manage_addGroupMapping(self, group_name, role_name, REQUEST=None):
         """ Map a LDAP group to a Zope role """
-        mappings = getattr(self, '_groups_mappings', {})
-        mappings[group_name] = role_name
-        self._groups_mappings = mappings
+        self._groupMappings()[group_name] = role_name
         self._clearCaches()
 
         if REQUEST:
@@ -1182,13 +1951,12 @@ class LDAPUserFolder(BasicUserFolder):
     @security.protected(manage_users)
     def manage_deleteGroupMappings(self, group_names, REQUEST=None):
         """ Delete mappings from LDAP group to Zope role """
-        mappings = getattr(self, '_groups_mappings', {})
+        mappings = self._groupMappings()
 
         for group_name in group_names:
             if group_name in mappings:
                 del mappings[group_name]
 
-        self._groups_mappings = mappings
         self._clearCaches()
 
         if REQUEST:
@@ -1196,6 +1964,32 @@ class LDAPUserFolder(BasicUserFolder):
                 ', '.join(group_names))
             return self.manage_grouprecords(manage_tabs_message=msg)
 
+    def _groupMappings(self):
+        """ Get the persistent LDAP group to Zope role mapping
+
+        Instances created before the mapping was kept in a BTree get
+        one the first time a mapping is changed.
+        """
+        mappings = getattr(aq_base(self), '_groups_mappings', None)
+
+        if not isinstance(mappings, OOBTree):
+            mappings = self._groups_mappings = OOBTree(mappings or {})
+
+        return mappings
+
+    def _additionalGroups(self):
+        """ Get the persistent set of locally defined groups
+
+        Instances created before the groups were kept in a tree set get
+        one the first time a group is added or deleted.
+        """
+        groups = getattr(aq_base(self), '_additional_groups', None)
+
+        if not isinstance(groups, OOTreeSet):
+            groups = self._additional_groups = OOTreeSet(groups or ())
+
+        return groups
+
     def _mapRoles(self, groups):
         """ Perform the mapping of LDAP groups to Zope roles """
         mappings = getattr(self, '_groups_mappings', {})
@@ -1293,12 +2087,7 @@ class LDAPUserFolder(BasicUserFolder):
                         newgroup_type='groupOfUniqueNames', REQUEST=None):
         """ Add a new group in groups_base """
         if self._local_groups and newgroup_name:
-            add_groups = self._additional_groups
-
-            if newgroup_name not in add_groups:
-                add_groups.append(newgroup_name)
-
-            self._additional_groups = add_groups
+            self._additionalGroups().insert(newgroup_name)
             msg = 'Added new group %s' % (newgroup_name)
 
         elif newgroup_name:
@@ -1322,6 +2111,12 @@ class LDAPUserFolder(BasicUserFolder):
                                             attrs=attributes)
             msg = err_msg or 'Added new group %s' % (newgroup_name)
 
+            if not err_msg:
+                self._indexGroup(f'cn={newgroup_name},{self.groups_base}')
+
+                if initial_member:
+                    self._expireGroupMemberships(initial_member)
+
         else:
             msg = 'No group name specified'
 
@@ -1383,7 +2178,7 @@ class LDAPUserFolder(BasicUserFolder):
                 user_roles = source.get('user_roles', [])
 
                 if self._local_groups:
-                    self._groups_store[user_dn] = user_roles
+                    self._setLocalGroups(user_dn, user_roles)
                 else:
                     if len(user_roles) > 0:
                         group_dns = []
@@ -1428,20 +2223,23 @@ class LDAPUserFolder(BasicUserFolder):
 
         else:
             if self._local_groups:
-                add_groups = self._additional_groups
+                add_groups = self._additionalGroups()
                 for dn in dns:
                     if dn in add_groups:
-                        del add_groups[add_groups.index(dn)]
-
-                self._additional_groups = add_groups
+                        add_groups.remove(dn)
 
             else:
+                index = self._loadedGroupIndex()
+
                 for dn in dns:
                     msg = self._delegate.delete(dn)
 
                     if msg:
                         break
 
+                    if index is not None:
+                        index.removeGroup(dn)
+
             msg = msg or 'Deleted group(s):<br> %s' % '<br>'.join(dns)
             self._clearCaches()
 
@@ -1467,10 +2265,10 @@ class LDAPUserFolder(BasicUserFolder):
                 self._delegate.delete(dn)
 
                 if self._local_groups:
-                    if dn in self._groups_store.keys():
-                        del self._groups_store[dn]
+                    self._deleteLocalGroups(dn)
                 else:
                     user_groups = self.getGroups(dn=dn, attr='dn')
+                    index = self._loadedGroupIndex()
 
                     for group in user_groups:
                         group_type = self.getGroupType(group)
@@ -1481,6 +2279,9 @@ class LDAPUserFolder(BasicUserFolder):
                                                     mod_type=del_op,
                                                     attrs={member_type: [dn]})
 
+                        if not msg and index is not None:
+                            index.removeMember(group, dn)
+
             msg = 'Deleted user(s):<br> %s' % '<br>'.join(dns)
             self._clearCaches()
 
@@ -1522,21 +2323,37 @@ class LDAPUserFolder(BasicUserFolder):
                 group_dns.append(group)
 
         if self._local_groups:
-            if len(role_dns) == 0 and user_dn in self._groups_store:
-                del self._groups_store[user_dn]
+            if len(role_dns) == 0:
+                self._deleteLocalGroups(user_dn)
             else:
-                self._groups_store[user_dn] = role_dns
+                self._setLocalGroups(user_dn, role_dns)
 
         else:
+            changes = []
             for group in all_groups:
-                member_attr = GROUP_MEMBER_MAP.get(self.getGroupType(group))
-
                 if group in cur_groups and group not in group_dns:
-                    msg = self._delegate.modify(group, self._delegate.DELETE,
-                                                {member_attr: [user_dn]})
+                    changes.append((group, self._delegate.DELETE))
                 elif group in group_dns and group not in cur_groups:
-                    msg = self._delegate.modify(group, self._delegate.ADD,
-                                                {member_attr: [user_dn]})
+                    changes.append((group, self._delegate.ADD))
+
+            # Look up the types of all affected groups in one batch
+            group_types = self._getGroupTypes([x[0] for x in changes])
+            index = self._loadedGroupIndex()
+
+            for group, mod_type in changes:
+                member_attr = GROUP_MEMBER_MAP.get(group_types[group])
+                msg = self._delegate.modify(group, mod_type,
+                                            {member_attr: [user_dn]})
+
+                if msg or index is None:
+                    continue
+                elif mod_type == self._delegate.ADD:
+                    index.addMember(group, user_dn)
+                else:
+                    index.removeMember(group, user_dn)
+
+            if changes:
+                self._expireGroupMemberships(user_dn)
 
         msg = msg or 'Roles changed for %s' % (user_dn)
         user_obj = self.getUserByDN(user_dn)
@@ -1653,12 +2470,12 @@ class LDAPUserFolder(BasicUserFolder):
             old_groups = self.getGroups(dn=user_dn, attr='dn')
 
             if self._local_groups:
-                if self._groups_store.get(user_dn):
-                    del self._groups_store[user_dn]
-
-                self._groups_store[new_dn] = old_groups
+                self._deleteLocalGroups(user_dn)
+                self._setLocalGroups(new_dn, old_groups)
 
             else:
+                index = self._loadedGroupIndex()
+
                 for group in old_groups:
                     group_type = self.getGroupType(group)
                     member_type = GROUP_MEMBER_MAP.get(group_type)
@@ -1668,6 +2485,13 @@ class LDAPUserFolder(BasicUserFolder):
                     msg = self._delegate.modify(group, self._delegate.ADD,
                                                 {member_type: [new_dn]})
 
+                    if index is not None:
+                        index.removeMember(group, user_dn)
+                        if not msg:
+                            index.addMember(group, new_dn)
+
+                self._expireGroupMemberships(user_dn, new_dn)
+
         self._expireUser(cur_user.getProperty(rdn))
         msg = msg or 'User %s changed' % (new_dn or user_dn)
 
@@ -1677,7 +2501,11 @@ class LDAPUserFolder(BasicUserFolder):
 
     @security.protected(manage_users)
     def _expireUser(self, user):
-        """ Purge user object from caches """
+        """ Purge user object from caches
+
+        The user is expired in other ZEO clients as well when they
+        notice the change, see ``_applyInvalidations``.
+        """
         user = user or ''
 
         if isinstance(user, bytes):
@@ -1685,8 +2513,15 @@ class LDAPUserFolder(BasicUserFolder):
         elif isinstance(user, LDAPUser):
             user = user.getUserName()
 
+        self._expireLocalUser(user)
+        self._invalidationLog().invalidateUser(user)
+
+    def _expireLocalUser(self, user):
+        """ Purge a user name or DN from the caches of the current process
+        """
         self._cache('anonymous').invalidate(user)
         self._cache('authenticated').invalidate(user)
+        self._cache('groups').invalidate(user)
 
         # This only removes records from the negative cache which
         # were retrieved without a password, since down here we do not
@@ -1722,14 +2557,72 @@ class LDAPUserFolder(BasicUserFolder):
 
     def _cache(self, cache_type='anonymous'):
         """ Get the specified user cache """
-        cache = getResource(f'{self._hash}-{cache_type}cache',
-                            UserCache, ())
+        cache = self._cacheResource(f'{cache_type}cache', 'createUserCache')
         cache.setTimeout(self.getCacheTimeout(cache_type))
+        limits = self.getCacheLimits(cache_type)
+        cache.setLimits(limits['max_entries'], limits['max_size'] * 1024)
+        cache.setGrace(self.getCacheGrace(cache_type))
         return cache
 
     def _misc_cache(self):
         """ Return the miscellaneous cache """
-        return getResource('%s-misc_cache' % self._hash, SimpleCache, ())
+        return self._cacheResource('misc_cache', 'createMiscCache')
+
+    def _cacheResource(self, name, factory_name):
+        """ Get a cache from the configured cache backend
+
+        The cache is created by calling the backend method
+        ``factory_name`` with the namespace for the cache.
+        """
+        self._applyInvalidations()
+        config = self.getCacheBackend()
+        namespace = f'{self._hash}-{name}'
+        backend = getCacheBackend(config['name'], config['location'])
+
+        if config['name'] == 'local':
+            resource_id = namespace
+        else:
+            resource_id = '{}-{}-{}'.format(namespace, config['name'],
+                                            config['location'])
+
+        return getResource(resource_id, getattr(backend, factory_name),
+                           (namespace,))
+
+    @security.protected(manage_users)
+    def getCacheBackend(self):
+        """ Return the name and location of the cache backend in use """
+        return {'name': getattr(self, '_cache_backend', 'local'),
+                'location': getattr(self, '_cache_location', '')}
+
+    @security.protected(manage_users)
+    def getCacheBackends(self):
+        """ Return the available cache backends for the ZMI """
+        backends = registeredCacheBackends()
+
+        return [{'name': x['name'], 'description': x['description']}
+                for x in backends.values()]
+
+    @security.protected(manage_users)
+    def setCacheBackend(self, name='local', location='', REQUEST=None):
+        """ Change where the user and miscellaneous caches are kept
+
+        ``location`` tells the backend where to keep the caches, e.g.
+        the socket path of a cache server. The caches start out empty
+        after a change.
+        """
+        if name not in registeredCacheBackends():
+            msg = f'Unknown cache backend {name}'
+        else:
+            self._cache_backend = name
+            self._cache_location = location.strip()
+            msg = 'Cache backend changed'
+
+        if REQUEST is not None:
+            return self.manage_cache(manage_tabs_message=msg)
+
+    def _singleFlight(self):
+        """ Return the process-wide coalescer for concurrent lookups """
+        return getResource(f'{self._hash}-singleflight', SingleFlight, ())
 
     @security.protected(manage_users)
     def getCacheTimeout(self, cache_type='anonymous'):
@@ -1753,6 +2646,111 @@ class LDAPUserFolder(BasicUserFolder):
             msg = 'Cache timeout changed'
             return self.manage_cache(manage_tabs_message=msg)
 
+    @security.protected(manage_users)
+    def getCacheGrace(self, cache_type='anonymous'):
+        """ Retrieve the grace period for stale cache entries (in seconds)
+
+        During the grace period an expired user is still served from the
+        cache while it is looked up again in the background. Only the
+        authenticated and anonymous caches have a grace period.
+        """
+        if cache_type not in ('anonymous', 'authenticated'):
+            return 0
+
+        return getattr(self, '_%s_grace' % cache_type, 0)
+
+    @security.protected(manage_users)
+    def setCacheGrace(self, cache_type='anonymous', grace=0, REQUEST=None):
+        """ Set the grace period for stale cache entries, 0 disables it """
+        if cache_type in ('anonymous', 'authenticated'):
+            grace = max(int(grace or 0), 0)
+            setattr(self, '_%s_grace' % cache_type, grace)
+            self._cache(cache_type).setGrace(grace)
+
+        if REQUEST is not None:
+            msg = 'Cache grace period changed'
+            return self.manage_cache(manage_tabs_message=msg)
+
+    @security.protected(manage_users)
+    def getCacheLimits(self, cache_type='anonymous'):
+        """ Retrieve the maximum cache size
+
+        Returns a mapping with the maximum number of entries and the
+        approximate maximum size in KB, 0 means no limit.
+        """
+        return {'max_entries': getattr(self, '_%s_max_entries' % cache_type,
+                                       10000),
+                'max_size': getattr(self, '_%s_max_size' % cache_type, 0)}
+
+    @security.protected(manage_users)
+    def setCacheLimits(self, cache_type='anonymous', max_entries=10000,
+                       max_size=0, REQUEST=None):
+        """ Set the maximum number of entries and size in KB of a cache """
+        max_entries = max(int(max_entries or 0), 0)
+        max_size = max(int(max_size or 0), 0)
+
+        setattr(self, '_%s_max_entries' % cache_type, max_entries)
+        setattr(self, '_%s_max_size' % cache_type, max_size)
+
+        self._cache(cache_type).setLimits(max_entries, max_size * 1024)
+
+        if REQUEST is not None:
+            msg = 'Cache limits changed'
+            return self.manage_cache(manage_tabs_message=msg)
+
+    @security.protected(manage_users)
+    def getCacheUsage(self, cache_type='anonymous'):
+        """ Get the number of entries, the approximate size in KB and the
+        number of entries evicted to stay within the limits of a cache
+        """
+        cache = self._cache(cache_type)
+        cache.sweep()
+
+        return {'entries': len(cache),
+                'size': int(round(cache.getSize() / 1024.0)),
+                'evictions': cache.evictions}
+
+    @security.protected(manage_users)
+    def getCacheStatistics(self, cache_type=None, REQUEST=None):
+        """ Get hit, miss, insert, eviction, expiration and invalidation
+        counts as well as the number of entries, approximate size in KB
+        and hit ratio of the anonymous, authenticated, negative or misc
+        cache
+
+        Without a cache type a mapping of cache type to statistics for
+        all caches is returned. When called through the web the result
+        is returned as JSON, e.g. for monitoring systems.
+        """
+        if cache_type is None:
+            stats = {x: self.getCacheStatistics(x) for x in CACHE_TYPES}
+        else:
+            if cache_type == 'misc':
+                cache = self._misc_cache()
+            else:
+                cache = self._cache(cache_type)
+                cache.sweep()
+            stats = cache.getStatistics()
+            stats['size'] = int(round(stats['size'] / 1024.0))
+
+        if REQUEST is not None:
+            REQUEST.RESPONSE.setHeader('Content-Type', 'application/json')
+            return json.dumps(stats)
+
+        return stats
+
+    @security.protected(manage_users)
+    def resetCacheStatistics(self, REQUEST=None):
+        """ Set the statistics counters of all caches back to 0 """
+        for cache_type in CACHE_TYPES:
+            if cache_type == 'misc':
+                self._misc_cache().resetStatistics()
+            else:
+                self._cache(cache_type).resetStatistics()
+
+        if REQUEST is not None:
+            msg = 'Cache statistics reset'
+            return self.manage_cache(manage_tabs_message=msg)
+
     @security.protected(manage_users)
     def getCurrentServer(self):
         """ Simple UI Helper to show who we are currently connected to. """
@@ -1770,6 +2768,40 @@ class LDAPUserFolder(BasicUserFolder):
         return sha1(self.getProperty('_bindpwd').encode()).hexdigest()
 
 
+def _refreshCachedUser(path, name, value, pwd=None):
+    """ Refresh a cached user from a background thread
+
+    The user folder is loaded from its own ZODB connection, because the
+    thread must not use persistent objects of the request that queued
+    the refresh.
+    """
+    import Zope2
+    app = Zope2.app()
+
+    try:
+        folder = app.unrestrictedTraverse(path)
+        folder._refreshCachedUser(name, value, pwd)
+    finally:
+        transaction.abort()
+        app._p_jar.close()
+
+
+def _refreshGroupIndex(path):
+    """ Load the group index again from a background thread
+
+    See ``_refreshCachedUser`` for the separate ZODB connection.
+    """
+    import Zope2
+    app = Zope2.app()
+
+    try:
+        folder = app.unrestrictedTraverse(path)
+        folder._loadGroupIndex()
+    finally:
+        transaction.abort()
+        app._p_jar.close()
+
+
 def manage_addLDAPUserFolder(self, delegate_type='LDAP delegate',
                              REQUEST=None):
     """ Called by Zope to create and install an LDAPUserFolder """
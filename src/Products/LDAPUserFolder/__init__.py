@@ -23,5 +23,7 @@ def initialize(context):
     context.registerClass(LDAPUserFolder, permission=add_user_folders,
                           constructors=(manage_addLDAPUserFolder,))
 
-    # make sure the default LDAPDelegate class is registered
+    # make sure the delegate classes and cache backends are registered
+    from . import AsyncLDAPDelegate  # noqa: F401
     from . import LDAPDelegate  # noqa: F401
+    from . import sharedcache  # noqa: F401
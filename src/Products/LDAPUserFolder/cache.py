@@ -13,46 +13,359 @@
 """ A simple non-persistent user object cache
 """
 
+import heapq
+import logging
+import sys
 import time
+from collections import OrderedDict
+from collections import deque
+from threading import Event
 from threading import Lock
+from threading import Thread
+from threading import current_thread
 
-from dataflake.cache.timeout import TimeoutCache
+from zope.interface import implementer
 
+from dataflake.cache.interfaces import ITimeoutCache
 
+from .interfaces import ICacheBackend
+
+
+logger = logging.getLogger('event.LDAPUserFolder')
 _caches = {}
 _cache_lock = Lock()
 
 
-class UserCache(TimeoutCache):
-    """ A simple non-persistent cache for user objects """
+def approximateSize(object):
+    """ Estimate the memory used by an object in bytes
+
+    The object itself, its attribute mapping and the attribute names and
+    values are counted, the items of container values one level deep.
+    The items of a container object are counted as well.
+    """
+    size = sys.getsizeof(object)
+    if isinstance(object, (list, tuple, set, frozenset)):
+        size += sum(sys.getsizeof(x) for x in object)
+    attrs = getattr(object, '__dict__', None)
+
+    if attrs:
+        size += sys.getsizeof(attrs)
+        for key, value in list(attrs.items()):
+            size += sys.getsizeof(key) + sys.getsizeof(value)
+            if isinstance(value, (list, tuple, set, frozenset)):
+                size += sum(sys.getsizeof(x) for x in value)
+            elif isinstance(value, dict):
+                size += sum(sys.getsizeof(k) + sys.getsizeof(v)
+                            for k, v in value.items())
+
+    return size
+
+
+class CacheStatistics:
+    """ Mixin counting what happens in a cache
+
+    The counters are updated without holding a lock, under heavy load
+    they are close approximations.
+    """
+
+    hits = misses = inserts = evictions = expirations = invalidations = 0
+
+    def getStatistics(self):
+        """ Get the counters, the number of entries, the approximate size
+        in bytes and the ratio of hits to lookups
+        """
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'inserts': self.inserts,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'entries': len(self),
+                'size': self.getSize(),
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0}
+
+    def resetStatistics(self):
+        """ Set all counters back to 0 """
+        self.hits = self.misses = self.inserts = 0
+        self.evictions = self.expirations = self.invalidations = 0
+
+
+@implementer(ITimeoutCache)
+class UserCache(CacheStatistics):
+    """ A simple non-persistent cache for user objects
+
+    Each entry stores its expiration time as a float from the monotonic
+    clock, so lookups neither allocate objects nor depend on changes to
+    the system time. A heap of (expiration time, key) pairs ordered by
+    expiration lets ``sweep`` find expired entries without looking at
+    the valid ones. Heap items for keys that have been set again or
+    invalidated in the meantime are discarded when they come up.
+
+    The cache can be bounded by a number of entries and an approximate
+    memory size in bytes, 0 means no limit. When a limit is exceeded
+    the least recently used entries are evicted.
+
+    Expired entries are kept for ``grace`` more seconds, during which
+    ``getStale`` still returns them while they are being refreshed.
+
+    Hits, misses, inserts, evictions, expirations and invalidations are
+    counted, see ``getStatistics``.
+    """
+
+    def __init__(self):
+        self.timeout = 600
+        self.grace = 0
+        self.max_entries = 0
+        self.max_size = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._expiries = []
+        self._lock = Lock()
+
+    def set(self, id, object):
+        """ Store an object, expired entries are swept along the way """
+        key = id.lower()
+        now = time.monotonic()
+        expires = now + self.timeout
+        size = approximateSize(object)
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (expires, object, size)
+            self._size += size
+            self.inserts += 1
+            heapq.heappush(self._expiries, (expires, key))
+            self._sweep(now)
+            self._evict()
+
+            if len(self._expiries) > 2 * len(self._entries) + 64:
+                # Too many heap items for replaced or evicted entries
+                self._rebuildExpiries()
 
     def get(self, id, password=None):
         """ Retrieve a cached object if it is valid """
-        user = super().get(id)
+        key = id.lower()
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, user, size = entry
+        if not user or time.monotonic() >= expires:
+            self.misses += 1
+            return None
+
+        if password is not None and password != user._getPassword():
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        try:
+            self._entries.move_to_end(key)
+        except KeyError:  # Removed by another thread in the meantime
+            pass
+
+        return user
 
-        if password is not None and \
-           user is not None and \
-           password != user._getPassword():
-            user = None
+    def getStale(self, id, password=None):
+        """ Retrieve a cached object that expired less than ``grace``
+        seconds ago, or None
+        """
+        entry = self._entries.get(id.lower())
 
-        if user and \
-           (time.time() < user.getCreationTime().timeTime() + self.timeout):
-            return user
-        else:
+        if entry is None:
             return None
 
+        expires, user, size = entry
+        now = time.monotonic()
+        if not user or now < expires or now >= expires + self.grace:
+            return None
+
+        if password is not None and password != user._getPassword():
+            return None
+
+        return user
+
+    def invalidate(self, id=None):
+        """ Invalidate the given key, or all entries if no key is passed """
+        with self._lock:
+            if id is not None:
+                if self._discard(id.lower()) is not None:
+                    self.invalidations += 1
+            else:
+                self.invalidations += len(self._entries)
+                self._entries = OrderedDict()
+                self._expiries = []
+                self._size = 0
+
+    def setLimits(self, max_entries=0, max_size=0):
+        """ Set the maximum number of entries and size in bytes """
+        if (max_entries, max_size) == (self.max_entries, self.max_size):
+            return
+
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_size = max_size
+            self._evict()
+
+    def getLimits(self):
+        """ Get the maximum number of entries and size in bytes """
+        return self.max_entries, self.max_size
+
+    def setGrace(self, grace):
+        """ Set how many seconds expired entries are kept for ``getStale`` """
+        self.grace = grace
+
+    def getSize(self):
+        """ Get the approximate size of all entries in bytes """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+        return entry
+
+    def _evict(self):
+        entries = self._entries
+
+        while entries and \
+            ((self.max_entries and len(entries) > self.max_entries) or
+             (self.max_size and self._size > self.max_size)):
+            key, entry = entries.popitem(last=False)
+            self._size -= entry[2]
+            self.evictions += 1
+
+    def _rebuildExpiries(self):
+        self._expiries = [(x[1][0], x[0]) for x in self._entries.items()]
+        heapq.heapify(self._expiries)
+
+    def sweep(self):
+        """ Remove all expired entries and return their number """
+        with self._lock:
+            return self._sweep(time.monotonic())
+
+    def _sweep(self, now):
+        expiries = self._expiries
+        entries = self._entries
+        removed = 0
+
+        while expiries and expiries[0][0] + self.grace <= now:
+            expires, key = heapq.heappop(expiries)
+            entry = entries.get(key)
+            if entry is not None and entry[0] == expires:
+                self._discard(key)
+                removed += 1
+
+        self.expirations += removed
+
+        return removed
+
     def getCache(self):
         """ Get valid cache records """
-        valid = []
-        cached = self.cache.values()
-        now = time.time()
+        self.sweep()
+
+        return [x[1] for x in list(self._entries.values()) if x[1]]
+
+    def keys(self):
+        """ Return all keys of valid entries """
+        self.sweep()
+
+        return list(self._entries.keys())
+
+    def values(self):
+        """ Return all valid cached objects """
+        self.sweep()
+
+        return [x[1] for x in list(self._entries.values())]
+
+    def items(self):
+        """ Return (key, object) tuples for all valid entries """
+        self.sweep()
+
+        return [(x[0], x[1][1]) for x in list(self._entries.items())]
+
+    def setTimeout(self, timeout):
+        """ Set a timeout value in seconds
+
+        Like before the timeout also applies to entries that are already
+        cached, their expiration times are moved by the difference.
+        """
+        if timeout == self.timeout:
+            return
+
+        with self._lock:
+            delta = timeout - self.timeout
+            self.timeout = timeout
+            self._entries = OrderedDict(
+                (key, (expires + delta, user, size))
+                for key, (expires, user, size) in self._entries.items())
+            self._rebuildExpiries()
+
+    def getTimeout(self):
+        """ Get the timeout value """
+        return self.timeout
+
 
-        for object in cached:
-            created = object.getCreationTime().timeTime()
-            if object and now < (created + self.timeout):
-                valid.append(object)
+@implementer(ICacheBackend)
+class LocalCacheBackend:
+    """ Keep cache entries in the memory of the current process """
 
-        return valid
+    def __init__(self, location=''):
+        self.location = location
+
+    def createUserCache(self, namespace):
+        return UserCache()
+
+    def createMiscCache(self, namespace):
+        return MiscCache()
+
+    def claimInvalidations(self, namespace, state, applied):
+        """ Every process applies invalidations to its own caches """
+        return applied
+
+
+backend_registry = {}
+
+
+def registerCacheBackend(name, klass, description=''):
+    """ Register a cache backend
+
+    name is a short ID-like moniker for the backend
+    klass is called with a location string, like a socket path, and
+    must return an object providing ICacheBackend
+    description is a more verbose backend description
+    """
+    backend_registry[name] = {'name': name, 'klass': klass,
+                              'description': description}
+
+
+def registeredCacheBackends():
+    """ Return the currently-registered cache backends """
+    return backend_registry
+
+
+def getCacheBackend(name='local', location=''):
+    """ Get the process-wide backend instance for a name and location
+
+    Unknown names fall back to the in-process backend.
+    """
+    if name not in backend_registry:
+        name = 'local'
+    klass = backend_registry[name]['klass']
+
+    return getResource(f'cachebackend-{name}-{location}', klass, (location,))
+
+
+registerCacheBackend('local', LocalCacheBackend, 'Process memory (default)')
 
 
 def getResource(id, factory=None, factoryArgs=()):
@@ -99,3 +412,207 @@ def removeResource(id):
         pass
     finally:
         _cache_lock.release()
+
+
+@implementer(ITimeoutCache)
+class MiscCache(CacheStatistics):
+    """ A non-persistent cache for values built from many LDAP records
+
+    Entries expire ``timeout`` seconds after they have been set.
+    """
+
+    def __init__(self):
+        self.timeout = 600
+        self._entries = {}
+        self._lock = Lock()
+
+    def set(self, key, value):
+        """ Store a key/value pair """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.timeout, value)
+            self.inserts += 1
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or ``default`` if it has expired """
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if time.monotonic() >= entry[0]:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+                    self.expirations += 1
+            self.misses += 1
+            return default
+
+        self.hits += 1
+
+        return entry[1]
+
+    def invalidate(self, key=None):
+        """ Invalidate the given key, or all entries if no key is passed """
+        with self._lock:
+            if key is not None:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+            else:
+                self.invalidations += len(self._entries)
+                self._entries = {}
+
+    def keys(self):
+        """ Return all cache keys """
+        return list(self._entries.keys())
+
+    def values(self):
+        """ Return all cached values """
+        return [x[1] for x in list(self._entries.values())]
+
+    def items(self):
+        """ Return all cached (key, value) tuples """
+        return [(x[0], x[1][1]) for x in list(self._entries.items())]
+
+    def getSize(self):
+        """ Get the approximate size of all entries in bytes """
+        return sum(approximateSize(x) for x in self.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def setTimeout(self, timeout):
+        """ Set the timeout value in seconds for new entries """
+        self.timeout = timeout
+
+    def getTimeout(self):
+        """ Get the timeout value """
+        return self.timeout
+
+
+class RefreshQueue:
+    """ Run jobs in a few background threads, at most one job per key
+
+    Used to refresh stale cache entries without keeping a request
+    waiting. New jobs are refused while too many are waiting already.
+    Worker threads only live while there is work for them.
+    """
+
+    def __init__(self, workers=2, max_pending=1000):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = Lock()
+        self._pending = set()
+        self._jobs = deque()
+        self._threads = []
+
+    def submit(self, key, job):
+        """ Queue ``job`` unless a job for ``key`` is pending already
+
+        Returns True if a job for ``key`` is waiting or running and
+        False if the job was refused.
+        """
+        with self._lock:
+            if key in self._pending:
+                return True
+
+            if len(self._pending) >= self.max_pending:
+                return False
+
+            self._pending.add(key)
+            self._jobs.append((key, job))
+
+            if len(self._threads) < self.workers:
+                thread = Thread(target=self._run, daemon=True,
+                                name='LDAPUserFolder cache refresh')
+                self._threads.append(thread)
+                thread.start()
+
+        return True
+
+    def isPending(self, key):
+        with self._lock:
+            return key in self._pending
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._jobs:
+                    self._threads.remove(current_thread())
+                    return
+                key, job = self._jobs.popleft()
+
+            try:
+                job()
+            except Exception:
+                logger.exception('RefreshQueue: Job failed')
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+class SingleFlight:
+    """ Coalesce concurrent calls for the same key into one call
+
+    The first thread asking for a key does the work, other threads
+    asking for the same key meanwhile wait for its result. A waiting
+    thread that times out does the work itself.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kw):
+        """ Return the result of ``func(*args, **kw)``
+
+        Exceptions raised by ``func`` are raised in all threads waiting
+        for it as well.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            if call.thread is current_thread():
+                # Re-entrant call, waiting would block forever
+                return func(*args, **kw)
+
+            if call.done.wait(self.timeout):
+                if call.exception is not None:
+                    raise call.exception
+                return call.result
+
+            logger.warning(f'SingleFlight: Timeout waiting for {key!r}')
+            return func(*args, **kw)
+
+        try:
+            call.result = func(*args, **kw)
+        except Exception as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def isInFlight(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+class _Call:
+    """ A call in progress for SingleFlight """
+
+    def __init__(self):
+        self.thread = current_thread()
+        self.done = Event()
+        self.result = None
+        self.exception = None
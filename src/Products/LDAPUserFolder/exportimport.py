@@ -15,6 +15,7 @@
 
 from Acquisition import aq_base
 from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
 from zope.component import adapts
 from ZPublisher.HTTPRequest import default_encoding
 
@@ -31,6 +32,8 @@ PROPERTIES = ('title', '_login_attr', '_uid_attr', 'users_base',
               '_binduid', '_bindpwd', '_binduid_usage', '_rdnattr',
               '_user_objclasses', '_local_groups', '_implicit_mapping',
               '_pwd_encryption', 'read_only', '_extra_user_filter',
+              '_group_resolution', '_group_attribute', '_group_nesting',
+              '_group_nesting_in_chain',
               '_anonymous_timeout', '_authenticated_timeout')
 
 
@@ -255,13 +258,14 @@ class LDAPUserFolderXMLAdapter(XMLAdapterBase):
 
         value_nodes = [x for x in child.childNodes if
                        x.nodeType == child.ELEMENT_NODE]
-        self.context._additional_groups = self._readSequenceValue(value_nodes)
+        self.context._additional_groups = OOTreeSet(
+            self._readSequenceValue(value_nodes))
 
     def _initGroupMap(self, node):
         """ Initialize LDAP group to Zope role mapping
         """
         # group-map/mapped-group/ldap_group/zope_role
-        group_map = {}
+        group_map = OOBTree()
 
         for child in node.childNodes:
             if child.nodeName != 'group-map':
@@ -298,6 +302,7 @@ class LDAPUserFolderXMLAdapter(XMLAdapterBase):
                 groups_store[user_dn] = role_dns
 
         self.context._groups_store = groups_store
+        self.context._rebuildLocalGroupMembers()
 
     def _initServers(self, node):
         """ Initialize LDAP server configurations
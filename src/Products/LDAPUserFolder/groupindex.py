@@ -0,0 +1,298 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" In-memory index of LDAP groups and their members
+"""
+
+import time
+from threading import Lock
+
+from .utils import GROUP_MEMBER_ATTRIBUTES
+from .utils import GROUP_MEMBER_MAP
+
+
+MEMBER_ATTRIBUTES = {x.lower() for x in GROUP_MEMBER_ATTRIBUTES}
+GROUP_TYPES = {x.lower(): x for x in GROUP_MEMBER_MAP.keys()}
+
+
+def getGroupType(record):
+    """ Find the group type of a group record, 'n/a' if it is unknown """
+    for key, values in record.items():
+        if key.lower() == 'objectclass':
+            for value in values:
+                if value.lower() in GROUP_TYPES:
+                    return value
+
+    return 'n/a'
+
+
+class GroupIndex:
+    """ Map member DNs to the groups they belong to
+
+    The index is loaded from the group records found by a single search
+    in the groups base and can be patched in place after changes to the
+    groups. All DNs are compared case-insensitively.
+
+    Groups that are members of other groups form a graph. The ancestors
+    of a group in this graph are computed once and kept until the index
+    changes.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.loaded = None
+        self._lock = Lock()
+        self._groups = {}
+        self._members = {}
+        self._ancestors = {}
+
+    def load(self, records, source=None):
+        """ Replace the index contents with a sequence of group records
+
+        The records are mappings as returned by the delegate search
+        method. ``source`` identifies where the records came from.
+        """
+        groups = {}
+        members = {}
+
+        for record in records:
+            record = _copyRecord(record)
+            group_key = record['dn'].lower()
+            groups[group_key] = record
+
+            for member_dn in _getMembers(record):
+                members.setdefault(member_dn.lower(), set()).add(group_key)
+
+        with self._lock:
+            self._groups = groups
+            self._members = members
+            self._ancestors = {}
+            self.source = source
+            self.loaded = time.monotonic()
+
+    def clear(self):
+        """ Empty the index, it must be loaded again before it is used """
+        with self._lock:
+            self._groups = {}
+            self._members = {}
+            self._ancestors = {}
+            self.source = None
+            self.loaded = None
+
+    def isLoaded(self):
+        return self.loaded is not None
+
+    def getAge(self):
+        """ Seconds since the index was loaded """
+        if self.loaded is None:
+            return None
+
+        return time.monotonic() - self.loaded
+
+    def getGroups(self):
+        """ Get (cn, DN) tuples for all groups """
+        with self._lock:
+            return tuple(sorted(_getNames(x) for x in self._groups.values()))
+
+    def getGroupsForMember(self, member_dn):
+        """ Get (cn, DN) tuples for the groups ``member_dn`` belongs to """
+        with self._lock:
+            keys = self._members.get(member_dn.lower(), ())
+            return tuple(sorted(_getNames(self._groups[x]) for x in keys))
+
+    def getGroup(self, group_dn):
+        """ Get a copy of the record for ``group_dn`` or None """
+        with self._lock:
+            record = self._groups.get(group_dn.lower())
+
+            if record is not None:
+                return _copyRecord(record)
+
+        return None
+
+    def getGroupByCN(self, cn):
+        """ Get a copy of the first record with the given cn or None """
+        with self._lock:
+            for record in self._groups.values():
+                if _getNames(record)[0].lower() == cn.lower():
+                    return _copyRecord(record)
+
+        return None
+
+    def addGroup(self, record):
+        """ Add a group record or replace an existing one """
+        self.removeGroup(record['dn'])
+        record = _copyRecord(record)
+        group_key = record['dn'].lower()
+
+        with self._lock:
+            self._groups[group_key] = record
+            self._ancestors = {}
+
+            for member_dn in _getMembers(record):
+                self._members.setdefault(member_dn.lower(),
+                                         set()).add(group_key)
+
+    def removeGroup(self, group_dn):
+        """ Remove a group and its memberships """
+        group_key = group_dn.lower()
+
+        with self._lock:
+            record = self._groups.pop(group_key, None)
+            self._ancestors = {}
+
+            if record is not None:
+                for member_dn in _getMembers(record):
+                    self._discard(member_dn.lower(), group_key)
+
+    def addMember(self, group_dn, member_dn):
+        """ Record that ``member_dn`` was added to a group """
+        group_key = group_dn.lower()
+
+        with self._lock:
+            record = self._groups.get(group_key)
+
+            if record is None:
+                return
+
+            member_attr = _getMemberAttribute(record)
+            values = record.setdefault(member_attr, [])
+            if member_dn.lower() not in [x.lower() for x in values]:
+                values.append(member_dn)
+            self._members.setdefault(member_dn.lower(), set()).add(group_key)
+
+            if member_dn.lower() in self._groups:
+                self._ancestors = {}
+
+    def removeMember(self, group_dn, member_dn):
+        """ Record that ``member_dn`` was removed from a group """
+        group_key = group_dn.lower()
+        member_key = member_dn.lower()
+
+        with self._lock:
+            record = self._groups.get(group_key)
+
+            if record is not None:
+                for key, values in record.items():
+                    if key.lower() in MEMBER_ATTRIBUTES:
+                        values[:] = [x for x in values
+                                     if x.lower() != member_key]
+
+            self._discard(member_key, group_key)
+
+            if member_key in self._groups:
+                self._ancestors = {}
+
+    def getAncestors(self, group_dn, max_depth):
+        """ Get (cn, DN) tuples for the groups containing a group
+
+        Groups containing those groups are included as well, up to
+        ``max_depth`` levels above ``group_dn``. Every group is visited
+        only once, so cycles in the graph do no harm.
+        """
+        key = (group_dn.lower(), max_depth)
+
+        with self._lock:
+            ancestors = self._ancestors.get(key)
+
+            if ancestors is None:
+                ancestors = self._findAncestors(key[0], max_depth)
+                self._ancestors[key] = ancestors
+
+        return ancestors
+
+    def expand(self, groups, max_depth):
+        """ Add the ancestors of groups to a sequence of (cn, DN) tuples
+
+        The groups passed in come first, duplicates are left out.
+        """
+        result = list(groups)
+        seen = {x[1].lower() for x in result}
+
+        for cn, group_dn in groups:
+            for ancestor in self.getAncestors(group_dn, max_depth):
+                if ancestor[1].lower() not in seen:
+                    seen.add(ancestor[1].lower())
+                    result.append(ancestor)
+
+        return tuple(result)
+
+    def getStatistics(self):
+        """ Get the number of groups and members and the index age """
+        with self._lock:
+            return {'groups': len(self._groups),
+                    'members': len(self._members),
+                    'age': self.getAge()}
+
+    def _findAncestors(self, group_key, max_depth):
+        visited = {group_key}
+        level = [group_key]
+        ancestors = []
+
+        for _ in range(max_depth):
+            parents = []
+
+            for key in level:
+                for parent in sorted(self._members.get(key, ())):
+                    if parent not in visited:
+                        visited.add(parent)
+                        parents.append(parent)
+
+            if not parents:
+                break
+
+            ancestors.extend(_getNames(self._groups[x]) for x in parents)
+            level = parents
+
+        return tuple(ancestors)
+
+    def _discard(self, member_key, group_key):
+        keys = self._members.get(member_key)
+
+        if keys is not None:
+            keys.discard(group_key)
+
+            if not keys:
+                del self._members[member_key]
+
+
+def _copyRecord(record):
+    return {k: list(v) if isinstance(v, list) else v
+            for k, v in record.items()}
+
+
+def _getMembers(record):
+    for key, values in record.items():
+        if key.lower() in MEMBER_ATTRIBUTES:
+            yield from values
+
+
+def _getMemberAttribute(record):
+    member_attr = GROUP_MEMBER_MAP.get(getGroupType(record), 'member')
+
+    for key in record.keys():
+        if key.lower() == member_attr.lower():
+            return key
+
+    return member_attr
+
+
+def _getNames(record):
+    """ Get the (cn, DN) tuple for a group record """
+    group_dn = record['dn']
+    cn = record.get('cn')
+
+    if cn:
+        return cn[0], group_dn
+
+    # NDS oddity, see LDAPUserFolder.getGroups
+    return group_dn.split(',')[0].split('=', 1)[-1], group_dn
@@ -15,6 +15,7 @@
 
 from AccessControl.interfaces import IStandardUserFolder
 from AccessControl.interfaces import IUser
+from zope.interface import Interface
 
 
 class ILDAPUser(IUser):
@@ -259,3 +260,38 @@ class ILDAPUserFolder(IStandardUserFolder):
 
         Permission: *Manage users*
         """
+
+
+class ICacheBackend(Interface):
+    """ A place to keep the user and miscellaneous caches
+
+    Backends are registered with
+    ``Products.LDAPUserFolder.cache.registerCacheBackend`` and created
+    once per process for a location string, like a socket path.
+    """
+
+    def createUserCache(namespace):
+        """ Create a cache for user objects
+
+        The cache must provide the API of
+        ``Products.LDAPUserFolder.cache.UserCache``. Caches created for
+        the same namespace and location share their entries.
+        """
+
+    def createMiscCache(namespace):
+        """ Create a cache for values built from many LDAP records
+
+        The cache must provide the API of
+        ``Products.LDAPUserFolder.cache.MiscCache``.
+        """
+
+    def claimInvalidations(namespace, state, applied):
+        """ Decide if this process applies cache invalidations
+
+        ``state`` is the (generation, serial) tuple of the invalidation
+        log of the user folder with the cache namespace ``namespace``,
+        ``applied`` the last state this process has applied. Returns
+        the state to apply the changes from, or None if there is
+        nothing to do. Backends whose caches are shared by several
+        processes return None to all but one of them.
+        """
@@ -0,0 +1,103 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Cache invalidations shared by all ZEO clients
+"""
+
+from persistent import Persistent
+
+
+class InvalidationLog(Persistent):
+    """ Persistent record of cache invalidations
+
+    Every Zope process keeps its own caches. Clearing all caches
+    increments ``generation``, expiring a single user appends the user
+    name to a log of at most ``max_entries`` entries, numbered by
+    ``serial``. Each process remembers the generation and serial it has
+    applied and compares them with the stored values, which is cheap,
+    to find out what to drop from its caches.
+
+    Concurrent changes are merged on commit instead of raising a
+    ConflictError.
+    """
+
+    max_entries = 1000
+
+    def __init__(self):
+        self.generation = 0
+        self.serial = 0
+        self.entries = ()
+
+    def invalidateAll(self):
+        """ Record that all caches have been cleared """
+        self.generation += 1
+        self.entries = ()
+
+    def invalidateUser(self, user):
+        """ Record that a user has been expired from the caches """
+        self.serial += 1
+        entries = self.entries + ((self.serial, user),)
+        self.entries = entries[-self.max_entries:]
+
+    def getState(self):
+        """ Get the current (generation, serial) tuple """
+        return self.generation, self.serial
+
+    def getChanges(self, state):
+        """ Get the users expired since ``state`` was current
+
+        Returns None if the caches must be cleared completely because
+        they have been cleared meanwhile or the log does not reach back
+        far enough.
+        """
+        generation, serial = state
+
+        if generation != self.generation or serial > self.serial:
+            return None
+
+        if serial == self.serial:
+            return []
+
+        if not self.entries or self.entries[0][0] > serial + 1:
+            return None
+
+        return [user for (number, user) in self.entries if number > serial]
+
+    def _p_resolveConflict(self, old, committed, new):
+        """ Merge concurrent invalidations
+
+        The entries added by ``new`` are appended to those already
+        committed and numbered after them.
+        """
+        old_serial = old.get('serial', 0)
+        old_generation = old.get('generation', 0)
+        added = [user for (number, user) in new.get('entries', ())
+                 if number > old_serial]
+
+        resolved = dict(committed)
+        resolved['generation'] = (committed.get('generation', 0) +
+                                  new.get('generation', 0) - old_generation)
+        serial = committed.get('serial', 0)
+        entries = list(committed.get('entries', ()))
+
+        if new.get('generation', 0) != old_generation:
+            # new cleared everything, keep only what was added later
+            entries = []
+
+        for user in added:
+            serial += 1
+            entries.append((serial, user))
+
+        resolved['serial'] = serial
+        resolved['entries'] = tuple(entries[-self.max_entries:])
+
+        return resolved
@@ -0,0 +1,361 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" A bounded, non-persistent pool of LDAP connections
+"""
+
+import logging
+import queue
+import time
+from threading import Condition
+from threading import Lock
+from threading import Thread
+
+
+logger = logging.getLogger('event.LDAPDelegate')
+
+
+class PoolExhaustedError(Exception):
+    """ No pooled connection became available in time """
+
+
+class Counters:
+    """ A thread-safe collection of named event counters """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counts = {}
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def get(self, name):
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def asDict(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class PooledConnection:
+    """ A LDAP connection object managed by a ConnectionPool
+
+    Besides the raw connection it carries the bookkeeping the pool and
+    the delegate need to decide whether the connection can be trusted.
+    """
+
+    def __init__(self, key, connection, generation=0):
+        self.key = key
+        self.connection = connection
+        self.generation = generation
+        self.created = self.last_used = time.monotonic()
+        self.uses = 0
+        self.failures = 0
+        self.healthy = True
+        # Set by the connection user to whatever identifies the
+        # credentials the connection is currently bound with
+        self.bound_as = None
+
+    def markFailed(self):
+        """ Flag the connection as broken, it will not be reused """
+        self.failures += 1
+        self.healthy = False
+
+    def idleTime(self, now=None):
+        """ Seconds since the connection was last handed back """
+        return (now or time.monotonic()) - self.last_used
+
+
+class ConnectionPool:
+    """ A thread-safe pool of connections keyed by server and identity
+
+    Connections are checked out for exclusive use by one thread and must
+    be checked back in afterwards. ``max_size`` bounds the number of open
+    connections, idle or checked out. Idle connections unused for longer
+    than ``idle_timeout`` seconds are closed.
+    """
+
+    def __init__(self, max_size=10, idle_timeout=300, checkout_timeout=5):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self._idle = {}
+        self._size = 0
+        self._generation = 0
+        self._last_reap = time.monotonic()
+        self._lock = Condition()
+        self._stats = {'created': 0, 'reused': 0, 'discarded': 0,
+                       'evicted': 0, 'reaped': 0}
+
+    def checkout(self, key, factory, fresh=False, prefer=None):
+        """ Get a connection for ``key`` for exclusive use
+
+        An idle connection for the same key is reused if possible and
+        ``fresh`` is False, otherwise ``factory`` is called without
+        arguments to create a new raw connection. Exceptions raised by
+        the factory propagate. Among idle connections those whose
+        ``bound_as`` value equals ``prefer`` are handed out first.
+        """
+        deadline = time.monotonic() + self.checkout_timeout
+
+        with self._lock:
+            self._reapIfDue()
+
+            while True:
+                if not fresh and self._idle.get(key):
+                    return self._reuse(key, prefer)
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    generation = self._generation
+                    break
+
+                if self._evictOldestIdle():
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolExhaustedError(
+                        f'No connection available after waiting '
+                        f'{self.checkout_timeout} seconds')
+                self._lock.wait(remaining)
+
+        try:
+            connection = factory()
+        except BaseException:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+        pooled = PooledConnection(key, connection, generation)
+        pooled.uses = 1
+        with self._lock:
+            self._stats['created'] += 1
+
+        return pooled
+
+    def checkoutIdle(self, key, prefer=None):
+        """ Get an idle connection for ``key`` or None, without waiting """
+        with self._lock:
+            if self._idle.get(key):
+                return self._reuse(key, prefer)
+
+        return None
+
+    def checkin(self, pooled, discard=False):
+        """ Hand back a connection obtained from ``checkout``
+
+        Connections that are flagged as unhealthy, that were created
+        before the pool was last cleared or that are explicitly discarded
+        are closed instead of being kept for reuse.
+        """
+        with self._lock:
+            if discard or \
+               not pooled.healthy or \
+               pooled.generation != self._generation:
+                if pooled.generation == self._generation:
+                    self._size -= 1
+                self._stats['discarded'] += 1
+                self._close(pooled)
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle.setdefault(pooled.key, []).append(pooled)
+            self._lock.notify()
+
+    def reap(self):
+        """ Close all connections that have been idle for too long """
+        with self._lock:
+            self._reap()
+
+    def clear(self):
+        """ Close all idle connections and retire all checked out ones """
+        with self._lock:
+            for idle in self._idle.values():
+                for pooled in idle:
+                    self._close(pooled)
+            self._idle = {}
+            self._size = 0
+            self._generation += 1
+            self._lock.notify_all()
+
+    def getStatistics(self):
+        """ Return a mapping of pool usage figures """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['max_size'] = self.max_size
+            stats['size'] = self._size
+            stats['idle'] = sum(len(x) for x in self._idle.values())
+            stats['in_use'] = stats['size'] - stats['idle']
+
+        return stats
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def _reuse(self, key, prefer=None):
+        """ Hand out an idle connection for ``key``, caller holds the lock """
+        idle = self._idle[key]
+        pooled = self._takeIdle(idle, prefer)
+        if not idle:
+            del self._idle[key]
+        pooled.uses += 1
+        self._stats['reused'] += 1
+
+        return pooled
+
+    def _takeIdle(self, idle, prefer=None):
+        """ Pick the most recently used idle connection, preferred first """
+        if prefer is not None:
+            for i in range(len(idle) - 1, -1, -1):
+                if idle[i].bound_as == prefer:
+                    return idle.pop(i)
+
+        return idle.pop()
+
+    def _reapIfDue(self):
+        """ Reap at most every tenth of the idle timeout """
+        now = time.monotonic()
+        if now - self._last_reap > self.idle_timeout / 10.0:
+            self._reap(now)
+
+    def _reap(self, now=None):
+        """ Close expired idle connections, caller holds the lock """
+        now = now or time.monotonic()
+        self._last_reap = now
+
+        for key, idle in list(self._idle.items()):
+            keep = []
+            for pooled in idle:
+                if pooled.idleTime(now) > self.idle_timeout:
+                    self._size -= 1
+                    self._stats['reaped'] += 1
+                    self._close(pooled)
+                else:
+                    keep.append(pooled)
+
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def _evictOldestIdle(self):
+        """ Close the least recently used idle connection of any key """
+        oldest = None
+        for idle in self._idle.values():
+            # Idle lists are ordered by time of last use
+            if oldest is None or idle[0].last_used < oldest.last_used:
+                oldest = idle[0]
+
+        if oldest is None:
+            return False
+
+        idle = self._idle[oldest.key]
+        idle.pop(0)
+        if not idle:
+            del self._idle[oldest.key]
+        self._size -= 1
+        self._stats['evicted'] += 1
+        self._close(oldest)
+
+        return True
+
+    def _close(self, pooled):
+        """ Unbind a connection, ignoring all errors """
+        try:
+            pooled.connection.unbind_s()
+        except Exception:
+            logger.debug('ConnectionPool: Error closing connection',
+                         exc_info=1)
+
+
+def race(attempts, stagger, loser=None):
+    """ Run callables in parallel threads, return the first result
+
+    The callables from the iterable ``attempts`` are started one by one,
+    each one ``stagger`` seconds after the previous one or as soon as
+    all running attempts have failed. Returns the result of the first
+    attempt that succeeds. Results of attempts succeeding later are
+    passed to ``loser``, attempts that are still running cannot be
+    cancelled. If all attempts fail the last exception is raised.
+    Attempts raising exceptions that do not derive from ``Exception``,
+    like ``SystemExit``, count as failed attempts as well.
+    """
+    attempts = iter(attempts)
+    results = queue.Queue()
+    lock = Lock()
+    finished = []
+    running = 0
+    exc = None
+
+    def run(attempt):
+        try:
+            value = attempt()
+        except BaseException as e:
+            # Always post a result, the caller is waiting for one
+            results.put((False, e))
+            return
+
+        with lock:
+            if not finished:
+                results.put((True, value))
+                return
+
+        if loser is not None:
+            loser(value)
+
+    def startNext():
+        attempt = next(attempts, None)
+        if attempt is None:
+            return False
+        Thread(target=run, args=(attempt,), daemon=True,
+               name='LDAPDelegate connection attempt').start()
+        return True
+
+    more = startNext()
+    if more:
+        running += 1
+
+    while running:
+        try:
+            succeeded, value = results.get(timeout=stagger if more else None)
+        except queue.Empty:
+            more = startNext()
+            if more:
+                running += 1
+            continue
+
+        if succeeded:
+            with lock:
+                finished.append(True)
+            # Attempts that succeeded while we were not looking
+            while True:
+                try:
+                    late_success, late_value = results.get_nowait()
+                except queue.Empty:
+                    break
+                if late_success and loser is not None:
+                    loser(late_value)
+            return value
+
+        running -= 1
+        exc = value
+        if not running and more:
+            more = startNext()
+            if more:
+                running += 1
+
+    if exc is not None:
+        raise exc
@@ -0,0 +1,462 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Server health bookkeeping and server selection strategies
+"""
+
+import atexit
+import logging
+import random
+import time
+from threading import Event
+from threading import Lock
+from threading import Thread
+from threading import current_thread
+from weakref import WeakSet
+
+
+logger = logging.getLogger('event.LDAPDelegate')
+
+# Weight of the newest observation in the moving averages
+SMOOTHING = 0.3
+
+# Health monitors with a running thread, stopped at interpreter exit
+_monitors = WeakSet()
+
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class ServerHealth:
+    """ Non-persistent record of recent results for a single server
+
+    Each record includes a circuit breaker. After ``threshold``
+    consecutive failures the breaker opens and the server is skipped for
+    ``cooldown`` seconds. After that a single trial request is let
+    through, its success closes the breaker again while a failure keeps
+    it open for another cool-down period.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.score = 1.0
+        self.latency = None
+        self.last_success = None
+        self.last_failure = None
+        self.last_probe = None
+        self.opened = None
+        self.trial_started = None
+
+    def recordSuccess(self, latency=None):
+        """ Record a successful operation and its duration in seconds """
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.last_success = time.time()
+        self.score += SMOOTHING * (1.0 - self.score)
+        self.opened = self.trial_started = None
+
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += SMOOTHING * (latency - self.latency)
+
+    def recordFailure(self, threshold=0):
+        """ Record a failure to connect or to complete an operation
+
+        Opens the circuit breaker if ``threshold`` is reached or if the
+        failed request was a trial request. A threshold of 0 disables
+        the circuit breaker.
+        """
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_failure = time.time()
+        self.score -= SMOOTHING * self.score
+
+        if threshold > 0 and (self.opened is not None or
+                              self.consecutive_failures >= threshold):
+            self.opened = time.monotonic()
+            self.trial_started = None
+
+    def isHealthy(self, cooldown=0, now=None):
+        """ A server is healthy unless its circuit breaker is open
+
+        Single failures below the breaker threshold do not count, and
+        the server is healthy again as soon as the cool-down is over.
+        """
+        return self.getState(cooldown, now) != OPEN
+
+    def getState(self, cooldown, now=None):
+        """ Return the circuit breaker state """
+        if self.opened is None:
+            return CLOSED
+
+        if (now or time.monotonic()) - self.opened < cooldown:
+            return OPEN
+
+        return HALF_OPEN
+
+    def allowRequest(self, cooldown, now=None):
+        """ Decide if a request may be sent to the server
+
+        In the half-open state only one trial request is allowed. If its
+        outcome is never recorded another trial is allowed after
+        ``cooldown`` seconds.
+        """
+        now = now or time.monotonic()
+        state = self.getState(cooldown, now)
+
+        if state == CLOSED:
+            return True
+
+        if state == HALF_OPEN and (self.trial_started is None or
+                                   now - self.trial_started >= cooldown):
+            self.trial_started = now
+            return True
+
+        return False
+
+    def getInfo(self, cooldown=0):
+        """ Return a mapping suitable for display """
+        state = self.getState(cooldown)
+        if state == OPEN:
+            retry_in = int(self.opened + cooldown - time.monotonic()) + 1
+        else:
+            retry_in = 0
+
+        return {'uri': self.uri,
+                'breaker': state,
+                'retry_in': retry_in,
+                'successes': self.successes,
+                'failures': self.failures,
+                'consecutive_failures': self.consecutive_failures,
+                'score': round(self.score, 3),
+                'latency': self.latency,
+                'last_success': self.last_success,
+                'last_failure': self.last_failure,
+                'last_probe': self.last_probe,
+                'healthy': state != OPEN}
+
+
+class HealthRegistry:
+    """ Thread-safe collection of ServerHealth records keyed by URI
+
+    ``threshold`` and ``cooldown`` configure the circuit breakers of all
+    records, see ServerHealth.
+    """
+
+    def __init__(self, threshold=0, cooldown=30):
+        self._servers = {}
+        self._lock = Lock()
+        self._turn = 0
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def get(self, uri):
+        """ Get the health record for ``uri``, creating it if needed """
+        with self._lock:
+            health = self._servers.get(uri)
+            if health is None:
+                health = self._servers[uri] = ServerHealth(uri)
+
+        return health
+
+    def recordSuccess(self, uri, latency=None):
+        health = self.get(uri)
+        with self._lock:
+            health.recordSuccess(latency)
+
+    def recordFailure(self, uri):
+        health = self.get(uri)
+        with self._lock:
+            health.recordFailure(self.threshold)
+
+    def recordProbe(self, uri, reachable, latency=None):
+        """ Record the result of a background probe """
+        health = self.get(uri)
+        with self._lock:
+            health.last_probe = time.time()
+            if reachable:
+                health.recordSuccess(latency)
+            else:
+                health.recordFailure(self.threshold)
+
+    def isHealthy(self, uri):
+        """ Is the circuit breaker of ``uri`` closed or half-open? """
+        health = self.get(uri)
+        with self._lock:
+            return health.isHealthy(self.cooldown)
+
+    def allowRequest(self, uri):
+        """ Ask the circuit breaker of ``uri`` for permission """
+        health = self.get(uri)
+        with self._lock:
+            return health.allowRequest(self.cooldown)
+
+    def getInfo(self, uri):
+        health = self.get(uri)
+        with self._lock:
+            return health.getInfo(self.cooldown)
+
+    def nextTurn(self):
+        """ Return an ever-increasing counter for round-robin selection """
+        with self._lock:
+            self._turn += 1
+            return self._turn
+
+    def clear(self):
+        with self._lock:
+            self._servers = {}
+
+
+class HealthMonitor:
+    """ Probe servers periodically from a daemon thread
+
+    ``probe`` is called with a server URI and the keyword arguments
+    configured for it and must raise an exception if the server cannot
+    be reached. Results are recorded in the HealthRegistry ``health``, so
+    failing servers are known before a request runs into them. The
+    probe and its arguments must not reference persistent objects.
+    """
+
+    def __init__(self, health):
+        self.health = health
+        self.interval = 60
+        self._probe = None
+        self._targets = ()
+        self._thread = None
+        self._stopping = Event()
+        self._lock = Lock()
+
+    def configure(self, probe, targets, interval):
+        """ Set the probe function, (URI, arguments) tuples and interval """
+        with self._lock:
+            self._probe = probe
+            self._targets = tuple(targets)
+            self.interval = interval
+
+    def isConfigured(self, probe, targets, interval):
+        with self._lock:
+            return (self._probe == probe and
+                    self._targets == tuple(targets) and
+                    self.interval == interval)
+
+    def start(self):
+        """ Start the monitoring thread if it is not running yet """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            self._stopping = Event()
+            self._thread = Thread(target=self._run, args=(self._stopping,),
+                                  name='LDAPDelegate health monitor',
+                                  daemon=True)
+            self._thread.start()
+        _monitors.add(self)
+
+    def stop(self, timeout=5):
+        """ Stop the monitoring thread and wait for it to finish """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+            self._stopping.set()
+
+        if thread is not None and thread is not current_thread():
+            thread.join(timeout)
+        _monitors.discard(self)
+
+    def isRunning(self):
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def probeAll(self):
+        """ Probe all configured servers once """
+        with self._lock:
+            probe = self._probe
+            targets = self._targets
+
+        for uri, options in targets:
+            start = time.monotonic()
+            try:
+                probe(uri, **dict(options))
+            except Exception as e:
+                logger.debug(f'HealthMonitor: {uri} unreachable ({e})')
+                self.health.recordProbe(uri, False)
+            else:
+                self.health.recordProbe(uri, True, time.monotonic() - start)
+
+    def _run(self, stopping):
+        while not stopping.is_set():
+            try:
+                self.probeAll()
+            except Exception:
+                logger.error('HealthMonitor: Probing failed', exc_info=1)
+            stopping.wait(self.interval)
+
+
+def stopAllMonitors():
+    """ Stop all running health monitor threads """
+    for monitor in list(_monitors):
+        monitor.stop()
+
+
+atexit.register(stopAllMonitors)
+
+
+############################################################
+# Server selection strategy registry
+############################################################
+
+strategy_registry = {}
+
+
+def registerSelectionStrategy(name, func, description=''):
+    """ Register a server selection strategy
+
+    name is a short ID-like moniker for the strategy
+    func is called with a sequence of (connection string, server info)
+    tuples in configured order, the HealthRegistry and a mapping of
+    connection string to weight. It must return all tuples, ordered by
+    preference.
+    description is a more verbose strategy description
+    """
+    strategy_registry[name] = {'name': name, 'func': func,
+                               'description': description}
+
+
+def registeredSelectionStrategies():
+    """ Return the currently-registered server selection strategies """
+    return strategy_registry
+
+
+def getSelectionStrategy(name):
+    """ Get a strategy function by name, defaulting to ordered failover """
+    info = strategy_registry.get(name) or strategy_registry['failover']
+
+    return info['func']
+
+
+def allowedServers(candidates, health):
+    """ Yield the candidates, those refused by their circuit breaker last
+
+    The breaker is only asked when the caller gets to a server, so a
+    half-open breaker lets its trial request through to a server that
+    is actually used. Servers refused by their breaker are still tried
+    as a last resort once all other servers failed, so open breakers
+    never leave no server to try.
+    """
+    refused = []
+
+    for candidate in candidates:
+        if health.allowRequest(candidate[0]):
+            yield candidate
+        else:
+            logger.debug(f'Circuit breaker open, trying {candidate[0]} last')
+            refused.append(candidate)
+
+    yield from refused
+
+
+def _splitByHealth(candidates, health):
+    """ Separate healthy servers from servers with an open breaker
+
+    Servers whose circuit breaker cool-down has passed count as healthy
+    again, so they get their trial request in their normal position.
+    Failed servers are sorted by score, so the server that failed the
+    least is tried first.
+    """
+    healthy = []
+    failed = []
+
+    for candidate in candidates:
+        if health.isHealthy(candidate[0]):
+            healthy.append(candidate)
+        else:
+            failed.append(candidate)
+
+    failed.sort(key=lambda x: -health.get(x[0]).score)
+
+    return healthy, failed
+
+
+def orderFailover(candidates, health, weights):
+    """ Configured order, servers with an open breaker are tried last """
+    healthy, failed = _splitByHealth(candidates, health)
+
+    return healthy + failed
+
+
+def orderRoundRobin(candidates, health, weights):
+    """ Rotate the starting server with every connection """
+    healthy, failed = _splitByHealth(candidates, health)
+
+    if healthy:
+        start = health.nextTurn() % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+
+    return healthy + failed
+
+
+def orderWeighted(candidates, health, weights):
+    """ Random order biased by configured weight and health score """
+    healthy, failed = _splitByHealth(candidates, health)
+    ordered = []
+
+    while healthy:
+        shares = [max(weights.get(x[0], 1), 0) * health.get(x[0]).score
+                  for x in healthy]
+        total = sum(shares)
+
+        if total <= 0:
+            ordered.extend(healthy)
+            break
+
+        pick = random.uniform(0, total)
+        for i, share in enumerate(shares):
+            pick -= share
+            if pick <= 0:
+                break
+
+        ordered.append(healthy.pop(i))
+
+    return ordered + failed
+
+
+def orderLatency(candidates, health, weights):
+    """ Fastest observed server first, unmeasured servers before others """
+    healthy, failed = _splitByHealth(candidates, health)
+
+    def latency(candidate):
+        value = health.get(candidate[0]).latency
+        return -1 if value is None else value
+
+    healthy.sort(key=latency)
+
+    return healthy + failed
+
+
+registerSelectionStrategy('failover', orderFailover,
+                          'Ordered failover: Use servers in the configured '
+                          'order')
+registerSelectionStrategy('roundrobin', orderRoundRobin,
+                          'Round robin: Spread connections over all servers')
+registerSelectionStrategy('weighted', orderWeighted,
+                          'Weighted: Spread connections according to the '
+                          'server weights')
+registerSelectionStrategy('latency', orderLatency,
+                          'Least latency: Prefer the fastest server')
@@ -0,0 +1,703 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" A cache shared by several processes on one host
+
+The cache server keeps entries in memory and listens on a UNIX domain
+socket, start it with::
+
+  ldapuserfolder-cacheserver /path/to/cache.sock
+
+Zope processes using the ``socket`` cache backend with the same socket
+path share their cache entries. Requests are encoded with ``marshal``
+so the server never unpickles anything. Cached values are pickled by
+the clients. Everyone who can write to the socket can put values into
+the cache, so the socket is only accessible for the user running the
+server. User passwords are never sent to the server, cached users carry
+a salted hash of their password instead.
+"""
+
+import copy
+import hashlib
+import hmac
+import logging
+import marshal
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from zope.interface import implementer
+
+from dataflake.cache.interfaces import ITimeoutCache
+
+from .cache import CacheStatistics
+from .cache import registerCacheBackend
+from .interfaces import ICacheBackend
+
+
+logger = logging.getLogger('event.LDAPUserFolder')
+HEADER = struct.Struct('!I')
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# PBKDF2 iterations for the password hashes stored with cached users
+VERIFIER_ITERATIONS = 10000
+
+
+def sendMessage(sock, message):
+    """ Send a marshalled message with a length header """
+    data = marshal.dumps(message)
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receiveMessage(sock):
+    """ Receive a message, returns None if the peer closed the socket """
+    header = _receive(sock, HEADER.size)
+    if header is None:
+        return None
+
+    length = HEADER.unpack(header)[0]
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f'Message of {length} bytes is too large')
+
+    data = _receive(sock, length)
+    if data is None:
+        return None
+
+    return marshal.loads(data)
+
+
+def makeVerifier(password):
+    """ Create a (salt, hash) tuple to store instead of ``password`` """
+    salt = os.urandom(16)
+
+    return salt, _hashPassword(password, salt)
+
+
+def _hashPassword(password, salt):
+    if isinstance(password, str):
+        password = password.encode('UTF-8')
+
+    return hashlib.pbkdf2_hmac('sha256', password, salt, VERIFIER_ITERATIONS)
+
+
+def _receive(sock, length):
+    chunks = []
+
+    while length:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        length -= len(chunk)
+
+    return b''.join(chunks)
+
+
+############################################################
+# Server
+############################################################
+
+class Namespace:
+    """ The entries of one cache in the server
+
+    Entries are kept in the order they were set. They are removed when
+    their timeout and grace period are over, and the oldest entries are
+    evicted when the limits are exceeded.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.size = 0
+        self.keep = 600
+        self.max_entries = 0
+        self.max_size = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, now, timeout, grace=0):
+        """ Get data set less than ``timeout`` seconds ago, or with a
+        grace period data that expired less than ``grace`` seconds ago
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        created, data = entry
+        age = now - created
+        if grace:
+            return data if timeout <= age < timeout + grace else None
+
+        return data if age < timeout else None
+
+    def set(self, key, data, now, keep, max_entries, max_size):
+        self.delete(key)
+        self.entries[key] = (now, data)
+        self.size += len(data)
+        self.keep = keep
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sweep(now)
+
+        while self.entries and \
+            ((self.max_entries and len(self.entries) > self.max_entries) or
+             (self.max_size and self.size > self.max_size)):
+            key, (created, data) = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return False
+
+        self.size -= len(entry[1])
+
+        return True
+
+    def clear(self):
+        count = len(self.entries)
+        self.entries = OrderedDict()
+        self.size = 0
+
+        return count
+
+    def sweep(self, now):
+        entries = self.entries
+
+        while entries:
+            key, (created, data) = next(iter(entries.items()))
+            if now - created < self.keep:
+                break
+            self.delete(key)
+            self.expirations += 1
+
+    def stats(self, now):
+        self.sweep(now)
+
+        return {'entries': len(self.entries), 'size': self.size,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+
+class CacheServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """ Serve cache namespaces over a UNIX domain socket """
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.path = path
+        self.namespaces = {}
+        self.claims = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            # Only replace a stale socket, not a running server
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f'A cache server is running on {path}')
+            finally:
+                probe.close()
+
+        old_umask = os.umask(0o177)
+        try:
+            super().__init__(path, CacheRequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def dispatch(self, request):
+        """ Run a request tuple of operation name, namespace and arguments
+        """
+        operation, namespace, args = request[0], request[1], request[2:]
+        now = time.monotonic()
+
+        with self.lock:
+            if operation == 'claim':
+                # Only the first client to ask applies an invalidation
+                state = tuple(args[0])
+                applied = self.claims.get(namespace, (0, 0))
+                if state <= applied:
+                    return None
+                self.claims[namespace] = state
+                return applied
+
+            if operation == 'clear':
+                ns = self.namespaces.pop(namespace, None)
+                return ns.clear() if ns is not None else 0
+
+            ns = self.namespaces.get(namespace)
+            if ns is None and operation != 'set':
+                # Nothing was ever stored in this namespace
+                return {'delete': False, 'items': []}.get(operation)
+            elif ns is None:
+                ns = self.namespaces[namespace] = Namespace()
+
+            if operation == 'get':
+                return ns.get(args[0], now, *args[1:])
+            elif operation == 'set':
+                return ns.set(args[0], args[1], now, *args[2:])
+            elif operation == 'delete':
+                return ns.delete(args[0])
+            elif operation == 'items':
+                ns.sweep(now)
+                return [(key, data) for key, (created, data)
+                        in ns.entries.items() if now - created < args[0]]
+            elif operation == 'stats':
+                return ns.stats(now)
+            elif operation == 'resetstats':
+                ns.evictions = ns.expirations = 0
+                return None
+
+        raise ValueError(f'Unknown operation {operation}')
+
+
+class CacheRequestHandler(socketserver.BaseRequestHandler):
+    """ Answer requests until the client closes the connection """
+
+    def handle(self):
+        while True:
+            try:
+                request = receiveMessage(self.request)
+                if request is None:
+                    return
+                response = (True, self.server.dispatch(request))
+            except (OSError, EOFError):
+                return
+            except Exception as e:
+                logger.exception('CacheServer: Request failed')
+                response = (False, str(e))
+
+            try:
+                sendMessage(self.request, response)
+            except OSError:
+                return
+
+
+def main(args=None):
+    """ Run a cache server on the socket path given on the command line """
+    args = sys.argv[1:] if args is None else args
+    if len(args) != 1:
+        sys.stderr.write('Usage: ldapuserfolder-cacheserver SOCKET_PATH\n')
+        return 1
+
+    logging.basicConfig(level=logging.INFO)
+    server = CacheServer(args[0])
+    logger.info(f'CacheServer: Listening on {args[0]}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return 0
+
+
+############################################################
+# Client
+############################################################
+
+class CacheClient:
+    """ Send requests to a cache server
+
+    Each thread uses its own connection. After a failed request the
+    server is not asked again for ``retry_delay`` seconds, requests fail
+    right away instead and callers treat them like cache misses.
+    """
+
+    def __init__(self, path, timeout=1.0, retry_delay=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+        self._down_until = 0
+
+    def call(self, *request):
+        """ Send a request and return a tuple (success, result) """
+        if time.monotonic() < self._down_until:
+            return False, None
+
+        try:
+            sock = self._connection()
+            sendMessage(sock, request)
+            response = receiveMessage(sock)
+            if response is None:
+                raise OSError('Connection closed by the cache server')
+        except (OSError, ValueError, EOFError) as e:
+            self._close()
+            self._down_until = time.monotonic() + self.retry_delay
+            logger.warning(f'CacheClient: {self.path} unavailable ({e})')
+            return False, None
+
+        success, result = response
+        if not success:
+            logger.error(f'CacheClient: Request failed ({result})')
+
+        return success, result
+
+    def _connection(self):
+        sock = getattr(self._local, 'sock', None)
+
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+            self._local.sock = sock
+
+        return sock
+
+    def _close(self):
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+
+        if sock is not None:
+            sock.close()
+
+
+@implementer(ICacheBackend)
+class SocketCacheBackend:
+    """ Keep cache entries in a cache server shared by several processes
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.client = CacheClient(location)
+
+    def createUserCache(self, namespace):
+        return SharedUserCache(self.client, namespace)
+
+    def createMiscCache(self, namespace):
+        return SharedMiscCache(self.client, namespace)
+
+    def claimInvalidations(self, namespace, state, applied):
+        """ Apply each invalidation to the shared caches only once
+
+        The server remembers the newest state claimed for ``namespace``.
+        The first process to claim a newer state gets the previously
+        claimed state back and applies the changes since, all others
+        get None.
+        """
+        success, result = self.client.call('claim', namespace, tuple(state))
+
+        if not success:
+            return applied
+
+        return None if result is None else tuple(result)
+
+
+class SharedCache(CacheStatistics):
+    """ Base class for caches kept in a cache server
+
+    Hits, misses, inserts and invalidations are counted in each process,
+    evictions and expirations by the server.
+    """
+
+    def __init__(self, client, namespace):
+        self.client = client
+        self.namespace = namespace
+        self.timeout = 600
+
+    def _call(self, operation, *args):
+        success, result = self.client.call(operation, self.namespace, *args)
+
+        return result if success else None
+
+    def _load(self, data):
+        if data is None:
+            return None
+
+        try:
+            return pickle.loads(data)
+        except Exception:
+            logger.exception(f'{self.__class__.__name__}: Cannot load entry')
+            return None
+
+    def _set(self, key, value, keep, max_entries=0, max_size=0):
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.exception(f'{self.__class__.__name__}: Cannot store '
+                             f'{key!r}')
+            return
+
+        self._call('set', key, data, keep, max_entries, max_size)
+        self.inserts += 1
+
+    def _serverStatistics(self):
+        return self._call('stats') or {'entries': 0, 'size': 0,
+                                       'evictions': 0, 'expirations': 0}
+
+    @property
+    def evictions(self):
+        return self._serverStatistics()['evictions']
+
+    @property
+    def expirations(self):
+        return self._serverStatistics()['expirations']
+
+    def getStatistics(self):
+        server = self._serverStatistics()
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'inserts': self.inserts,
+                'evictions': server['evictions'],
+                'expirations': server['expirations'],
+                'invalidations': self.invalidations,
+                'entries': server['entries'],
+                'size': server['size'],
+                'hit_ratio': lookups and float(self.hits) / lookups or 0.0}
+
+    def resetStatistics(self):
+        self.hits = self.misses = self.inserts = self.invalidations = 0
+        self._call('resetstats')
+
+    def getSize(self):
+        """ Get the size of all entries in bytes """
+        return self._serverStatistics()['size']
+
+    def __len__(self):
+        return self._serverStatistics()['entries']
+
+    def invalidate(self, id=None):
+        """ Invalidate the given key, or all entries if no key is passed """
+        if id is not None:
+            if self._call('delete', self._key(id)):
+                self.invalidations += 1
+        else:
+            self.invalidations += self._call('clear') or 0
+
+    def _key(self, id):
+        return id
+
+    def items(self):
+        """ Return (key, object) tuples for all valid entries """
+        items = [(key, self._load(data)) for key, data
+                 in self._call('items', self.timeout) or ()]
+
+        return [x for x in items if x[1] is not None]
+
+    def setTimeout(self, timeout):
+        """ Set a timeout value in seconds """
+        self.timeout = timeout
+
+    def getTimeout(self):
+        """ Get the timeout value """
+        return self.timeout
+
+
+@implementer(ITimeoutCache)
+class SharedUserCache(SharedCache):
+    """ A cache for user objects kept in a cache server
+
+    Provides the API of ``UserCache``. Entries are evicted in the order
+    they were stored instead of least recently used first.
+
+    Users are stored without their password, together with a salted
+    hash of it. Users retrieved with the correct password get it back,
+    all others have the password ``undef`` like users that did not log
+    in. Hashes that matched are remembered in each process, so cache
+    hits do not compute the hash every time.
+    """
+
+    max_verified = 1000
+
+    def __init__(self, client, namespace):
+        super().__init__(client, namespace)
+        self.grace = 0
+        self.max_entries = 0
+        self.max_size = 0
+        self._secret = os.urandom(32)
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, id):
+        return id.lower()
+
+    def set(self, id, object):
+        """ Store an object """
+        get_password = getattr(object, '_getPassword', None)
+        password = get_password() if get_password is not None else None
+
+        if password and password != 'undef':
+            verifier = makeVerifier(password)
+            object = copy.copy(object)
+            object._setPassword('undef')
+        else:
+            verifier = None
+
+        self._set(self._key(id), (verifier, object),
+                  self.timeout + self.grace, self.max_entries, self.max_size)
+
+    def get(self, id, password=None):
+        """ Retrieve a cached object if it is valid """
+        user = self._loadUser(self._call('get', self._key(id), self.timeout),
+                              password)
+
+        if not user:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return user
+
+    def getStale(self, id, password=None):
+        """ Retrieve a cached object that expired less than ``grace``
+        seconds ago, or None
+        """
+        if not self.grace:
+            return None
+
+        return self._loadUser(self._call('get', self._key(id), self.timeout,
+                                         self.grace), password)
+
+    def _loadUser(self, data, password):
+        """ Load a stored user, check and restore its password """
+        entry = self._load(data)
+
+        if not isinstance(entry, tuple) or len(entry) != 2:
+            # Nothing stored, or an entry in an older format
+            return None
+
+        verifier, user = entry
+
+        if password is None or not user:
+            return user
+
+        if verifier is None:
+            return user if password == user._getPassword() else None
+
+        if not self._checkPassword(verifier, password):
+            return None
+
+        user._setPassword(password)
+
+        return user
+
+    def _checkPassword(self, verifier, password):
+        """ Compare ``password`` with a stored (salt, hash) tuple """
+        salt, digest = verifier
+        if isinstance(password, str):
+            password = password.encode('UTF-8')
+        # Keyed with a secret that never leaves this process
+        known = hmac.new(self._secret, salt + digest + password,
+                         'sha256').digest()
+
+        with self._lock:
+            if known in self._verified:
+                self._verified.move_to_end(known)
+                return True
+
+        if not hmac.compare_digest(_hashPassword(password, salt), digest):
+            return False
+
+        with self._lock:
+            self._verified[known] = True
+            while len(self._verified) > self.max_verified:
+                self._verified.popitem(last=False)
+
+        return True
+
+    def items(self):
+        """ Return (key, object) tuples for all valid entries """
+        items = [(key, self._loadUser(data, None)) for key, data
+                 in self._call('items', self.timeout) or ()]
+
+        return [x for x in items if x[1] is not None]
+
+    def setLimits(self, max_entries=0, max_size=0):
+        """ Set the maximum number of entries and size in bytes """
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+    def getLimits(self):
+        """ Get the maximum number of entries and size in bytes """
+        return self.max_entries, self.max_size
+
+    def setGrace(self, grace):
+        """ Set how many seconds expired entries are kept for ``getStale`` """
+        self.grace = grace
+
+    def sweep(self):
+        """ Expired entries are removed by the server """
+        return 0
+
+    def getCache(self):
+        """ Get valid cache records """
+        return [x for x in self.values() if x]
+
+    def keys(self):
+        """ Return all keys of valid entries """
+        return [x[0] for x in self.items()]
+
+    def values(self):
+        """ Return all valid cached objects """
+        return [x[1] for x in self.items()]
+
+
+@implementer(ITimeoutCache)
+class SharedMiscCache(SharedCache):
+    """ A cache for values built from many LDAP records kept in a cache
+    server, provides the API of ``MiscCache``
+    """
+
+    def set(self, key, value):
+        """ Store a key/value pair """
+        self._set(key, value, self.timeout)
+
+    def get(self, key, default=None):
+        """ Get the value for a key, or ``default`` if it has expired """
+        value = self._load(self._call('get', key, self.timeout))
+
+        if value is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+
+        return value
+
+    def keys(self):
+        """ Return all cache keys """
+        return [x[0] for x in self.items()]
+
+    def values(self):
+        """ Return all cached values """
+        return [x[1] for x in self.items()]
+
+
+registerCacheBackend('socket', SocketCacheBackend,
+                     'Cache server on a UNIX domain socket')
@@ -0,0 +1,393 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the AsyncLDAPDelegate class
+"""
+
+import asyncio
+import threading
+import unittest
+
+from .base.testcase import LDAPTest
+from .config import defaults
+from .config import user
+from .config import user2
+
+
+dg = defaults.get
+
+
+class AsyncFakeLDAPConnection:
+    """ Wraps a fake connection to add the asynchronous API
+
+    Results only become available on the second poll.
+    """
+
+    instances = []
+
+    def __init__(self, uri, *args, **kw):
+        from dataflake.fakeldap import FakeLDAPConnection
+        self._conn = FakeLDAPConnection(uri, *args, **kw)
+        self._results = {}
+        self._polled = set()
+        self._msgid = 0
+        self.log = []
+        self.fail_next = None
+        self.instances.append(self)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _send(self, method, *args):
+        self._msgid += 1
+        self.log.append(('send', self._msgid))
+
+        if self.fail_next is not None:
+            res, self.fail_next = self.fail_next, None
+        else:
+            try:
+                res = getattr(self._conn, method)(*args)
+            except Exception as e:
+                res = e
+        self._results[self._msgid] = res
+
+        return self._msgid
+
+    def search_ext(self, base, scope, filter, attrs):
+        return self._send('search_s', base, scope, filter, attrs)
+
+    def add_ext(self, dn, attrs):
+        return self._send('add_s', dn, attrs)
+
+    def modify_ext(self, dn, mod_list):
+        return self._send('modify_s', dn, mod_list)
+
+    def delete_ext(self, dn):
+        return self._send('delete_s', dn)
+
+    def rename(self, dn, new_rdn):
+        return self._send('modrdn_s', dn, new_rdn)
+
+    def result3(self, msgid, all=1, timeout=None):
+        import ldap
+        if timeout == 0 and msgid not in self._polled:
+            self._polled.add(msgid)
+            return None, None, None, None
+
+        self.log.append(('result', msgid))
+        res = self._results.pop(msgid)
+        if isinstance(res, Exception):
+            raise res
+
+        return ldap.RES_SEARCH_RESULT, res, msgid, []
+
+
+class TestAsyncLDAPDelegate(LDAPTest):
+
+    def setUp(self):
+        from .. import LDAPDelegate as module
+        from ..AsyncLDAPDelegate import AsyncLDAPDelegate
+        super().setUp()
+        module.c_factory = AsyncFakeLDAPConnection
+        AsyncFakeLDAPConnection.instances = []
+
+        # Switch the configured folder to the asynchronous delegate
+        acl = self.folder.acl_users
+        old = acl._delegate
+        old._clearPools()
+        acl._delegate = AsyncLDAPDelegate()
+        acl._delegate.__setstate__(old.__getstate__())
+
+    def tearDown(self):
+        from dataflake.fakeldap import FakeLDAPConnection
+
+        from .. import LDAPDelegate as module
+        delegate = self.folder.acl_users._delegate
+        delegate._clearPools()
+        delegate._getEventLoop().stop()
+        module.c_factory = FakeLDAPConnection
+        super().tearDown()
+
+    def test_registered(self):
+        from ..AsyncLDAPDelegate import AsyncLDAPDelegate
+        from ..utils import _createDelegate
+        from ..utils import registeredDelegates
+
+        self.assertIn('Asynchronous LDAP delegate', registeredDelegates())
+        delegate = _createDelegate('Asynchronous LDAP delegate')
+        self.assertIsInstance(delegate, AsyncLDAPDelegate)
+
+    def test_sync_facade(self):
+        acl = self.folder.acl_users
+        for kwargs in (user, user2):
+            self.assertFalse(acl.manage_addUser(REQUEST=None, kwargs=kwargs))
+
+        user_ob = acl.getUserById(user.get(dg('uid_attr')))
+        self.assertIsNotNone(user_ob)
+        self.assertEqual(acl._delegate.modify(user_ob.getUserDN(),
+                                              attrs={'sn': ['Changed']}), '')
+        self.assertEqual(acl._delegate.delete(user_ob.getUserDN()), '')
+        res = acl._delegate.search(dg('users_base'), acl._delegate.ONELEVEL)
+        self.assertEqual(res['size'], 1)
+        self.assertTrue(acl._delegate._getEventLoop().isRunning())
+
+    def test_coroutines(self):
+        delegate = self.folder.acl_users._delegate
+        base = dg('users_base')
+
+        async def run():
+            msg = await delegate.insert_async(base, 'cn=async',
+                                              {'objectClass': ['person'],
+                                               'cn': ['async'],
+                                               'sn': ['Async']})
+            self.assertEqual(msg, '')
+            msg = await delegate.modify_async(f'cn=async,{base}',
+                                              attrs={'sn': ['Other']})
+            self.assertEqual(msg, '')
+            res = await delegate.search_async(f'cn=async,{base}',
+                                              delegate.BASE)
+            self.assertEqual(res['results'][0]['sn'], ['Other'])
+            self.assertEqual(await delegate.delete_async(f'cn=async,{base}'),
+                             '')
+            return await delegate.search_async(f'cn=async,{base}',
+                                               delegate.BASE)
+
+        res = asyncio.run(run())
+        self.assertEqual(res['size'], 0)
+        self.assertTrue(res['exception'])
+
+    def test_requests_multiplexed(self):
+        acl = self.folder.acl_users
+        delegate = acl._delegate
+        for kwargs in (user, user2):
+            acl.manage_addUser(REQUEST=None, kwargs=kwargs)
+        queries = [{'base': dg('users_base'), 'scope': delegate.ONELEVEL,
+                    'filter': '(cn=%s)' % x}
+                   for x in ('test', 'test2', 'missing')] * 10
+
+        async def run():
+            AsyncFakeLDAPConnection.instances = []
+            return await delegate.search_many_async(queries)
+
+        results = asyncio.run(run())
+        self.assertEqual([x['size'] for x in results], [1, 1, 0] * 10)
+
+        # All searches went over one connection and were sent before
+        # the first result was read
+        connections = AsyncFakeLDAPConnection.instances
+        self.assertEqual(len(connections), 1)
+        self.assertEqual([x[0] for x in connections[0].log],
+                         ['send'] * 30 + ['result'] * 30)
+
+    def test_connection_lost_retried(self):
+        import ldap
+
+        delegate = self.folder.acl_users._delegate
+
+        async def run():
+            res = await delegate.search_async(dg('users_base'),
+                                              delegate.BASE)
+            self.assertEqual(res['size'], 1)
+            connection = AsyncFakeLDAPConnection.instances[-1]
+            connection.fail_next = ldap.SERVER_DOWN('Gone')
+            return await delegate.search_async(dg('users_base'),
+                                               delegate.BASE)
+
+        res = asyncio.run(run())
+        self.assertEqual(res['exception'], '')
+        self.assertEqual(res['size'], 1)
+        self.assertEqual(len(AsyncFakeLDAPConnection.instances), 2)
+        health = delegate.getServerHealth()[0]
+        self.assertEqual(health['failures'], 1)
+
+    def test_partial_results(self):
+        import ldap
+
+        delegate = self.folder.acl_users._delegate
+
+        async def run():
+            await delegate.search_async(dg('users_base'), delegate.BASE)
+            connection = AsyncFakeLDAPConnection.instances[-1]
+            connection.fail_next = ldap.PARTIAL_RESULTS({})
+            return await delegate.search_async(dg('users_base'),
+                                               delegate.BASE)
+
+        res = asyncio.run(run())
+        self.assertEqual(res['exception'], '')
+        self.assertEqual(res['size'], 0)
+
+    def test_referral_channels(self):
+        import ldap
+
+        delegate = self.folder.acl_users._delegate
+        target = 'ldap://referral.example.com'
+
+        async def run():
+            await delegate.search_async(dg('users_base'), delegate.BASE)
+            connection = AsyncFakeLDAPConnection.instances[-1]
+            connection.fail_next = ldap.REFERRAL(
+                {'info': f'Referral:\n{target}/dc=org'})
+            return await delegate.search_async(dg('users_base'),
+                                               delegate.BASE)
+
+        res = asyncio.run(run())
+        self.assertEqual(res['exception'], '')
+        self.assertEqual(res['size'], 1)
+        self.assertEqual(len(delegate._getChannels()), 1)
+        referrals = delegate._getChannels('referral')
+        self.assertEqual(len(referrals), 1)
+        self.assertEqual(referrals.max_size, delegate.referral_pool_size)
+        stats = delegate.getConnectionStatistics()
+        self.assertEqual(stats['counters']['referral_hops'], 1)
+
+    def test_operations_detached(self):
+        delegate = self.folder.acl_users._delegate
+        operations = delegate._getOperations()
+
+        self.assertEqual(operations.rdn_attr, delegate.rdn_attr)
+        self.assertEqual(operations.read_only, delegate.read_only)
+        for value in vars(operations).values():
+            self.assertIsNot(value, delegate)
+        for conn_string, server in operations.candidates:
+            self.assertFalse([x for x in delegate.getServers()
+                              if x is server])
+
+    def test_operation_timeout(self):
+        delegate = self.folder.acl_users._delegate
+        operations = delegate._getOperations()
+        operations.candidates = [('ldap://a', {'conn_timeout': 5,
+                                               'op_timeout': 10}),
+                                 ('ldap://b', {'conn_timeout': 5,
+                                               'op_timeout': 20})]
+        self.assertEqual(operations.getTimeout(), 60)
+        self.assertEqual(operations.getTimeout(requests=3), 180)
+
+        operations.candidates[1][1]['op_timeout'] = -1
+        self.assertIsNone(operations.getTimeout())
+
+
+class TestEventLoopThread(unittest.TestCase):
+
+    def test_run_timeout(self):
+        import ldap
+
+        from ..AsyncLDAPDelegate import EventLoopThread
+        loop_thread = EventLoopThread()
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        try:
+            with self.assertRaises(ldap.TIMEOUT):
+                loop_thread.run(slow(), timeout=0.05)
+            self.assertEqual(loop_thread.run(asyncio.sleep(0, 'done'), 1),
+                             'done')
+        finally:
+            loop_thread.stop()
+
+        self.assertEqual(cancelled, [True])
+
+    def test_channel_unbound_in_thread(self):
+        from ..AsyncLDAPDelegate import Channel
+        threads = []
+
+        class Connection:
+
+            def unbind_s(self):
+                threads.append(threading.current_thread())
+
+        async def run():
+            channel = Channel('key', Connection(), asyncio.get_running_loop())
+            channel.close()
+            self.assertFalse(channel.healthy)
+            return threading.current_thread()
+
+        loop_thread = asyncio.run(run())
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], loop_thread)
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.pending = 0
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestChannelRegistry(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from ..AsyncLDAPDelegate import ChannelRegistry
+        return ChannelRegistry(*args, **kw)
+
+    def _addChannel(self, registry, loop, key, now):
+        channel = FakeChannel()
+        task = loop.create_future()
+        task.set_result(channel)
+        registry.set(loop, key, task, now=now)
+        return channel
+
+    def test_least_recently_used_closed(self):
+        registry = self._makeOne(max_size=2, idle_timeout=60)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            first = self._addChannel(registry, loop, 'first', 0)
+            second = self._addChannel(registry, loop, 'second', 1)
+            self.assertIsNotNone(registry.get(loop, 'first', now=2))
+            self._addChannel(registry, loop, 'third', 3)
+            await asyncio.sleep(0)
+            return first, second
+
+        first, second = asyncio.run(run())
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertEqual(len(registry), 2)
+
+    def test_busy_channels_kept(self):
+        registry = self._makeOne(max_size=1, idle_timeout=60)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            first = self._addChannel(registry, loop, 'first', 0)
+            first.pending = 1
+            self._addChannel(registry, loop, 'second', 1)
+            await asyncio.sleep(0)
+            return first
+
+        first = asyncio.run(run())
+        self.assertFalse(first.closed)
+        self.assertEqual(len(registry), 2)
+
+    def test_idle_channels_closed(self):
+        registry = self._makeOne(max_size=10, idle_timeout=60)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            first = self._addChannel(registry, loop, 'first', 0)
+            self._addChannel(registry, loop, 'second', 50)
+            self.assertIsNotNone(registry.get(loop, 'second', now=100))
+            self.assertIsNone(registry.get(loop, 'first', now=100))
+            await asyncio.sleep(0)
+            return first
+
+        first = asyncio.run(run())
+        self.assertTrue(first.closed)
+        self.assertEqual(len(registry), 1)
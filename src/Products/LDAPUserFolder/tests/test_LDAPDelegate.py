@@ -15,6 +15,14 @@
 
 import unittest
 
+from .base.testcase import LDAPTest
+from .config import defaults
+from .config import user
+from .config import user2
+
+
+dg = defaults.get
+
 
 class TestSimple(unittest.TestCase):
 
@@ -40,3 +48,522 @@ class TestSimple(unittest.TestCase):
 
         self.assertEqual(delegate._clean_dn(''), '')
         self.assertEqual(delegate._clean_dn(None), '')
+
+
+class TestConnectionPooling(LDAPTest):
+
+    def test_connection_reused(self):
+        delegate = self.folder.acl_users._delegate
+        delegate.search(dg('users_base'), delegate.BASE)
+        delegate.search(dg('users_base'), delegate.BASE)
+
+        stats = delegate._getPool().getStatistics()
+        self.assertEqual(stats['size'], 1)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertTrue(stats['reused'] >= 1)
+
+    def test_separate_pools_for_manager_and_users(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        delegate = acl._delegate
+        user_dn = 'cn=test,%s' % dg('users_base')
+
+        delegate.search(dg('users_base'), delegate.BASE)
+        res = delegate.search(user_dn, delegate.BASE, bind_dn=user_dn,
+                              bind_pwd=user.get('user_pw'))
+        self.assertEqual(res['size'], 1)
+        self.assertEqual(len(delegate._getPool('manager')), 1)
+        self.assertEqual(len(delegate._getPool('user')), 1)
+
+    def test_no_bind_if_already_bound(self):
+        delegate = self.folder.acl_users._delegate
+        pooled = self._idleConnection(delegate)
+        binds = []
+        original = pooled.connection.simple_bind_s
+
+        def simple_bind_s(*args, **kw):
+            binds.append(args)
+            return original(*args, **kw)
+
+        pooled.connection.simple_bind_s = simple_bind_s
+        delegate.search(dg('users_base'), delegate.BASE)
+        delegate.search(dg('users_base'), delegate.BASE)
+        self.assertEqual(binds, [])
+
+    def test_rebind_if_identity_changes(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        delegate = acl._delegate
+        user_dn = 'cn=test,%s' % dg('users_base')
+        pwd = user.get('user_pw')
+
+        delegate.search(user_dn, delegate.BASE, bind_dn=user_dn,
+                        bind_pwd=pwd)
+        pool = delegate._getPool('user')
+        pooled = pool.checkout(list(pool._idle.keys())[0], None)
+        pool.checkin(pooled)
+        self.assertEqual(pooled.bound_as[0], user_dn)
+
+        # A wrong password for the same DN must not reuse the bind
+        res = delegate.search(user_dn, delegate.BASE, bind_dn=user_dn,
+                              bind_pwd='wrong')
+        self.assertTrue(res['exception'])
+        self.assertIsNone(pooled.bound_as)
+
+    def test_server_changes_clear_pool(self):
+        delegate = self.folder.acl_users._delegate
+        delegate.search(dg('users_base'), delegate.BASE)
+        self.assertEqual(len(delegate._getPool()), 1)
+
+        delegate.addServer('ldap.example.com')
+        self.assertEqual(len(delegate._getPool()), 0)
+
+    def _idleConnection(self, delegate):
+        """ Warm up the pool and return the idle pooled connection """
+        delegate.search(dg('users_base'), delegate.BASE)
+        pool = delegate._getPool()
+        pooled = pool.checkout(list(pool._idle.keys())[0], None)
+        pool.checkin(pooled)
+
+        return pooled
+
+    def test_recently_used_connection_not_probed(self):
+        delegate = self.folder.acl_users._delegate
+        pooled = self._idleConnection(delegate)
+        searches = []
+        original = pooled.connection.search_s
+
+        def search_s(*args, **kw):
+            searches.append(args)
+            return original(*args, **kw)
+
+        pooled.connection.search_s = search_s
+        delegate.search(dg('users_base'), delegate.BASE)
+        self.assertEqual(len(searches), 1)
+
+        # After sitting idle past the threshold the connection is probed
+        delegate.health_check_interval = 0
+        delegate.search(dg('users_base'), delegate.BASE)
+        self.assertEqual(len(searches), 3)
+
+    def test_operation_retried_on_lost_connection(self):
+        import ldap
+        delegate = self.folder.acl_users._delegate
+        pooled = self._idleConnection(delegate)
+
+        def search_s(*args, **kw):
+            raise ldap.SERVER_DOWN('gone')
+
+        pooled.connection.search_s = search_s
+        res = delegate.search(dg('users_base'), delegate.BASE)
+        self.assertFalse(res['exception'])
+        self.assertEqual(res['size'], 1)
+        self.assertFalse(pooled.healthy)
+        self.assertEqual(delegate._getPool().getStatistics()['size'], 1)
+
+    def test_verify_credentials(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        delegate = acl._delegate
+        user_dn = 'cn=test,%s' % dg('users_base')
+        manager_pool = delegate._getPool('manager')
+        stats_before = manager_pool.getStatistics()
+
+        self.assertTrue(delegate.verify_credentials(user_dn,
+                                                    user.get('user_pw')))
+        self.assertFalse(delegate.verify_credentials(user_dn, 'wrong'))
+        self.assertFalse(delegate.verify_credentials(user_dn, ''))
+        self.assertFalse(delegate.verify_credentials('', 'secret'))
+
+        # Password checks only use the reserved pool
+        self.assertEqual(len(delegate._getPool('auth')), 1)
+        self.assertEqual(manager_pool.getStatistics(), stats_before)
+
+    def test_circuit_breaker(self):
+        import time
+        delegate = self.folder.acl_users._delegate
+        uri = delegate._createConnectionString(delegate.getServers()[0])
+        delegate.setCircuitBreaker(2, 30)
+        health = delegate._getHealth()
+
+        health.recordFailure(uri)
+        res = delegate.search(dg('users_base'), delegate.BASE)
+        self.assertFalse(res['exception'])
+        self.assertEqual(delegate.getServerHealth()[0]['breaker'], 'closed')
+
+        health.recordFailure(uri)
+        health.recordFailure(uri)
+        self.assertEqual(delegate.getServerHealth()[0]['breaker'], 'open')
+
+        # The only server is still used as a last resort, its success
+        # closes the breaker
+        res = delegate.search(dg('users_base'), delegate.BASE)
+        self.assertFalse(res['exception'])
+        self.assertEqual(delegate.getServerHealth()[0]['breaker'], 'closed')
+
+        # After the cool-down a trial request closes the breaker again
+        health.recordFailure(uri)
+        health.recordFailure(uri)
+        health.get(uri).opened = time.monotonic() - 31
+        self.assertEqual(delegate.getServerHealth()[0]['breaker'],
+                         'half-open')
+        res = delegate.search(dg('users_base'), delegate.BASE)
+        self.assertFalse(res['exception'])
+        self.assertEqual(delegate.getServerHealth()[0]['breaker'], 'closed')
+
+    def test_health_monitor(self):
+        import ldap
+
+        from dataflake.fakeldap import FakeLDAPConnection
+        from dataflake.fakeldap import RaisingFakeLDAPConnection
+
+        from .. import LDAPDelegate as module
+        delegate = self.folder.acl_users._delegate
+        self.assertFalse(delegate.isHealthMonitorRunning())
+
+        delegate.setHealthMonitor(3600)
+        self.assertTrue(delegate.isHealthMonitorRunning())
+        delegate.setHealthMonitor(0)
+        self.assertFalse(delegate.isHealthMonitorRunning())
+
+        # A single failed probe opens the circuit breaker
+        delegate.setCircuitBreaker(1, 30)
+
+        # Probe synchronously with the configuration the thread used
+        monitor = delegate._getMonitor()
+        monitor.probeAll()
+        info = delegate.getServerHealth()[0]
+        self.assertTrue(info['healthy'])
+        self.assertIsNotNone(info['last_probe'])
+        failures = info['failures']
+
+        # Inject a failure into the next connection
+        def failing_factory(*args, **kw):
+            conn = RaisingFakeLDAPConnection(*args, **kw)
+            conn.setExceptionAndMethod('search_s', ldap.SERVER_DOWN)
+            return conn
+
+        module.c_factory = failing_factory
+        try:
+            monitor.probeAll()
+        finally:
+            module.c_factory = FakeLDAPConnection
+        info = delegate.getServerHealth()[0]
+        self.assertFalse(info['healthy'])
+        self.assertEqual(info['failures'], failures + 1)
+
+        monitor.probeAll()
+        self.assertTrue(delegate.getServerHealth()[0]['healthy'])
+
+    def test_parallel_connect(self):
+        import time
+
+        from dataflake.fakeldap import FakeLDAPConnection
+
+        from .. import LDAPDelegate as module
+        delegate = self.folder.acl_users._delegate
+        delegate.addServer('ldap.example.com')
+        slow, fast = [delegate._createConnectionString(x)
+                      for x in delegate.getServers()]
+        delegate.setConnectStagger(0.05)
+
+        def slow_factory(uri, *args, **kw):
+            if uri == slow:
+                time.sleep(0.5)
+            return FakeLDAPConnection(uri, *args, **kw)
+
+        module.c_factory = slow_factory
+        try:
+            start = time.monotonic()
+            res = delegate.search(dg('users_base'), delegate.BASE)
+            self.assertTrue(time.monotonic() - start < 0.5)
+            self.assertFalse(res['exception'])
+            self.assertEqual(delegate.getServerHealth()[1]['successes'], 1)
+
+            # The slow connection is pooled once it is established
+            time.sleep(0.6)
+            pool = delegate._getPool()
+            self.assertEqual(pool.getStatistics()['idle'], 2)
+            self.assertIsNotNone(pool.checkoutIdle((slow, 'manager')))
+        finally:
+            module.c_factory = FakeLDAPConnection
+
+    def test_referral_connections_pooled(self):
+        import ldap
+        delegate = self.folder.acl_users._delegate
+        pooled = self._idleConnection(delegate)
+        target = 'ldap://referral.example.com'
+
+        def search_s(*args, **kw):
+            raise ldap.REFERRAL({'info': f'Referral:\n{target}/dc=org'})
+
+        pooled.connection.search_s = search_s
+        for i in range(2):
+            res = delegate.search(dg('users_base'), delegate.BASE)
+            self.assertFalse(res['exception'])
+            self.assertEqual(res['size'], 1)
+
+        stats = delegate.getConnectionStatistics()
+        self.assertEqual(stats['counters']['referral_hops'], 2)
+        referral_stats = stats['pools']['referral']
+        self.assertEqual(referral_stats['created'], 1)
+        self.assertEqual(referral_stats['reused'], 1)
+        self.assertEqual(referral_stats['idle'], 1)
+        self.assertEqual(referral_stats['max_size'],
+                         delegate.referral_pool_size)
+
+
+class PagedFakeLDAPConnection:
+    """ Wraps a fake connection to add asynchronous searches and
+    simple paged results support
+    """
+
+    def __init__(self, uri, *args, **kw):
+        from dataflake.fakeldap import FakeLDAPConnection
+        self._conn = FakeLDAPConnection(uri, *args, **kw)
+        self._results = {}
+        self._msgid = 0
+        self.log = []
+        self.pages = 0
+        self.abandoned = False
+        self.reject_paging = None
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def search_ext(self, base, scope, filter, attrs, serverctrls=()):
+        from ldap.controls import SimplePagedResultsControl
+        self._msgid += 1
+        self.log.append(('search', self._msgid))
+
+        try:
+            if serverctrls and self.reject_paging is not None:
+                raise self.reject_paging({'desc': 'Critical extension is '
+                                                  'unavailable'})
+            res = self._conn.search_s(base, scope, filter, attrs)
+        except Exception as e:
+            res = e
+
+        if not serverctrls or isinstance(res, Exception):
+            self._results[self._msgid] = (res, None)
+        else:
+            control = serverctrls[0]
+            start = int(control.cookie or 0)
+            end = start + control.size
+            cookie = str(end).encode() if end < len(res) else b''
+            self._results[self._msgid] = (res[start:end],
+                                          SimplePagedResultsControl(
+                                              True, size=control.size,
+                                              cookie=cookie))
+
+        return self._msgid
+
+    def result3(self, msgid, all=1, timeout=-1):
+        import ldap
+        self.log.append(('result', msgid))
+        res, control = self._results.pop(msgid)
+        if isinstance(res, Exception):
+            raise res
+        if control is None:
+            return ldap.RES_SEARCH_RESULT, res, msgid, []
+        self.pages += 1
+        return ldap.RES_SEARCH_RESULT, res, msgid, [control]
+
+    def abandon_ext(self, msgid):
+        self.log.append(('abandon', msgid))
+        self._results.pop(msgid, None)
+
+    def search_ext_s(self, base, scope, filter, attrs, serverctrls=()):
+        if serverctrls[0].size == 0:
+            self.abandoned = True
+        return []
+
+
+class TestPagedSearch(LDAPTest):
+
+    def setUp(self):
+        from .. import LDAPDelegate as module
+        super().setUp()
+        module.c_factory = PagedFakeLDAPConnection
+        acl = self.folder.acl_users
+        acl._delegate._clearPools()
+        for kwargs in (user, user2):
+            acl.manage_addUser(REQUEST=None, kwargs=kwargs)
+
+    def tearDown(self):
+        from dataflake.fakeldap import FakeLDAPConnection
+
+        from .. import LDAPDelegate as module
+        module.c_factory = FakeLDAPConnection
+        super().tearDown()
+
+    def _connection(self, delegate):
+        pool = delegate._getPool()
+        pooled = pool.checkout(list(pool._idle.keys())[0], None)
+        pool.checkin(pooled)
+        return pooled.connection
+
+    def test_iter_search_pages(self):
+        delegate = self.folder.acl_users._delegate
+        records = list(delegate.iter_search(dg('users_base'),
+                                            delegate.ONELEVEL,
+                                            '(objectClass=person)',
+                                            page_size=1))
+        self.assertEqual(sorted(x['cn'][0] for x in records),
+                         ['test', 'test2'])
+        self.assertTrue(all('dn' in x for x in records))
+        self.assertEqual(self._connection(delegate).pages, 2)
+        self.assertEqual(delegate._getPool().getStatistics()['in_use'], 0)
+
+    def test_iter_search_stop_early(self):
+        delegate = self.folder.acl_users._delegate
+        records = delegate.iter_search(dg('users_base'), delegate.ONELEVEL,
+                                       '(objectClass=person)', page_size=1)
+        next(records)
+        records.close()
+
+        connection = self._connection(delegate)
+        self.assertEqual(connection.pages, 1)
+        self.assertTrue(connection.abandoned)
+        self.assertEqual(delegate._getPool().getStatistics()['in_use'], 0)
+
+    def test_iter_search_without_paging(self):
+        delegate = self.folder.acl_users._delegate
+        records = list(delegate.iter_search(dg('users_base'),
+                                            delegate.ONELEVEL,
+                                            '(objectClass=person)',
+                                            page_size=0))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(self._connection(delegate).pages, 0)
+
+    def test_iter_search_partial_results(self):
+        import ldap
+        delegate = self.folder.acl_users._delegate
+        connection = self._connection(delegate)
+        partial = [('cn=test,' + dg('users_base'), {'cn': [b'test']})]
+
+        def search_s(*args):
+            raise ldap.PARTIAL_RESULTS({})
+
+        connection.search_s = search_s
+        connection.result = lambda all=0: (ldap.RES_SEARCH_RESULT, partial)
+        records = list(delegate.iter_search(dg('users_base'),
+                                            delegate.ONELEVEL,
+                                            '(objectClass=person)',
+                                            page_size=0))
+        self.assertEqual([x['cn'] for x in records], [['test']])
+        records = delegate.iter_search(dg('users_base'), delegate.ONELEVEL,
+                                       '(objectClass=person)', page_size=0,
+                                       allow_partial=False)
+        self.assertRaises(ldap.PARTIAL_RESULTS, list, records)
+
+    def test_iter_search_paging_refused(self):
+        import ldap
+        acl = self.folder.acl_users
+        connection = self._connection(acl._delegate)
+
+        for exc in (ldap.UNAVAILABLE_CRITICAL_EXTENSION,
+                    ldap.UNWILLING_TO_PERFORM):
+            connection.reject_paging = exc
+            records = list(acl._delegate.iter_search(dg('users_base'),
+                                                     acl._delegate.ONELEVEL,
+                                                     '(objectClass=person)',
+                                                     page_size=1))
+            self.assertEqual(sorted(x['cn'][0] for x in records),
+                             ['test', 'test2'])
+
+        acl._delegate.page_size = 1
+        self.assertEqual(acl.getUserNames(), ('test', 'test2'))
+        self.assertEqual(connection.pages, 0)
+        self.assertEqual(acl._delegate._getPool().getStatistics()['in_use'],
+                         0)
+
+    def test_getUserNames_paged(self):
+        acl = self.folder.acl_users
+        acl._delegate.page_size = 1
+        self.assertEqual(acl.getUserNames(), ('test', 'test2'))
+        self.assertEqual(self._connection(acl._delegate).pages, 2)
+
+
+class TestBatchSearch(TestPagedSearch):
+
+    def _queries(self):
+        delegate = self.folder.acl_users._delegate
+        return [{'base': 'cn=test,%s' % dg('users_base'),
+                 'scope': delegate.BASE},
+                {'base': 'cn=missing,%s' % dg('users_base'),
+                 'scope': delegate.BASE},
+                {'base': 'cn=test2,%s' % dg('users_base'),
+                 'scope': delegate.BASE, 'attrs': ['sn']}]
+
+    def test_search_many(self):
+        delegate = self.folder.acl_users._delegate
+        connection = self._connection(delegate)
+        connection.log = []
+
+        results = delegate.search_many(self._queries())
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['size'], 1)
+        self.assertEqual(results[0]['results'][0]['cn'], ['test'])
+        self.assertTrue(results[1]['exception'])
+        self.assertEqual(results[1]['size'], 0)
+        self.assertEqual(results[2]['results'][0]['sn'], ['User2'])
+
+        # All searches are sent before the first result is read
+        self.assertEqual([x[0] for x in connection.log],
+                         ['search'] * 3 + ['result'] * 3)
+
+    def test_search_many_same_format_as_search(self):
+        delegate = self.folder.acl_users._delegate
+        results = delegate.search_many(self._queries())
+        for query, result in zip(self._queries(), results):
+            self.assertEqual(result, delegate.search(**query))
+
+    def test_search_many_send_error(self):
+        import ldap
+        delegate = self.folder.acl_users._delegate
+        connection = self._connection(delegate)
+        connection.log = []
+        send = connection.search_ext
+
+        def search_ext(base, scope, filter, attrs, serverctrls=()):
+            if filter == '(bad':
+                raise ldap.FILTER_ERROR('Bad search filter')
+            if base.startswith('cn=missing'):
+                raise ldap.TIMEOUT('Gone')
+            return send(base, scope, filter, attrs, serverctrls)
+
+        connection.search_ext = search_ext
+
+        # A bad filter fails only its own search
+        queries = self._queries()
+        queries[1]['filter'] = '(bad'
+        results = delegate.search_many(queries)
+        self.assertEqual([x['size'] for x in results], [1, 0, 1])
+        self.assertTrue(results[1]['exception'])
+
+        # After a connection error the searches sent so far are abandoned
+        connection.log = []
+        results = delegate.search_many(self._queries())
+        self.assertTrue(all(x['exception'] for x in results))
+        self.assertEqual([x[0] for x in connection.log],
+                         ['search', 'abandon'])
+        self.assertEqual(connection._results, {})
+
+    def test_search_many_without_async_support(self):
+        from dataflake.fakeldap import FakeLDAPConnection
+
+        from .. import LDAPDelegate as module
+        module.c_factory = FakeLDAPConnection
+        delegate = self.folder.acl_users._delegate
+        delegate._clearPools()
+
+        results = delegate.search_many(self._queries())
+        self.assertEqual([x['size'] for x in results], [1, 0, 1])
+
+    def test_getGroupedUsers(self):
+        acl = self.folder.acl_users
+        acl.manage_addGroup('Staff')
+        acl.manage_editUserRoles('cn=test,%s' % dg('users_base'), ['Staff'])
+        users = acl.getGroupedUsers()
+        self.assertEqual([x.getId() for x in users], ['test'])
@@ -15,6 +15,8 @@
 
 import copy
 import os
+import threading
+import time
 from hashlib import sha1
 
 import ldap
@@ -565,6 +567,75 @@ class TestLDAPUserFolder(LDAPTest):
         self.assertNotEqual(user_ob, None)
         self.assertTrue(new_role in user_ob.getRoles())
 
+    def testGroupMembershipCache(self):
+        acl = self.folder.acl_users
+        new_role = 'Privileged'
+        acl.manage_addGroup(new_role)
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        user_dn = acl.getUser(ug(acl.getProperty('_login_attr'))).getUserDN()
+        searches = []
+        search_groups = acl._searchGroups
+
+        def counting_search(*args):
+            searches.append(args)
+            return search_groups(*args)
+
+        acl._searchGroups = counting_search
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), [])
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), [])
+        self.assertEqual(len(searches), 1)
+        self.assertIsNotNone(acl._cache('groups').get(user_dn))
+
+        # Group changes made through the user folder expire the entry
+        acl.manage_editUserRoles(user_dn, [new_role])
+        self.assertIsNone(acl._cache('groups').get(user_dn))
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), [new_role])
+
+    def testGroupMembershipIndex(self):
+        acl = self.folder.acl_users
+        new_role = 'Privileged'
+        acl.manage_addGroup(new_role)
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        user_dn = acl.getUser(ug(acl.getProperty('_login_attr'))).getUserDN()
+        acl.setGroupIndex(enabled=True, interval=3600)
+        searches = []
+        acl._searchGroups = lambda *args: searches.append(args)
+
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), [])
+        self.assertIn(new_role, acl.getGroups(attr='cn'))
+        self.assertEqual(acl.getGroupIndex()['groups'],
+                         len(acl.getGroups()))
+
+        # Changes made through the user folder are applied to the index
+        acl.manage_editUserRoles(user_dn, [new_role])
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), [new_role])
+        details = dict(acl.getGroupDetails(new_role))
+        self.assertIn(user_dn, details['uniqueMember'])
+        self.assertEqual(searches, [])
+
+        acl.setGroupIndex(enabled=False)
+        self.assertIsNone(acl.getGroupIndex()['age'])
+
+    def testGroupMembershipIndexIncomplete(self):
+        acl = self.folder.acl_users
+        acl.manage_addGroup('Privileged')
+        acl.manage_addGroup('Editors')
+
+        # The search fails after the first page of groups
+        def iter_search(*args, **kw):
+            yield from list(search(*args, **kw))[:1]
+            raise OSError('Size limit exceeded')
+
+        search = acl._delegate.iter_search
+        acl._delegate.iter_search = iter_search
+        acl.setGroupIndex(enabled=True, interval=3600)
+        self.assertFalse(acl._loadGroupIndex())
+        self.assertIsNone(acl._loadedGroupIndex())
+
+        # Without the index groups are searched as before
+        self.assertIn('Editors', acl.getGroups(attr='cn'))
+        self.assertIn('Privileged', acl.getGroups(attr='cn'))
+
     def testEditUserRolesReadOnly(self):
         acl = self.folder.acl_users
         for role in ug('user_roles'):
@@ -714,6 +785,231 @@ class TestLDAPUserFolder(LDAPTest):
         acl.manage_addUser(REQUEST=None, kwargs=user)
         ae(len(acl._cache('negative').getCache()), 0)
 
+    def testNegativeCacheLimits(self):
+        ae = self.assertEqual
+        acl = self.folder.acl_users
+
+        ae(acl.getCacheLimits('negative'), {'max_entries': 10000,
+                                            'max_size': 0})
+        acl.setCacheLimits('negative', max_entries='2', max_size='')
+        ae(acl.getCacheLimits('negative'), {'max_entries': 2, 'max_size': 0})
+
+        for login in ('missing1', 'missing2', 'missing3'):
+            acl.getUser(login)
+        usage = acl.getCacheUsage('negative')
+        ae(usage['entries'], 2)
+        ae(usage['evictions'], 1)
+
+    def testStaleWhileRevalidate(self):
+        from ..cache import setResource
+
+        ae = self.assertEqual
+        acl = self.folder.acl_users
+        jobs = []
+
+        class SyncQueue:
+            def submit(self, key, job):
+                jobs.append(key)
+                job()
+                return True
+
+        setResource(f'{acl._hash}-refreshqueue', SyncQueue())
+        acl._refreshJob = lambda name, value, pwd: (
+            lambda: acl._refreshCachedUser(name, value, pwd))
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        uid = ug(acl.getProperty('_uid_attr'))
+        acl.setCacheGrace('anonymous', 60)
+        ae(acl.getCacheGrace('anonymous'), 60)
+        ae(acl.getCacheGrace('negative'), 0)
+
+        user_ob = acl.getUserById(uid)
+        ae(jobs, [])
+        acl.setCacheTimeout('anonymous', 0)
+
+        # The stale user is returned and refreshed in the background
+        ae(acl.getUserById(uid), user_ob)
+        ae(len(jobs), 1)
+        cache = acl._cache('anonymous')
+        refreshed = cache.getStale(uid)
+        self.assertIsNotNone(refreshed)
+        self.assertFalse(refreshed is user_ob)
+
+        # LDAP errors keep the stale entry
+        acl._delegate.search = lambda *args, **kw: {
+            'exception': 'Server down', 'size': 0, 'results': []}
+        acl._refreshCachedUser(acl.getProperty('_uid_attr'), uid)
+        ae(cache.getStale(uid), refreshed)
+
+        # A user that is gone is removed
+        del acl._delegate.search
+        acl.manage_deleteUsers([refreshed.getUserDN()])
+        cache.set(uid, refreshed)
+        acl._refreshCachedUser(acl.getProperty('_uid_attr'), uid)
+        self.assertIsNone(cache.getStale(uid))
+
+        # Lookups bound with the credentials of the current user are
+        # not refreshed in the background
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        acl._delegate.binduid_usage = 0
+        jobs[:] = []
+        user_ob = acl.getUserById(uid)
+        self.assertIsNone(cache.get(uid))
+        self.assertIsNotNone(cache.getStale(uid))
+        self.assertFalse(acl.getUserById(uid) is user_ob)
+        ae(jobs, [])
+
+    def testConcurrentLookupsCoalesced(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        uid = ug(acl.getProperty('_uid_attr'))
+        make_user = acl._makeUser
+        started = threading.Event()
+        proceed = threading.Event()
+        lookups = []
+
+        def slow_make_user(*args, **kw):
+            lookups.append(args)
+            started.set()
+            proceed.wait(5)
+            return make_user(*args, **kw)
+
+        acl._makeUser = slow_make_user
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(acl.getUserById(uid)))
+            for x in range(5)]
+        threads[0].start()
+        self.assertTrue(started.wait(5))
+        [x.start() for x in threads[1:]]
+        # Give the other threads time to wait for the first lookup
+        time.sleep(0.1)
+        proceed.set()
+        [x.join() for x in threads]
+
+        self.assertEqual(len(lookups), 1)
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len({id(x) for x in results}), 1)
+        self.assertEqual(results[0].getId(), uid)
+
+    def testCacheStatistics(self):
+        import json
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        uid = ug(acl.getProperty('_uid_attr'))
+        acl.resetCacheStatistics()
+
+        acl.getUserById(uid)
+        acl.getUserById(uid)
+        acl.getUserById('missing')
+        acl.getUserIds()
+        acl.getUserIds()
+
+        stats = acl.getCacheStatistics()
+        self.assertEqual(sorted(stats.keys()),
+                         ['anonymous', 'authenticated', 'misc', 'negative'])
+        self.assertEqual(stats['anonymous']['hits'], 1)
+        self.assertEqual(stats['anonymous']['misses'], 2)
+        self.assertEqual(stats['anonymous']['inserts'], 1)
+        self.assertEqual(stats['anonymous']['entries'], 1)
+        self.assertEqual(stats['anonymous']['hit_ratio'], 1.0 / 3)
+        self.assertEqual(stats['negative']['inserts'], 1)
+        self.assertEqual(stats['misc']['hits'], 1)
+        self.assertEqual(stats['misc']['inserts'], 1)
+
+        request = self.app.REQUEST
+        published = json.loads(acl.getCacheStatistics('misc',
+                                                      REQUEST=request))
+        self.assertEqual(published['hits'], 1)
+        self.assertEqual(request.RESPONSE.getHeader('Content-Type'),
+                         'application/json')
+
+        acl.resetCacheStatistics()
+        self.assertEqual(acl.getCacheStatistics('anonymous')['hits'], 0)
+
+    def testCacheBackend(self):
+        import tempfile
+
+        from ..sharedcache import CacheServer
+        from ..sharedcache import SocketCacheBackend
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        uid = ug(acl.getProperty('_uid_attr'))
+        self.assertEqual(acl.getCacheBackend(),
+                         {'name': 'local', 'location': ''})
+        self.assertIn('socket', [x['name'] for x in acl.getCacheBackends()])
+
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'cache.sock')
+        server = CacheServer(path)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        other_process = SocketCacheBackend(path)
+
+        try:
+            acl.setCacheBackend('socket', path)
+            self.assertEqual(acl.getCacheBackend(),
+                             {'name': 'socket', 'location': path})
+            user_ob = acl.getUserById(uid)
+
+            # Another process sees the cached user
+            shared = other_process.createUserCache(
+                f'{acl._hash}-anonymouscache')
+            self.assertEqual(shared.get(uid).getUserDN(),
+                             user_ob.getUserDN())
+
+            acl._clearCaches()
+            self.assertIsNone(shared.get(uid))
+
+            # Invalidations by other ZEO clients are applied to the
+            # shared caches by the first process noticing them only
+            user_ob = acl.getUserById(uid)
+            acl._invalidations.invalidateUser(uid)
+            state = acl._invalidations.getState()
+            self.assertIsNotNone(other_process.claimInvalidations(
+                f'{acl._hash}-invalidations', state, (0, 0)))
+            acl._cache('anonymous')
+            self.assertIsNotNone(shared.get(uid))
+        finally:
+            acl._cache('anonymous').client._close()
+            other_process.client._close()
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            os.rmdir(tempdir)
+
+        acl.setCacheBackend('unknown')
+        self.assertEqual(acl.getCacheBackend()['name'], 'socket')
+        acl.setCacheBackend()
+        self.assertIs(acl.getUserById(uid).__class__, user_ob.__class__)
+
+    def testInvalidationsFromOtherClients(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        uid = ug(acl.getProperty('_uid_attr'))
+        user_ob = acl.getUserById(uid)
+        cache = acl._cache('anonymous')
+        self.assertEqual(cache.get(uid), user_ob)
+
+        # Another ZEO client expires the user and commits
+        acl._invalidations.invalidateUser(uid)
+        self.assertEqual(cache.get(uid), user_ob)
+        acl._cache('anonymous')
+        self.assertIsNone(cache.get(uid))
+
+        # Another ZEO client clears all caches
+        user_ob = acl.getUserById(uid)
+        acl._misc_cache().set('foo', 'bar')
+        acl._invalidations.invalidateAll()
+        self.assertIsNone(acl._misc_cache().get('foo'))
+        self.assertIsNone(cache.get(uid))
+
+        # Older instances get the log on the first invalidation
+        del acl._invalidations
+        acl._cache('anonymous')
+        acl._expireUser(uid)
+        self.assertEqual(acl._invalidations.getState(), (0, 1))
+
     def testNegativeCachePoisoning(self):
         # Test against cache poisoning
         # https://bugs.launchpad.net/bugs/695821
@@ -76,3 +76,17 @@ class TestAuthentication(LDAPTest):
 
         # now we should be OK
         self.assertIsNotNone(user_ob)
+
+    def testPasswordsVerifiedOnReservedConnections(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user)
+        delegate = acl._delegate
+
+        user_ob = acl.authenticate(user.get(acl.getProperty('_login_attr')),
+                                   user.get('user_pw'), {})
+        self.assertIsNotNone(user_ob)
+
+        # With the Manager DN used for all lookups no connection is ever
+        # bound as the user for reading
+        self.assertEqual(len(delegate._getPool('user')), 0)
+        self.assertEqual(len(delegate._getPool('auth')), 1)
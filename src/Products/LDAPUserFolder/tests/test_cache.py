@@ -83,6 +83,270 @@ class TestUserCache(unittest.TestCase):
         self.assertEqual(len(self.cache.getCache()), 0)
         self.assertEqual(len(self.cache.getCache()), 0)
 
+    def testNoDateTimeOnLookup(self):
+        class NoDateTimeObject(CacheObject):
+            def getCreationTime(self):
+                raise AssertionError('DateTime must not be built')
+
+        self.cache.set('TestId', NoDateTimeObject('nodt'))
+        self.assertEqual(self.cache.get('testid').id, 'nodt')
+        self.assertEqual(len(self.cache.getCache()), 1)
+
+    def testSetRenewsExpiry(self):
+        self.cache.set('TestId', CacheObject('first'))
+        time.sleep(0.06)
+        self.cache.set('TestId', CacheObject('second'))
+        time.sleep(0.06)
+        # The heap item of the first entry expired but must not
+        # remove the second one
+        self.assertEqual(self.cache.sweep(), 0)
+        self.assertEqual(self.cache.get('testid').id, 'second')
+
+    def testSweep(self):
+        for i in range(10):
+            self.cache.set(f'key{i}', CacheObject(f'key{i}'))
+        self.cache.invalidate('key0')
+        self.assertEqual(len(self.cache.keys()), 9)
+        self.assertEqual(self.cache.sweep(), 0)
+        time.sleep(0.2)
+        self.assertEqual(self.cache.sweep(), 9)
+        self.assertEqual(self.cache.getCache(), [])
+        self.assertEqual(self.cache._expiries, [])
+
+    def testMaxEntries(self):
+        self.cache.setTimeout(60)
+        for i in range(3):
+            self.cache.set(f'key{i}', CacheObject(f'key{i}'))
+        self.cache.get('key0')
+        self.cache.setLimits(max_entries=2)
+        # key1 was the least recently used entry
+        self.assertEqual(sorted(self.cache.keys()), ['key0', 'key2'])
+        self.assertEqual(self.cache.evictions, 1)
+
+        self.cache.set('key3', CacheObject('key3'))
+        self.assertEqual(sorted(self.cache.keys()), ['key0', 'key3'])
+        self.assertEqual(self.cache.evictions, 2)
+
+    def testMaxSize(self):
+        from ..cache import approximateSize
+        self.cache.setTimeout(60)
+        size = approximateSize(CacheObject('key0'))
+        self.cache.setLimits(max_size=size * 3)
+        for i in range(5):
+            self.cache.set(f'key{i}', CacheObject(f'key{i}'))
+        self.assertEqual(len(self.cache), 3)
+        self.assertTrue(self.cache.getSize() <= size * 3)
+        self.assertEqual(self.cache.evictions, 2)
+
+        self.cache.invalidate('key4')
+        self.assertEqual(len(self.cache), 2)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.getSize(), 0)
+
+    def testExpiryHeapBounded(self):
+        self.cache.setTimeout(60)
+        for i in range(1000):
+            self.cache.set('samekey', CacheObject('same'))
+        self.assertTrue(len(self.cache._expiries) < 100)
+
+    def testGrace(self):
+        ob = CacheObject('stale')
+        self.cache.setGrace(60)
+        self.cache.set('TestId', ob)
+        self.assertIsNone(self.cache.getStale('testid'))
+        time.sleep(0.2)
+        self.assertIsNone(self.cache.get('testid'))
+        self.assertEqual(self.cache.getStale('testid'), ob)
+        self.assertEqual(self.cache.getStale('testid', TESTPWD), ob)
+        self.assertIsNone(self.cache.getStale('testid', 'wrong'))
+        self.assertEqual(self.cache.sweep(), 0)
+
+        self.cache.setGrace(0)
+        self.assertIsNone(self.cache.getStale('testid'))
+        self.assertEqual(self.cache.sweep(), 1)
+
+    def testTimeoutChangeAppliesToCachedEntries(self):
+        self.cache.set('TestId', CacheObject('nonauth'))
+        self.cache.setTimeout(0)
+        self.assertIsNone(self.cache.get('testid'))
+        self.cache.setTimeout(60)
+        self.assertIsNotNone(self.cache.get('testid'))
+
+    def testStatistics(self):
+        ob = CacheObject('stats')
+        self.cache.set('TestId', ob)
+        self.cache.set('OtherId', ob)
+        self.cache.get('testid')
+        self.cache.get('testid', 'wrong')
+        self.cache.get('missing')
+        self.cache.invalidate('otherid')
+        self.cache.invalidate('missing')
+        time.sleep(0.2)
+        self.cache.sweep()
+        stats = self.cache.getStatistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['inserts'], 2)
+        self.assertEqual(stats['evictions'], 0)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['size'], 0)
+        self.assertAlmostEqual(stats['hit_ratio'], 1.0 / 3)
+
+        self.cache.resetStatistics()
+        stats = self.cache.getStatistics()
+        self.assertEqual(stats['hits'], 0)
+        self.assertEqual(stats['hit_ratio'], 0.0)
+
+
+class TestMiscCache(unittest.TestCase):
+
+    def setUp(self):
+        from ..cache import MiscCache
+        self.cache = MiscCache()
+        self.cache.setTimeout(0.1)
+
+    def testCaching(self):
+        self.cache.set('useridlist', ['a', 'b'])
+        self.assertEqual(self.cache.get('useridlist'), ['a', 'b'])
+        self.assertTrue(self.cache.getSize() > 0)
+        time.sleep(0.2)
+        self.assertIsNone(self.cache.get('useridlist'))
+        self.assertEqual(self.cache.get('useridlist', 'default'), 'default')
+        self.assertEqual(len(self.cache), 0)
+
+    def testStatistics(self):
+        self.cache.set('foo', 'bar')
+        self.cache.set('bar', 'baz')
+        self.cache.get('foo')
+        self.cache.get('missing')
+        self.cache.invalidate('bar')
+        time.sleep(0.2)
+        self.cache.get('foo')
+        stats = self.cache.getStatistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['inserts'], 2)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['hit_ratio'], 1.0 / 3)
+
+        self.cache.set('foo', 'bar')
+        self.cache.invalidate()
+        self.assertEqual(self.cache.getStatistics()['invalidations'], 2)
+
+
+class TestRefreshQueue(unittest.TestCase):
+
+    def test_submit(self):
+        from ..cache import RefreshQueue
+        refresh_queue = RefreshQueue(workers=1)
+        started = threading.Event()
+        proceed = threading.Event()
+        done = []
+
+        def job():
+            started.set()
+            proceed.wait(5)
+            done.append(1)
+
+        self.assertTrue(refresh_queue.submit('key', job))
+        self.assertTrue(started.wait(5))
+        # A second job for the same key is not queued
+        self.assertTrue(refresh_queue.submit('key', job))
+        self.assertTrue(refresh_queue.isPending('key'))
+        proceed.set()
+
+        for i in range(50):
+            if not refresh_queue.isPending('key'):
+                break
+            time.sleep(0.1)
+        self.assertEqual(done, [1])
+
+    def test_submit_full(self):
+        from ..cache import RefreshQueue
+        refresh_queue = RefreshQueue(workers=1, max_pending=1)
+        proceed = threading.Event()
+
+        self.assertTrue(refresh_queue.submit('key1', lambda: proceed.wait(5)))
+        self.assertFalse(refresh_queue.submit('key2', lambda: None))
+        proceed.set()
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        from ..cache import SingleFlight
+        self.flight = SingleFlight(timeout=5)
+        self.calls = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+
+    def _slow(self, value):
+        self.calls.append(value)
+        self.started.set()
+        self.proceed.wait(5)
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def _runConcurrently(self, func, count=5):
+        results = []
+
+        def call():
+            try:
+                results.append(self.flight.do('key', func))
+            except Exception as e:
+                results.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        self.assertTrue(self.started.wait(5))
+        followers = [threading.Thread(target=call) for x in range(count - 1)]
+        [x.start() for x in followers]
+        # Give the followers time to start waiting
+        time.sleep(0.1)
+        self.proceed.set()
+        [x.join() for x in [leader] + followers]
+
+        return results
+
+    def test_do_coalesced(self):
+        results = self._runConcurrently(lambda: self._slow('result'))
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(self.calls, ['result'])
+        self.assertFalse(self.flight.isInFlight('key'))
+
+    def test_do_exception(self):
+        error = ValueError('failed')
+        results = self._runConcurrently(lambda: self._slow(error))
+        self.assertEqual(results, [error] * 5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertFalse(self.flight.isInFlight('key'))
+
+    def test_do_sequential(self):
+        self.proceed.set()
+        self.assertEqual(self.flight.do('key', self._slow, 'first'), 'first')
+        self.assertEqual(self.flight.do('key', self._slow, 'second'),
+                         'second')
+        self.assertEqual(self.calls, ['first', 'second'])
+
+    def test_do_timeout(self):
+        self.flight.timeout = 0.1
+        leader = threading.Thread(target=self.flight.do,
+                                  args=('key', self._slow, 'leader'))
+        leader.start()
+        self.assertTrue(self.started.wait(5))
+        self.assertEqual(self.flight.do('key', lambda: 'own'), 'own')
+        self.proceed.set()
+        leader.join()
+
+    def test_do_reentrant(self):
+        result = self.flight.do('key', self.flight.do, 'key', lambda: 'inner')
+        self.assertEqual(result, 'inner')
+
 
 class TestGetSetRemoveResource(unittest.TestCase):
 
@@ -68,7 +68,10 @@ class _LDAPUserFolderSetup(BaseRegistryTests):
                             obj_classes='top,inetOrgPerson',
                             local_groups=True, implicit_mapping=True,
                             encryption='SSHA', read_only=1,
-                            extra_user_filter='(usertype=privileged)')
+                            extra_user_filter='(usertype=privileged)',
+                            group_resolution='attribute',
+                            group_attribute='isMemberOf', group_nesting=3,
+                            group_nesting_in_chain=True)
             acl.manage_addLDAPSchemaItem('mail', friendly_name='Email Address',
                                          multivalued=True,
                                          public_name='publicmail', binary=True)
@@ -151,6 +154,10 @@ class LDAPUserFolderImportTests(_LDAPUserFolderSetup):
         self.assertEqual(acl._pwd_encryption, 'SSHA')
         self.assertTrue(acl.read_only)
         self.assertEqual(acl._extra_user_filter, '(usertype=privileged)')
+        self.assertEqual(acl._group_resolution, 'attribute')
+        self.assertEqual(acl._group_attribute, 'isMemberOf')
+        self.assertEqual(acl._group_nesting, 3)
+        self.assertTrue(acl._group_nesting_in_chain)
 
         group_mappings = acl.getGroupMappings()
         self.assertEqual(len(group_mappings), 1)
@@ -178,6 +185,43 @@ class LDAPUserFolderImportTests(_LDAPUserFolderSetup):
         self.assertTrue(('user1', ['posixAdmin', 'foobar']) in local_groups)
         self.assertTrue(('user2', ['baz']) in local_groups)
 
+    def test_roundtrip_old_folder(self):
+        from Products.GenericSetup.tests.common import DummyExportContext
+        from Products.GenericSetup.tests.common import DummyImportContext
+
+        from ..exportimport import exportLDAPUserFolder
+        from ..exportimport import importLDAPUserFolder
+
+        # Folders created before the group settings existed
+        group_settings = ('_group_resolution', '_group_attribute',
+                          '_group_nesting', '_group_nesting_in_chain')
+        site = self._initSite()
+        for name in group_settings:
+            delattr(site.acl_users, name)
+
+        context = DummyExportContext(site)
+        exportLDAPUserFolder(context)
+        filename, text, content_type = context._wrote[0]
+
+        site = self._initSite()
+        acl = site.acl_users
+        for name in group_settings:
+            delattr(acl, name)
+        context = DummyImportContext(site)
+        context._files['ldapuserfolder.xml'] = text
+        importLDAPUserFolder(context)
+
+        self.assertEqual(acl._group_resolution, 'search')
+        self.assertEqual(acl._group_attribute, 'memberOf')
+        self.assertEqual(acl._group_nesting, 0)
+        self.assertFalse(acl._group_nesting_in_chain)
+        self.assertFalse(acl._usesGroupGraph())
+
+        # Broken values from earlier imports do not break lookups
+        acl._group_nesting = ''
+        self.assertEqual(acl._getNestingDepth(), 0)
+        self.assertFalse(acl._usesGroupGraph())
+
     def test_servers_purge(self):
         from Products.GenericSetup.tests.common import DummyImportContext
 
@@ -296,6 +340,10 @@ _LDAPUSERFOLDER_BODY = b"""\
  <property name="_pwd_encryption">SHA</property>
  <property name="read_only">False</property>
  <property name="_extra_user_filter"></property>
+ <property name="_group_resolution">search</property>
+ <property name="_group_attribute">memberOf</property>
+ <property name="_group_nesting">0</property>
+ <property name="_group_nesting_in_chain">False</property>
  <property name="_anonymous_timeout">600</property>
  <property name="_authenticated_timeout">600</property>
  <ldap-schema>
@@ -334,6 +382,10 @@ _CHANGED_EXPORT = b"""\
  <property name="_pwd_encryption">SSHA</property>
  <property name="read_only">True</property>
  <property name="_extra_user_filter">(usertype=privileged)</property>
+ <property name="_group_resolution">attribute</property>
+ <property name="_group_attribute">isMemberOf</property>
+ <property name="_group_nesting">3</property>
+ <property name="_group_nesting_in_chain">True</property>
  <property name="_anonymous_timeout">60</property>
  <property name="_authenticated_timeout">60</property>
  <additional-groups>
@@ -130,6 +130,133 @@ class TestGroups(LDAPTest):
                                   exact_match=True)
         self.assertEqual(len(result), 0)
 
+    def test_groupAttribute(self):
+        # Groups are read from the memberOf attribute of the user record
+        acl = self.folder.acl_users
+        acl._group_resolution = 'attribute'
+        groups_base = defaults.get('groups_base')
+        user_dn = 'cn=test3,' + defaults.get('users_base')
+        ldapconn = acl._delegate.connect()
+        ldapconn.add_s(user_dn,
+                       dict(objectClass=['top', 'person'], cn=['test3'],
+                            sn=['Test'],
+                            memberOf=['cn=group1,' + groups_base,
+                                      'cn=elsewhere,dc=example,dc=org'],
+                            ).items())
+        acl._searchGroups = lambda *args: self.fail('Groups were searched')
+        acl.manage_addGroupMapping('group1', 'Manager')
+
+        # The attribute read does not share flights with group searches
+        flight = acl._singleFlight()
+        keys = []
+
+        def do(key, func, *args, **kw):
+            keys.append(key)
+            return func(*args, **kw)
+
+        flight.do = do
+        self.addCleanup(delattr, flight, 'do')
+
+        u = acl.getUser('test3')
+        self.assertEqual(u._getLDAPGroups(), ('group1',))
+        self.assertIn('Manager', u.getRoles())
+        # The attribute is not in the schema, it is no user property
+        self.assertIsNone(u.getProperty('memberOf', None))
+        self.assertEqual(acl.getGroups(dn=user_dn, attr='cn'), ['group1'])
+        self.assertIn(('group_attr', user_dn.lower(), 'memberOf'), keys)
+        self.assertNotIn(('groups', user_dn.lower()), keys)
+
+        acl._cache('groups').invalidate()
+        self.assertEqual(acl.getGroups(dn=user_dn),
+                         [('group1', 'cn=group1,' + groups_base)])
+
+    def test_nestedGroups(self):
+        acl = self.folder.acl_users
+        acl.manage_addUser(REQUEST=None, kwargs=user2)
+        groups_base = defaults.get('groups_base')
+        member = 'cn=test2,' + defaults.get('users_base')
+        ldapconn = acl._delegate.connect()
+        for group_cn, group_member in (('inner', member),
+                                       ('outer', 'cn=inner,' + groups_base),
+                                       ('top', 'cn=outer,' + groups_base)):
+            ldapconn.add_s(f'cn={group_cn},{groups_base}',
+                           dict(objectClass=['groupOfUniqueNames', 'top'],
+                                uniqueMember=[group_member]).items())
+        acl.manage_addGroupMapping('outer', 'Manager')
+
+        u = acl.getUser('test2')
+        self.assertEqual(u._getLDAPGroups(), ('inner',))
+        self.assertNotIn('Manager', u.getRoles())
+
+        acl._group_nesting = 1
+        acl._clearCaches()
+        u = acl.getUser('test2')
+        self.assertEqual(u._getLDAPGroups(), ('inner', 'outer'))
+        self.assertIn('Manager', u.getRoles())
+        # Only direct memberships are shown for the user DN
+        self.assertEqual(acl.getGroups(dn=member, attr='cn'), ['inner'])
+
+        acl._group_nesting = 5
+        acl._clearCaches()
+        u = acl.getUser('test2')
+        self.assertEqual(u._getLDAPGroups(), ('inner', 'outer', 'top'))
+
+    def test_localGroupMembers(self):
+        from Acquisition import aq_base
+        acl = self.folder.acl_users
+        acl._local_groups = True
+        user_dn = 'cn=test2,' + defaults.get('users_base')
+
+        acl.manage_editUserRoles(user_dn, ['Manager', 'Owner'])
+        self.assertEqual(acl.getGroupDetails('Manager'), [('', [user_dn])])
+        self.assertEqual(acl.getGroupDetails('Owner'), [('', [user_dn])])
+
+        acl.manage_editUserRoles(user_dn, ['Owner'])
+        self.assertEqual(acl.getGroupDetails('Manager'), [('', [])])
+        self.assertEqual(list(acl._groups_members['Manager']), [])
+
+        acl.manage_deleteUsers([user_dn])
+        self.assertEqual(acl.getGroupDetails('Owner'), [('', [])])
+
+        # Folders without the index build it for reading without
+        # storing it, the upgrade or the next change stores it
+        del acl._groups_members
+        acl._groups_store[user_dn] = ['Manager']
+        self.assertEqual(acl.getGroupDetails('Manager'), [('', [user_dn])])
+        self.assertIsNone(getattr(aq_base(acl), '_groups_members', None))
+
+        acl.manage_upgrade()
+        self.assertEqual(list(acl._groups_members['Manager']), [user_dn])
+
+        del acl._groups_members
+        acl.manage_editUserRoles(user_dn, ['Manager', 'Owner'])
+        self.assertEqual(list(acl._groups_members['Manager']), [user_dn])
+        self.assertEqual(list(acl._groups_members['Owner']), [user_dn])
+
+    def test_localGroupStorage(self):
+        from BTrees.OOBTree import OOBTree
+        from BTrees.OOBTree import OOTreeSet
+        acl = self.folder.acl_users
+        acl._local_groups = True
+        self.assertIsInstance(acl._additional_groups, OOTreeSet)
+        self.assertIsInstance(acl._groups_mappings, OOBTree)
+
+        # Folders with the old list and dict get the new types on write
+        acl._additional_groups = ['Editor']
+        acl._groups_mappings = {'ldap_group': 'Manager'}
+        acl.manage_addGroup('Reviewer')
+        acl.manage_addGroupMapping('other_group', 'Owner')
+        self.assertIsInstance(acl._additional_groups, OOTreeSet)
+        self.assertIsInstance(acl._groups_mappings, OOBTree)
+        self.assertEqual(list(acl._additional_groups), ['Editor', 'Reviewer'])
+        self.assertEqual(sorted(acl.getGroupMappings()),
+                         [('ldap_group', 'Manager'), ('other_group', 'Owner')])
+
+        acl.manage_deleteGroups(['Editor', 'unknown'])
+        acl.manage_deleteGroupMappings(['ldap_group'])
+        self.assertEqual(list(acl._additional_groups), ['Reviewer'])
+        self.assertEqual(acl.getGroupMappings(), [('other_group', 'Owner')])
+
     def test_groupLifecycle_nonutf8(self):
         # http://www.dataflake.org/tracker/issue_00527
         # Make sure groups with non-UTF8/non-ASCII characters can be
@@ -0,0 +1,118 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the GroupIndex class
+"""
+
+import unittest
+
+
+ADMINS = {'dn': 'cn=Admins,ou=groups,dc=example,dc=com',
+          'cn': ['Admins'],
+          'objectClass': ['top', 'groupOfUniqueNames'],
+          'uniqueMember': ['cn=User1,ou=people,dc=example,dc=com']}
+EDITORS = {'dn': 'cn=Editors,ou=groups,dc=example,dc=com',
+           'cn': ['Editors'],
+           'objectClass': ['top', 'groupOfNames'],
+           'member': ['cn=user1,ou=people,dc=example,dc=com',
+                      'cn=user2,ou=people,dc=example,dc=com']}
+USER1 = 'cn=user1,ou=people,dc=example,dc=com'
+USER2 = 'cn=user2,ou=people,dc=example,dc=com'
+
+
+class TestGroupIndex(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..groupindex import GroupIndex
+        index = GroupIndex()
+        index.load([ADMINS, EDITORS], source='test')
+        return index
+
+    def test_load(self):
+        index = self._makeOne()
+        self.assertTrue(index.isLoaded())
+        self.assertEqual(index.source, 'test')
+        both = (('Admins', ADMINS['dn']), ('Editors', EDITORS['dn']))
+        self.assertEqual(index.getGroups(), both)
+        self.assertEqual(index.getGroupsForMember(USER1), both)
+        self.assertEqual(index.getGroupsForMember(USER2),
+                         (('Editors', EDITORS['dn']),))
+        self.assertEqual(index.getGroupsForMember('cn=nobody'), ())
+        self.assertEqual(index.getStatistics()['groups'], 2)
+        self.assertEqual(index.getStatistics()['members'], 2)
+
+        index.clear()
+        self.assertFalse(index.isLoaded())
+        self.assertEqual(index.getGroups(), ())
+
+    def test_getGroup(self):
+        from ..groupindex import getGroupType
+        index = self._makeOne()
+        record = index.getGroup(EDITORS['dn'].upper())
+        self.assertEqual(record, EDITORS)
+        self.assertEqual(getGroupType(record), 'groupOfNames')
+        # Changing the copy does not change the index
+        record['member'].append('cn=user3')
+        self.assertEqual(index.getGroup(EDITORS['dn']), EDITORS)
+        self.assertEqual(index.getGroupByCN('admins'), ADMINS)
+        self.assertIsNone(index.getGroupByCN('missing'))
+
+    def test_members(self):
+        index = self._makeOne()
+        index.addMember(ADMINS['dn'], USER2)
+        self.assertEqual([x[0] for x in index.getGroupsForMember(USER2)],
+                         ['Admins', 'Editors'])
+        self.assertIn(USER2, index.getGroup(ADMINS['dn'])['uniqueMember'])
+
+        index.removeMember(EDITORS['dn'], USER1)
+        index.removeMember(ADMINS['dn'], USER1)
+        self.assertEqual(index.getGroupsForMember(USER1), ())
+        self.assertEqual(index.getGroup(EDITORS['dn'])['member'], [USER2])
+
+        # Unknown groups are ignored
+        index.addMember('cn=missing', USER1)
+        self.assertEqual(index.getGroupsForMember(USER1), ())
+
+    def test_groups(self):
+        index = self._makeOne()
+        index.removeGroup(EDITORS['dn'])
+        self.assertEqual(index.getGroupsForMember(USER2), ())
+        self.assertEqual(index.getGroups(), (('Admins', ADMINS['dn']),))
+
+        index.addGroup(EDITORS)
+        self.assertEqual(index.getGroupsForMember(USER2),
+                         (('Editors', EDITORS['dn']),))
+
+    def test_ancestors(self):
+        from ..groupindex import GroupIndex
+        base = 'ou=groups,dc=example,dc=com'
+        records = [{'dn': f'cn={name},{base}', 'cn': [name],
+                    'objectClass': ['groupOfNames'],
+                    'member': [f'cn={x},{base}' for x in members]}
+                   for name, members in (('a', ['b']), ('b', ['c']),
+                                         ('c', ['a']), ('d', ['c']))]
+        index = GroupIndex()
+        index.load(records)
+        c_dn = f'cn=c,{base}'
+
+        # a contains b contains c, c contains a: the cycle ends at c
+        self.assertEqual([x[0] for x in index.getAncestors(c_dn, 10)],
+                         ['b', 'd', 'a'])
+        self.assertEqual([x[0] for x in index.getAncestors(c_dn, 1)],
+                         ['b', 'd'])
+        self.assertEqual([x[0] for x in index.expand([('c', c_dn)], 1)],
+                         ['c', 'b', 'd'])
+
+        # Changes between groups are reflected right away
+        index.removeMember(f'cn=d,{base}', c_dn)
+        self.assertEqual([x[0] for x in index.getAncestors(c_dn, 10)],
+                         ['b', 'a'])
@@ -0,0 +1,90 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the InvalidationLog class
+"""
+
+import unittest
+
+
+class TestInvalidationLog(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..invalidation import InvalidationLog
+        return InvalidationLog()
+
+    def test_getChanges(self):
+        log = self._makeOne()
+        self.assertEqual(log.getState(), (0, 0))
+        self.assertEqual(log.getChanges((0, 0)), [])
+
+        log.invalidateUser('user1')
+        log.invalidateUser('user2')
+        self.assertEqual(log.getState(), (0, 2))
+        self.assertEqual(log.getChanges((0, 0)), ['user1', 'user2'])
+        self.assertEqual(log.getChanges((0, 1)), ['user2'])
+        self.assertEqual(log.getChanges((0, 2)), [])
+
+        log.invalidateAll()
+        self.assertEqual(log.getState(), (1, 2))
+        self.assertIsNone(log.getChanges((0, 2)))
+        log.invalidateUser('user3')
+        self.assertEqual(log.getChanges((1, 2)), ['user3'])
+
+    def test_bounded(self):
+        log = self._makeOne()
+        log.max_entries = 5
+        for i in range(10):
+            log.invalidateUser(f'user{i}')
+        self.assertEqual(len(log.entries), 5)
+        self.assertEqual(log.getChanges((0, 5)),
+                         ['user5', 'user6', 'user7', 'user8', 'user9'])
+        # The log does not reach back far enough
+        self.assertIsNone(log.getChanges((0, 4)))
+
+    def test_resolveConflict(self):
+        log = self._makeOne()
+        log.invalidateUser('user1')
+        old = log.__getstate__()
+
+        committed = self._makeOne()
+        committed.__setstate__(dict(old))
+        committed.invalidateUser('user2')
+
+        new = self._makeOne()
+        new.__setstate__(dict(old))
+        new.invalidateUser('user3')
+        new.invalidateUser('user4')
+
+        resolved = log._p_resolveConflict(old, committed.__getstate__(),
+                                          new.__getstate__())
+        log.__setstate__(resolved)
+        self.assertEqual(log.getState(), (0, 4))
+        self.assertEqual(log.getChanges((0, 1)), ['user2', 'user3', 'user4'])
+
+    def test_resolveConflict_invalidateAll(self):
+        log = self._makeOne()
+        old = log.__getstate__()
+
+        committed = self._makeOne()
+        committed.invalidateUser('user1')
+
+        new = self._makeOne()
+        new.invalidateAll()
+        new.invalidateUser('user2')
+
+        resolved = log._p_resolveConflict(old, committed.__getstate__(),
+                                          new.__getstate__())
+        log.__setstate__(resolved)
+        self.assertEqual(log.getState(), (1, 2))
+        self.assertIsNone(log.getChanges((0, 1)))
+        self.assertEqual(log.getChanges((1, 1)), ['user2'])
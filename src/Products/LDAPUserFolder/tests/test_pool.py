@@ -0,0 +1,238 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the ConnectionPool class
+"""
+
+import threading
+import time
+import unittest
+
+
+class DummyConnection:
+
+    def __init__(self, name='dummy'):
+        self.name = name
+        self.unbound = False
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def _makeOne(self, *args, **kw):
+        from ..pool import ConnectionPool
+
+        return ConnectionPool(*args, **kw)
+
+    def test_checkout_creates_connection(self):
+        pool = self._makeOne()
+        pooled = pool.checkout('key', DummyConnection)
+        self.assertIsInstance(pooled.connection, DummyConnection)
+        self.assertEqual(pooled.key, 'key')
+        self.assertEqual(pooled.uses, 1)
+        self.assertEqual(len(pool), 1)
+
+    def test_checkin_and_reuse(self):
+        pool = self._makeOne()
+        pooled = pool.checkout('key', DummyConnection)
+        pool.checkin(pooled)
+        self.assertEqual(pool.getStatistics()['idle'], 1)
+
+        again = pool.checkout('key', DummyConnection)
+        self.assertIs(again, pooled)
+        self.assertEqual(again.uses, 2)
+        self.assertEqual(len(pool), 1)
+
+    def test_keys_are_separate(self):
+        pool = self._makeOne()
+        pooled = pool.checkout('key1', DummyConnection)
+        pool.checkin(pooled)
+
+        other = pool.checkout('key2', DummyConnection)
+        self.assertIsNot(other, pooled)
+        self.assertEqual(len(pool), 2)
+
+    def test_checkout_prefers_bound_identity(self):
+        pool = self._makeOne()
+        first = pool.checkout('key', DummyConnection)
+        first.bound_as = 'alice'
+        second = pool.checkout('key', DummyConnection)
+        second.bound_as = 'bob'
+        pool.checkin(first)
+        pool.checkin(second)
+
+        self.assertIs(pool.checkout('key', None, prefer='alice'), first)
+        self.assertIs(pool.checkout('key', DummyConnection,
+                                    prefer='alice'), second)
+
+    def test_concurrent_checkouts_get_separate_connections(self):
+        pool = self._makeOne()
+        first = pool.checkout('key', DummyConnection)
+        second = pool.checkout('key', DummyConnection)
+        self.assertIsNot(first.connection, second.connection)
+
+    def test_unhealthy_connection_is_discarded(self):
+        pool = self._makeOne()
+        pooled = pool.checkout('key', DummyConnection)
+        pooled.markFailed()
+        pool.checkin(pooled)
+        self.assertTrue(pooled.connection.unbound)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.getStatistics()['discarded'], 1)
+
+    def test_factory_failure_frees_slot(self):
+        pool = self._makeOne(max_size=1)
+
+        def broken():
+            raise ValueError('no connection')
+
+        self.assertRaises(ValueError, pool.checkout, 'key', broken)
+        self.assertEqual(len(pool), 0)
+        pool.checkout('key', DummyConnection)
+        self.assertEqual(len(pool), 1)
+
+    def test_max_size_evicts_idle_connection(self):
+        pool = self._makeOne(max_size=1)
+        pooled = pool.checkout('key1', DummyConnection)
+        pool.checkin(pooled)
+
+        other = pool.checkout('key2', DummyConnection)
+        self.assertTrue(pooled.connection.unbound)
+        self.assertEqual(other.key, 'key2')
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(pool.getStatistics()['evicted'], 1)
+
+    def test_max_size_exhausted(self):
+        from ..pool import PoolExhaustedError
+        pool = self._makeOne(max_size=1, checkout_timeout=0.1)
+        pool.checkout('key', DummyConnection)
+        self.assertRaises(PoolExhaustedError,
+                          pool.checkout, 'key', DummyConnection)
+
+    def test_waiting_checkout_gets_returned_connection(self):
+        pool = self._makeOne(max_size=1, checkout_timeout=5)
+        pooled = pool.checkout('key', DummyConnection)
+        result = []
+
+        def waiter():
+            result.append(pool.checkout('key', DummyConnection))
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.1)
+        pool.checkin(pooled)
+        thread.join(5)
+        self.assertEqual(result, [pooled])
+
+    def test_reap(self):
+        pool = self._makeOne(idle_timeout=0.1)
+        pooled = pool.checkout('key', DummyConnection)
+        pool.checkin(pooled)
+        time.sleep(0.2)
+        pool.reap()
+        self.assertTrue(pooled.connection.unbound)
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.getStatistics()['reaped'], 1)
+
+    def test_clear(self):
+        pool = self._makeOne()
+        idle = pool.checkout('key', DummyConnection)
+        busy = pool.checkout('key', DummyConnection)
+        pool.checkin(idle)
+        pool.clear()
+        self.assertTrue(idle.connection.unbound)
+        self.assertEqual(len(pool), 0)
+
+        # Connections checked out before clearing are not reused
+        pool.checkin(busy)
+        self.assertTrue(busy.connection.unbound)
+        self.assertEqual(len(pool), 0)
+
+
+class TestCounters(unittest.TestCase):
+
+    def test_increment(self):
+        from ..pool import Counters
+        counters = Counters()
+        self.assertEqual(counters.get('hops'), 0)
+        counters.increment('hops')
+        counters.increment('hops', 2)
+        self.assertEqual(counters.get('hops'), 3)
+        self.assertEqual(counters.asDict(), {'hops': 3})
+
+
+class TestRace(unittest.TestCase):
+
+    def _race(self, *args, **kw):
+        from ..pool import race
+
+        return race(*args, **kw)
+
+    def _attempt(self, value, delay=0, fail=False):
+        def attempt():
+            time.sleep(delay)
+            if fail:
+                raise ValueError(value)
+            return value
+        return attempt
+
+    def test_first_attempt_wins(self):
+        attempts = [self._attempt('one'), self._attempt('two')]
+        self.assertEqual(self._race(attempts, 1), 'one')
+
+    def test_slow_attempt_is_overtaken(self):
+        losers = []
+        attempts = [self._attempt('slow', delay=0.3),
+                    self._attempt('fast')]
+        start = time.monotonic()
+        self.assertEqual(self._race(attempts, 0.05, loser=losers.append),
+                         'fast')
+        self.assertTrue(time.monotonic() - start < 0.3)
+
+        # The loser is handed over once it finishes
+        time.sleep(0.5)
+        self.assertEqual(losers, ['slow'])
+
+    def test_failure_starts_next_attempt_at_once(self):
+        attempts = [self._attempt('broken', fail=True),
+                    self._attempt('two')]
+        start = time.monotonic()
+        self.assertEqual(self._race(attempts, 5), 'two')
+        self.assertTrue(time.monotonic() - start < 1)
+
+    def test_later_attempts_not_started_after_success(self):
+        started = []
+
+        def attempts():
+            for value in ('one', 'two'):
+                started.append(value)
+                yield self._attempt(value)
+
+        self.assertEqual(self._race(attempts(), 1), 'one')
+        self.assertEqual(started, ['one'])
+
+    def test_all_fail(self):
+        attempts = [self._attempt('one', fail=True),
+                    self._attempt('two', fail=True)]
+        self.assertRaises(ValueError, self._race, attempts, 0.01)
+
+    def test_attempt_raising_base_exception(self):
+        def exiting():
+            raise SystemExit()
+
+        attempts = [exiting, self._attempt('two')]
+        start = time.monotonic()
+        self.assertEqual(self._race(attempts, 5), 'two')
+        self.assertTrue(time.monotonic() - start < 1)
+        self.assertRaises(SystemExit, self._race, [exiting], 5)
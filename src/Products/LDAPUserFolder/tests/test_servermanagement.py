@@ -41,3 +41,30 @@ class TestServerManagement(LDAPTest):
         svr = [x for x in acl.getServers() if x['host'] == 'ldap.some.com'][0]
         self.assertEqual(svr['conn_timeout'], 15)
         self.assertEqual(svr['op_timeout'], 10)
+
+    def testServerSelection(self):
+        acl = self.folder.acl_users
+        acl.manage_addServer('ldap.some.com', port=636, use_ssl=1)
+        self.assertEqual(acl.getServerSelection(), 'failover')
+        names = [x['name'] for x in acl.getServerSelectionStrategies()]
+        self.assertIn('roundrobin', names)
+        self.assertIn('weighted', names)
+        self.assertIn('latency', names)
+
+        acl.manage_setServerSelection('weighted', weights=['3', '0'])
+        self.assertEqual(acl.getServerSelection(), 'weighted')
+        status = acl.getServerStatus()
+        self.assertEqual([x['weight'] for x in status], [3, 0])
+        self.assertEqual(status[1]['host'], 'ldap.some.com')
+
+        # Unknown strategies are refused
+        acl.manage_setServerSelection('bogus')
+        self.assertEqual(acl.getServerSelection(), 'weighted')
+
+    def testServerHealth(self):
+        acl = self.folder.acl_users
+        acl.getUserNames()
+        status = acl.getServerStatus()[0]
+        self.assertTrue(status['healthy'])
+        self.assertTrue(status['successes'] > 0)
+        self.assertEqual(status['failures'], 0)
@@ -0,0 +1,251 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for server health bookkeeping and server selection strategies
+"""
+
+import unittest
+
+
+SERVERS = [('ldap://one:389', {}), ('ldap://two:389', {}),
+           ('ldap://three:389', {})]
+
+
+class TestServerHealth(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..servers import ServerHealth
+
+        return ServerHealth('ldap://one:389')
+
+    def test_defaults(self):
+        health = self._makeOne()
+        self.assertTrue(health.isHealthy())
+        self.assertEqual(health.score, 1.0)
+        self.assertIsNone(health.latency)
+
+    def test_failure_and_recovery(self):
+        health = self._makeOne()
+        health.recordFailure(1)
+        self.assertFalse(health.isHealthy(30))
+        self.assertTrue(health.score < 1.0)
+        low_score = health.score
+
+        health.recordSuccess(0.5)
+        self.assertTrue(health.isHealthy(30))
+        self.assertTrue(health.score > low_score)
+        self.assertEqual(health.latency, 0.5)
+        self.assertEqual(health.successes, 1)
+        self.assertEqual(health.failures, 1)
+
+    def test_latency_average(self):
+        health = self._makeOne()
+        health.recordSuccess(1.0)
+        health.recordSuccess(0.0)
+        self.assertTrue(0.0 < health.latency < 1.0)
+
+
+class TestSelectionStrategies(unittest.TestCase):
+
+    def setUp(self):
+        from ..servers import HealthRegistry
+
+        self.health = HealthRegistry(threshold=1, cooldown=30)
+
+    def _order(self, name, weights=None):
+        from ..servers import getSelectionStrategy
+
+        strategy = getSelectionStrategy(name)
+        ordered = strategy(SERVERS, self.health, weights or {})
+
+        return [x[0] for x in ordered]
+
+    def test_unknown_strategy_falls_back_to_failover(self):
+        from ..servers import getSelectionStrategy
+        from ..servers import orderFailover
+
+        self.assertIs(getSelectionStrategy('bogus'), orderFailover)
+
+    def test_failover(self):
+        self.assertEqual(self._order('failover'), [x[0] for x in SERVERS])
+
+    def test_failed_servers_last(self):
+        self.health.recordFailure('ldap://one:389')
+        for name in ('failover', 'roundrobin', 'weighted', 'latency'):
+            self.assertEqual(self._order(name)[-1], 'ldap://one:389')
+
+    def test_failures_below_threshold(self):
+        self.health.threshold = 2
+        self.health.recordFailure('ldap://one:389')
+        self.assertEqual(self._order('failover'), [x[0] for x in SERVERS])
+
+    def test_failed_server_returns_after_cooldown(self):
+        # Without a health monitor nothing but the cool-down brings the
+        # primary server back to the front
+        self.health.recordFailure('ldap://one:389')
+        self.assertEqual(self._order('failover')[0], 'ldap://two:389')
+
+        self.health.get('ldap://one:389').opened -= 31
+        self.assertEqual(self._order('failover'), [x[0] for x in SERVERS])
+        self.assertTrue(self.health.allowRequest('ldap://one:389'))
+
+    def test_roundrobin(self):
+        firsts = {self._order('roundrobin')[0] for i in range(3)}
+        self.assertEqual(len(firsts), 3)
+
+    def test_weighted(self):
+        weights = {'ldap://one:389': 0, 'ldap://two:389': 1,
+                   'ldap://three:389': 0}
+        for i in range(10):
+            self.assertEqual(self._order('weighted', weights)[0],
+                             'ldap://two:389')
+
+        # All servers are always returned
+        self.assertEqual(sorted(self._order('weighted', weights)),
+                         sorted(x[0] for x in SERVERS))
+
+    def test_latency(self):
+        self.health.recordSuccess('ldap://one:389', 0.3)
+        self.health.recordSuccess('ldap://two:389', 0.1)
+        self.health.recordSuccess('ldap://three:389', 0.2)
+        self.assertEqual(self._order('latency'),
+                         ['ldap://two:389', 'ldap://three:389',
+                          'ldap://one:389'])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..servers import ServerHealth
+
+        return ServerHealth('ldap://one:389')
+
+    def test_opens_after_threshold(self):
+        from ..servers import CLOSED
+        from ..servers import OPEN
+        health = self._makeOne()
+        health.recordFailure(2)
+        self.assertEqual(health.getState(30), CLOSED)
+        self.assertTrue(health.allowRequest(30))
+        health.recordFailure(2)
+        self.assertEqual(health.getState(30), OPEN)
+        self.assertFalse(health.allowRequest(30))
+
+    def test_disabled(self):
+        from ..servers import CLOSED
+        health = self._makeOne()
+        for i in range(10):
+            health.recordFailure(0)
+        self.assertEqual(health.getState(30), CLOSED)
+
+    def test_single_trial_after_cooldown(self):
+        from ..servers import CLOSED
+        from ..servers import HALF_OPEN
+        health = self._makeOne()
+        health.recordFailure(1)
+        later = health.opened + 31
+        self.assertEqual(health.getState(30, later), HALF_OPEN)
+        self.assertTrue(health.allowRequest(30, later))
+        self.assertFalse(health.allowRequest(30, later + 1))
+
+        health.recordSuccess()
+        self.assertEqual(health.getState(30), CLOSED)
+
+    def test_failed_trial_reopens(self):
+        from ..servers import OPEN
+        health = self._makeOne()
+        health.recordFailure(3)
+        health.recordFailure(3)
+        health.recordFailure(3)
+        health.opened -= 31
+        self.assertTrue(health.allowRequest(30))
+        health.recordFailure(3)
+        self.assertEqual(health.getState(30), OPEN)
+
+    def test_open_servers_tried_last(self):
+        from ..servers import HealthRegistry
+        from ..servers import allowedServers
+        registry = HealthRegistry(threshold=1, cooldown=30)
+        registry.recordFailure('ldap://one:389')
+        self.assertEqual([x[0] for x in allowedServers(SERVERS, registry)],
+                         [x[0] for x in SERVERS[1:] + SERVERS[:1]])
+
+        # Even with all breakers open every server is still tried
+        for server in SERVERS:
+            registry.recordFailure(server[0])
+        self.assertEqual([x[0] for x in allowedServers(SERVERS, registry)],
+                         [x[0] for x in SERVERS])
+
+    def test_registry_skips_open_servers(self):
+        from ..servers import HealthRegistry
+        registry = HealthRegistry(threshold=1, cooldown=30)
+        registry.recordFailure('ldap://one:389')
+        self.assertFalse(registry.allowRequest('ldap://one:389'))
+        self.assertTrue(registry.allowRequest('ldap://two:389'))
+        self.assertEqual(registry.getInfo('ldap://one:389')['breaker'],
+                         'open')
+
+
+class TestHealthMonitor(unittest.TestCase):
+
+    def setUp(self):
+        from ..servers import HealthMonitor
+        from ..servers import HealthRegistry
+
+        self.health = HealthRegistry(threshold=1)
+        self.monitor = HealthMonitor(self.health)
+        self.probed = []
+
+    def tearDown(self):
+        self.monitor.stop()
+
+    def _probe(self, uri, fail=False):
+        self.probed.append(uri)
+        if fail:
+            raise OSError('unreachable')
+
+    def test_probeAll(self):
+        self.monitor.configure(self._probe,
+                               [('ldap://one:389', ()),
+                                ('ldap://two:389', (('fail', True),))], 60)
+        self.monitor.probeAll()
+        self.assertEqual(self.probed, ['ldap://one:389', 'ldap://two:389'])
+
+        one = self.health.getInfo('ldap://one:389')
+        self.assertTrue(one['healthy'])
+        self.assertIsNotNone(one['latency'])
+        self.assertIsNotNone(one['last_probe'])
+
+        two = self.health.getInfo('ldap://two:389')
+        self.assertFalse(two['healthy'])
+        self.assertEqual(two['breaker'], 'open')
+
+    def test_start_and_stop(self):
+        import time
+        self.monitor.configure(self._probe, [('ldap://one:389', ())], 0.01)
+        self.monitor.start()
+        self.assertTrue(self.monitor.isRunning())
+        time.sleep(0.1)
+        self.monitor.stop()
+        self.assertFalse(self.monitor.isRunning())
+        self.assertTrue(len(self.probed) > 1)
+
+        # Stopped monitors can be started again
+        self.monitor.start()
+        self.assertTrue(self.monitor.isRunning())
+
+    def test_stopAllMonitors(self):
+        from ..servers import stopAllMonitors
+        self.monitor.configure(self._probe, [], 60)
+        self.monitor.start()
+        stopAllMonitors()
+        self.assertFalse(self.monitor.isRunning())
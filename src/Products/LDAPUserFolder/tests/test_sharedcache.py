@@ -0,0 +1,235 @@
+##############################################################################
+#
+# Copyright (c) 2000-2023 Jens Vagelpohl and Contributors. All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+""" Tests for the shared cache server and backend
+"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+TESTPWD = 'test'
+
+
+class CacheObject:
+
+    def __init__(self, id, password=TESTPWD):
+        self.id = id
+        self.password = password
+
+    def getId(self):
+        return self.id
+
+    def _getPassword(self):
+        return self.password
+
+    def _setPassword(self, password):
+        self.password = password
+
+
+class SharedCacheTestBase(unittest.TestCase):
+
+    def setUp(self):
+        from ..sharedcache import CacheServer
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache.sock')
+        self.server = CacheServer(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.backends = []
+        self.backend = self._makeBackend()
+
+    def _makeBackend(self):
+        from ..sharedcache import SocketCacheBackend
+        backend = SocketCacheBackend(self.path)
+        self.backends.append(backend)
+        return backend
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.client._close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        os.rmdir(self.tempdir)
+
+
+class TestSharedUserCache(SharedCacheTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = self.backend.createUserCache('users')
+        self.cache.setTimeout(0.1)
+
+    def testInterfaces(self):
+        from zope.interface.verify import verifyObject
+
+        from dataflake.cache.interfaces import ITimeoutCache
+
+        from ..interfaces import ICacheBackend
+        verifyObject(ICacheBackend, self.backend)
+        verifyObject(ITimeoutCache, self.cache)
+
+    def testCaching(self):
+        self.cache.set('TestId', CacheObject('test'))
+        self.assertEqual(self.cache.get('testid').id, 'test')
+        self.assertEqual(self.cache.get('testid', TESTPWD).id, 'test')
+        self.assertIsNone(self.cache.get('testid', 'wrong'))
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.keys(), ['testid'])
+        self.assertEqual([x.id for x in self.cache.getCache()], ['test'])
+        time.sleep(0.2)
+        self.assertIsNone(self.cache.get('testid'))
+        self.assertEqual(len(self.cache), 0)
+
+    def testPasswordNotShared(self):
+        import pickle
+        ob = CacheObject('test', 'Sekr1t')
+        self.cache.set('TestId', ob)
+        self.assertEqual(ob._getPassword(), 'Sekr1t')
+        data = self.server.namespaces['users'].entries['testid'][1]
+        self.assertNotIn(b'Sekr1t', data)
+        verifier, stored = pickle.loads(data)
+        self.assertEqual(stored._getPassword(), 'undef')
+
+        # Only users retrieved with the password get it back
+        self.assertEqual(self.cache.get('testid', 'Sekr1t')._getPassword(),
+                         'Sekr1t')
+        self.assertEqual(self.cache.get('testid')._getPassword(), 'undef')
+        other = self._makeBackend().createUserCache('users')
+        self.assertIsNone(other.get('testid', 'wrong'))
+        self.assertEqual(other.get('testid', 'Sekr1t')._getPassword(),
+                         'Sekr1t')
+
+        # Values that are no users are stored as they are
+        self.cache.set('cn=test', ('cn=test', []))
+        self.assertEqual(self.cache.get('cn=test'), ('cn=test', []))
+
+    def testClaimInvalidations(self):
+        other = self._makeBackend()
+        self.assertEqual(self.backend.claimInvalidations('inv', (1, 5),
+                                                         (0, 0)), (0, 0))
+        self.assertIsNone(other.claimInvalidations('inv', (1, 5), (0, 0)))
+        self.assertEqual(other.claimInvalidations('inv', (1, 7), (1, 5)),
+                         (1, 5))
+        self.assertIsNone(self.backend.claimInvalidations('inv', (1, 7),
+                                                          (1, 5)))
+
+    def testShared(self):
+        other = self._makeBackend().createUserCache('users')
+        unrelated = self.backend.createUserCache('other')
+        self.cache.set('TestId', CacheObject('test'))
+        self.assertEqual(other.get('testid').id, 'test')
+        self.assertIsNone(unrelated.get('testid'))
+
+        other.invalidate('testid')
+        self.assertIsNone(self.cache.get('testid'))
+
+        self.cache.set('TestId', CacheObject('test'))
+        other.invalidate()
+        self.assertIsNone(self.cache.get('testid'))
+
+    def testGrace(self):
+        self.cache.setGrace(60)
+        self.cache.set('TestId', CacheObject('stale'))
+        self.assertIsNone(self.cache.getStale('testid'))
+        time.sleep(0.2)
+        self.assertIsNone(self.cache.get('testid'))
+        self.assertEqual(self.cache.getStale('testid').id, 'stale')
+        self.assertIsNone(self.cache.getStale('testid', 'wrong'))
+
+    def testLimits(self):
+        self.cache.setTimeout(60)
+        self.cache.setLimits(max_entries=2)
+        for i in range(3):
+            self.cache.set(f'key{i}', CacheObject(f'key{i}'))
+        self.assertEqual(sorted(self.cache.keys()), ['key1', 'key2'])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def testStatistics(self):
+        self.cache.set('TestId', CacheObject('test'))
+        self.cache.get('testid')
+        self.cache.get('missing')
+        self.cache.invalidate('testid')
+        stats = self.cache.getStatistics()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['inserts'], 1)
+        self.assertEqual(stats['invalidations'], 1)
+        self.assertEqual(stats['entries'], 0)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+        self.cache.resetStatistics()
+        self.assertEqual(self.cache.getStatistics()['hits'], 0)
+
+    def testServerUnavailable(self):
+        self.cache.set('TestId', CacheObject('test'))
+        self.server.shutdown()
+        self.server.server_close()
+        self.backend.client._close()
+        self.assertIsNone(self.cache.get('testid'))
+        # Further requests fail right away
+        self.assertTrue(self.backend.client._down_until > time.monotonic())
+        self.assertEqual(self.cache.getCache(), [])
+        self.cache.set('TestId', CacheObject('test'))
+        self.assertEqual(len(self.cache), 0)
+
+
+class TestSharedMiscCache(SharedCacheTestBase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = self.backend.createMiscCache('misc')
+        self.cache.setTimeout(0.1)
+
+    def testCaching(self):
+        self.cache.set('useridlist', ['a', 'b'])
+        other = self._makeBackend().createMiscCache('misc')
+        self.assertEqual(other.get('useridlist'), ['a', 'b'])
+        self.assertEqual(other.items(), [('useridlist', ['a', 'b'])])
+        time.sleep(0.2)
+        self.assertEqual(self.cache.get('useridlist', 'default'), 'default')
+        self.assertEqual(self.cache.getStatistics()['expirations'], 1)
+
+
+class TestCacheServer(unittest.TestCase):
+
+    def test_refuses_running_server(self):
+        from ..sharedcache import CacheServer
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, 'cache.sock')
+        server = CacheServer(path)
+        try:
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            self.assertRaises(OSError, CacheServer, path)
+        finally:
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+        # A stale socket file is replaced
+        open(path, 'w').close()
+        server = CacheServer(path)
+        server.server_close()
+        os.rmdir(tempdir)
+
+    def test_registered(self):
+        from ..cache import getCacheBackend
+        from ..cache import registeredCacheBackends
+        from ..sharedcache import SocketCacheBackend
+        self.assertIn('socket', registeredCacheBackends())
+        backend = getCacheBackend('socket', '/tmp/unused.sock')
+        self.assertIsInstance(backend, SocketCacheBackend)
+        self.assertIs(getCacheBackend('socket', '/tmp/unused.sock'), backend)
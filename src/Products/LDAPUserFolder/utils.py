@@ -36,6 +36,9 @@ BINARY_ATTRIBUTES = ('objectguid', 'jpegphoto')
 
 HTTP_METHODS = ('GET', 'PUT', 'POST')
 
+# Error message in search results after a refused bind
+INVALID_CREDENTIALS_MESSAGE = 'Invalid authentication credentials'
+
 GROUP_MEMBER_MAP = {'groupOfUniqueNames': 'uniqueMember',
                     'groupOfNames': 'member',
                     'accessGroup': 'member',
@@ -47,6 +50,9 @@ GROUP_MEMBER_ATTRIBUTES = set(list(GROUP_MEMBER_MAP.values()))
 VALID_GROUP_ATTRIBUTES = {'name', 'displayName', 'cn', 'dn', 'objectGUID',
                           'description', 'mail'}.union(GROUP_MEMBER_ATTRIBUTES)
 
+# Active Directory LDAP_MATCHING_RULE_IN_CHAIN, matches transitively
+MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
 
 #################################################
 # Helper methods for other modules